@@ -0,0 +1,156 @@
+from functools import lru_cache
+import numpy as np
+
+# Dynamic World land cover classes, in the order of their class index
+DW_CLASSES = [
+    "water",
+    "trees",
+    "grass",
+    "flooded_vegetation",
+    "crops",
+    "shrub_and_scrub",
+    "built",
+    "bare",
+    "snow_and_ice",
+]
+
+# RGB color of each class in the "visualize" exports (see GeemapUtils.dynamic_world)
+DW_PALETTE = np.array(
+    [
+        [65, 155, 223],
+        [57, 125, 73],
+        [136, 176, 83],
+        [122, 135, 198],
+        [228, 150, 53],
+        [223, 195, 90],
+        [196, 40, 27],
+        [165, 155, 143],
+        [179, 159, 225],
+    ],
+    dtype=np.uint8,
+)
+
+# Class index of the pixels matching none of the palette colors, e.g. black (0, 0, 0) no-data pixels
+NO_DATA = len(DW_CLASSES)
+N_LABELS = NO_DATA + 1
+
+BUILT = DW_CLASSES.index("built")
+SNOW = DW_CLASSES.index("snow_and_ice")
+
+
+@lru_cache(maxsize=1)
+def _rgb_lookup_table():
+    # One entry per 24-bit RGB color (16 MB), built once
+    lut = np.full(1 << 24, NO_DATA, dtype=np.uint8)
+    keys = (
+        (DW_PALETTE[:, 0].astype(np.uint32) << 16)
+        | (DW_PALETTE[:, 1].astype(np.uint32) << 8)
+        | DW_PALETTE[:, 2]
+    )
+    lut[keys] = np.arange(len(DW_CLASSES))
+    return lut
+
+
+def rgb_to_class(image):
+    """
+    Convert a Dynamic World "visualize" image into a class-index raster.
+
+    Args:
+        image (np.ndarray): An (H, W, 3) or (H, W, 4) uint8 RGB(A) image.
+
+    Returns:
+        np.ndarray: An (H, W) uint8 raster of class indices, NO_DATA for pixels whose color is not in DW_PALETTE.
+    """
+    key = image[..., 0].astype(np.uint32) << 16
+    key |= image[..., 1].astype(np.uint32) << 8
+    key |= image[..., 2]
+    return _rgb_lookup_table()[key]
+
+
+def to_class_raster(image):
+    """
+    Return the class-index raster of an image, whether it is a "visualize" RGB(A) image or already a class-index
+    raster (from the "class" exports).
+    """
+    if image.ndim == 3:
+        return rgb_to_class(image)
+    return image
+
+
+def class_to_rgb(class_raster):
+    """
+    Render a class-index raster with the colors of the "visualize" exports, NO_DATA pixels being black.
+
+    Returns:
+        np.ndarray: An (H, W, 3) uint8 RGB image.
+    """
+    palette = np.vstack([DW_PALETTE, np.zeros((1, 3), dtype=np.uint8)])
+    return palette[np.minimum(class_raster, NO_DATA)]
+
+
+@lru_cache(maxsize=2)
+def _gray_lookup_table(normalize):
+    # Gray level of every class index: the luminance of the class color as computed by PIL's convert("L") (ITU-R
+    # 601-2 with PIL's fixed-point rounding), so the levels match the grayscale conversion of the "visualize" images.
+    # Every class color has its own luminance, and NO_DATA (and any other index) is black
+    palette = DW_PALETTE.astype(np.int64)
+    luminance = (
+        palette[:, 0] * 19595 + palette[:, 1] * 38470 + palette[:, 2] * 7471 + 0x8000
+    ) >> 16
+    levels = np.zeros(256, dtype=np.uint8)
+    levels[: len(DW_CLASSES)] = luminance
+    if normalize:
+        return levels.astype(np.float32) / 255.0
+    return levels
+
+
+def class_to_gray(class_raster, normalize=False):
+    """
+    Quantize a class-index raster to fixed gray levels with a 256-entry lookup table.
+
+    The level of a class is the PIL "L" luminance of its color, and NO_DATA is black. It does not depend on the image,
+    so a class has the same value across images and years.
+
+    Args:
+        class_raster (np.ndarray): A uint8 raster of class indices, of any shape.
+        normalize (bool): Whether to return float32 levels in [0, 1] instead of uint8 levels in [0, 255].
+
+    Returns:
+        np.ndarray: The gray levels, with the shape of class_raster.
+    """
+    return _gray_lookup_table(normalize)[class_raster]
+
+
+def color_to_class(color):
+    """
+    Return the class index of an RGB color of the "visualize" exports, NO_DATA for black or unknown colors.
+    """
+    return int(rgb_to_class(np.asarray(color, dtype=np.uint8).reshape(1, 3))[0])
+
+
+# -------------------------------------------------------------------------- #
+#                           4-bit packed labels                              #
+# -------------------------------------------------------------------------- #
+
+
+def pack_labels(class_raster):
+    """
+    Pack a class-index raster with two 4-bit labels per byte, the even column in the high nibble.
+
+    Returns:
+        np.ndarray: An (H, ceil(W / 2)) uint8 array.
+    """
+    height, width = class_raster.shape
+    if width % 2:
+        class_raster = np.pad(class_raster, ((0, 0), (0, 1)), constant_values=NO_DATA)
+    return (class_raster[:, 0::2] << 4) | class_raster[:, 1::2]
+
+
+def unpack_labels(packed, width):
+    """
+    Unpack a raster packed by pack_labels into an (H, width) uint8 class-index raster.
+    """
+    class_raster = np.empty((packed.shape[0], 2 * packed.shape[1]), dtype=np.uint8)
+    np.right_shift(packed, 4, out=class_raster[:, 0::2])
+    np.bitwise_and(packed, 0x0F, out=class_raster[:, 1::2])
+    return class_raster[:, :width]
@@ -1,9 +1,10 @@
 import geopandas as gpd
-from shapely.geometry import Polygon
+import shapely
 
 # from pyproj import Geod
 from tqdm import tqdm
 import matplotlib.pyplot as plt
+import os
 import pickle
 import pandas as pd
 import numpy as np
@@ -18,6 +19,25 @@ from tqdm.contrib import tzip
 import matplotlib.cm as cm
 from shapely.geometry import box
 from tqdm import tqdm
+from ImplicitGrid import ImplicitGrid
+from FishnetStore import write_fishnet, read_fishnet
+
+# Columns describing a fishnet tile when its shapely geometry has not been built
+LAZY_GEOMETRY_COLUMNS = ["row", "col", "minx", "miny", "maxx", "maxy"]
+
+
+def _polygonal_parts(geometry):
+    # Polygonal part of each geometry, empty for points and lines (the keep_geom_type behavior of gpd.overlay)
+    geometry = geometry.copy()
+    type_ids = shapely.get_type_id(geometry)
+    geometry[~np.isin(type_ids, [3, 6, 7])] = shapely.Polygon()
+    for i in np.flatnonzero(type_ids == 7):
+        parts = shapely.get_parts(geometry[i])
+        polygons = parts[np.isin(shapely.get_type_id(parts), [3, 6])]
+        geometry[i] = (
+            shapely.union_all(polygons) if len(polygons) else shapely.Polygon()
+        )
+    return geometry
 
 
 class Fishnet:
@@ -75,7 +95,14 @@ class Fishnet:
         self.crs = self.tx.crs
         print("Using Shapefile to initialize fishnet.")
 
-    def create_fishnet(self):
+    def create_fishnet(self, lazy_geometry=False):
+        """
+        Generate the fishnet tiles covering the region of interest.
+
+        Parameters:
+        lazy_geometry (bool): If True, the fishnet is kept as a plain DataFrame of row/column/bounds arrays and the
+        shapely polygons are only built on request with materialize_geometry(). Clipping always requires geometry.
+        """
         # Initialize the fishnet parameters
         self.fishnet_width_degrees = self.xmax - self.xmin
         self.fishnet_height_degrees = self.ymax - self.ymin
@@ -102,33 +129,126 @@ class Fishnet:
             self.fishnet_height_degrees / self.tile_height_degrees
         )
 
-        # Create the fishnet polygons
-        fishnet_polys = []
-        for i in tqdm(range(self.fishnet_rows)):
-            for j in range(self.fishnet_cols):
-                # Calculate the coordinates of the fishnet cell corners
-                x_min = self.xmin + j * self.tile_width_degrees
-                x_max = x_min + self.tile_width_degrees
-                y_max = self.ymax - i * self.tile_height_degrees
-                y_min = y_max - self.tile_height_degrees
-                tile_geom = box(x_min, y_min, x_max, y_max)
-                fishnet_polys.append(tile_geom)
+        self.grid = ImplicitGrid(
+            self.xmin,
+            self.ymax,
+            self.tile_width_degrees,
+            self.tile_height_degrees,
+            self.fishnet_rows,
+            self.fishnet_cols,
+        )
 
-        # Create a GeoDataFrame from the fishnet polygons
-        print("Generating polygons...")
-        self.fishnet = gpd.GeoDataFrame(
-            {"id": range(len(fishnet_polys)), "geometry": fishnet_polys},
-            crs=self.crs,
+        # Calculate the coordinates of all fishnet cell corners at once
+        ids = np.arange(self.grid.n_tiles)
+        tile_row, tile_col = self.grid.id_to_row_col(ids)
+        bounds = self.grid.id_to_bounds(ids)
+        self.fishnet = pd.DataFrame(
+            {
+                "id": ids,
+                "row": tile_row,
+                "col": tile_col,
+                "minx": bounds[:, 0],
+                "miny": bounds[:, 1],
+                "maxx": bounds[:, 2],
+                "maxy": bounds[:, 3],
+            }
         )
+        self.lazy_geometry = True
 
         if self.clip:
             # Clip the fishnet to the Shapefile boundary
             print("Cliping fishinet to boundaries...")
-            self.fishnet = gpd.overlay(self.fishnet, self.tx, how=self.overlay_method)
+            self.clip_to_shapefile()
+        elif not lazy_geometry:
+            self.materialize_geometry()
 
         print("Success. Fishnet created.")
         self.fishnet_info()
 
+    def materialize_geometry(self):
+        """
+        Build the shapely polygons of a fishnet created with lazy_geometry=True in one bulk call, and replace the
+        row/column/bounds arrays by a GeoDataFrame geometry column. Does nothing if the geometry already exists.
+        """
+        if not self.lazy_geometry:
+            return
+
+        print("Generating polygons...")
+        self.fishnet = self._build_geometry(self.fishnet)
+        filtered_fishnet = getattr(self, "filtered_fishnet", None)
+        if filtered_fishnet is not None and "minx" in filtered_fishnet.columns:
+            self.filtered_fishnet = self._build_geometry(filtered_fishnet)
+        self.lazy_geometry = False
+
+    def _build_geometry(self, df):
+        geometry = shapely.box(
+            df["minx"].values, df["miny"].values, df["maxx"].values, df["maxy"].values
+        )
+        return gpd.GeoDataFrame(
+            df.drop(columns=LAZY_GEOMETRY_COLUMNS), geometry=geometry, crs=self.crs
+        )
+
+    def _add_lazy_geometry(self, df):
+        # Row/column/bounds arrays of the tiles of a table, rebuilt from their id
+        ids = df["id"].values
+        tile_row, tile_col = self.grid.id_to_row_col(ids)
+        bounds = self.grid.id_to_bounds(ids).reshape(-1, 4)
+        for name, values in zip(
+            LAZY_GEOMETRY_COLUMNS, [tile_row, tile_col] + list(bounds.T)
+        ):
+            df[name] = values
+        return df
+
+    def clip_to_shapefile(self):
+        """
+        Clip the fishnet tiles to the shapes of the shapefile, as gpd.overlay(fishnet, shapefile, how="intersection").
+
+        The tiles of each shape are classified with the grid as fully inside, boundary or outside the shape (see
+        ImplicitGrid.classify_geometry): outside tiles are dropped without building their polygon, inside tiles keep
+        their box, and only the boundary tiles are intersected exactly. Other overlay methods, and shapefiles whose
+        columns collide with the fishnet columns, fall back to gpd.overlay.
+        """
+        tiles = self.fishnet.drop(columns=LAZY_GEOMETRY_COLUMNS, errors="ignore")
+        shapes = self.tx.reset_index(drop=True)
+        attributes = shapes.drop(columns=shapes.geometry.name)
+        if self.overlay_method != "intersection" or set(attributes.columns) & set(
+            tiles.columns
+        ):
+            self.materialize_geometry()
+            self.fishnet = gpd.overlay(self.fishnet, self.tx, how=self.overlay_method)
+            return
+
+        tile_ids, shape_ids, geometries = [], [], []
+        for shape_id, shape in enumerate(shapes.geometry.values):
+            ids, inside = self.grid.classify_geometry(shape)
+            geometry = self.grid.tile_geometry(ids)
+            geometry[~inside] = shapely.intersection(geometry[~inside], shape)
+            tile_ids.append(ids)
+            shape_ids.append(np.full(len(ids), shape_id))
+            geometries.append(geometry)
+
+        tile_ids = np.concatenate(tile_ids)
+        shape_ids = np.concatenate(shape_ids)
+        geometry = _polygonal_parts(np.concatenate(geometries))
+
+        # Pairs sorted by tile then shape, the order in which gpd.overlay finds them (its output keeps that order
+        # with pandas >= 2.2), without the tiles merely touching a shape
+        order = np.lexsort((shape_ids, tile_ids))
+        order = order[~shapely.is_empty(geometry[order])]
+        tile_rows = np.searchsorted(tiles["id"].values, tile_ids[order])
+        self.fishnet = gpd.GeoDataFrame(
+            pd.concat(
+                [
+                    tiles.iloc[tile_rows].reset_index(drop=True),
+                    attributes.iloc[shape_ids[order]].reset_index(drop=True),
+                ],
+                axis=1,
+            ),
+            geometry=geometry[order],
+            crs=self.crs,
+        )
+        self.lazy_geometry = False
+
     def filter_fishnet_by_bbox(self, bbox):
         """
         Filter the fishnet to keep only the bounding boxes present within the larger bounding box.
@@ -139,27 +259,32 @@ class Fishnet:
         Returns:
         GeoDataFrame: A filtered GeoDataFrame containing only the bounding boxes within the larger bounding box.
         """
-        xmin, ymin, xmax, ymax = bbox
         self.filtered = True
-        bounding_box = Polygon([(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)])
         self.filter_region = bbox
-        self.filtered_fishnet = self.fishnet[self.fishnet.intersects(bounding_box)]
-        self.filtered_batches = self.batches[self.batches.intersects(bounding_box)]
 
-        # Create filtered_fishnet_cols and filtered_fishnet_rows
-
-        # compute the width of the filtered fishnet area
-        L = (
-            self.filtered_fishnet["geometry"].bounds["maxx"].max()
-            - self.filtered_fishnet["geometry"].bounds["minx"].min()
-        )
-        H = (
-            self.filtered_fishnet["geometry"].bounds["maxy"].max()
-            - self.filtered_fishnet["geometry"].bounds["miny"].min()
+        # The fishnet is a regular grid: the intersecting tiles and batches follow from index arithmetic
+        row_start, row_stop, col_start, col_stop = self.grid.bbox_to_row_col_range(bbox)
+        tile_ids = self.grid.bbox_to_ids(bbox)
+        batch_ids = self.grid.bbox_to_batch_ids(bbox)
+        self.filtered_fishnet = self.fishnet.iloc[self._tile_rows(tile_ids)]
+        self.filtered_batches = self.batches[self.batches["batch_id"].isin(batch_ids)]
+
+        self.filtered_fishnet_rows = row_stop - row_start
+        self.filtered_fishnet_cols = col_stop - col_start
+
+    def _tile_rows(self, tile_ids):
+        # Positions of the fishnet rows of the sorted tile ids, found by binary search instead of hashing every id
+        ids = self.fishnet["id"].values
+        sorter = None if np.all(ids[1:] >= ids[:-1]) else np.argsort(ids, kind="stable")
+        start = np.searchsorted(ids, tile_ids, side="left", sorter=sorter)
+        stop = np.searchsorted(ids, tile_ids, side="right", sorter=sorter)
+
+        # Clipped fishnets may hold several rows per tile, or none
+        counts = stop - start
+        rows = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
         )
-
-        self.filtered_fishnet_rows = int(H / self.tile_height_degrees)
-        self.filtered_fishnet_cols = int(L / self.tile_width_degrees)
+        return rows if sorter is None else np.sort(sorter[rows])
 
     # -------------------------------------------------------------------------- #
     #                              Batches                                       #
@@ -210,6 +335,11 @@ class Fishnet:
             self.fishnet_height_degrees / self.batch_height_degrees
         )
 
+        self.nbr_tiles_per_batch = self.batch_width_miles / self.tile_width_miles
+        self.grid.set_batches(
+            self.nbr_tiles_per_batch, self.batch_rows, self.batch_cols
+        )
+
         # Calculate batch_id for each tile in fishnet
         self.fishnet["batch_id"] = self._create_batches()
         self.fishnet["batch_id"] = self.fishnet["batch_id"].astype(int)
@@ -220,14 +350,7 @@ class Fishnet:
         self.batch_info()
 
     def _create_batches(self):
-        self.nbr_tiles_per_batch = self.batch_width_miles / self.tile_width_miles
-        tile_row, tile_col = np.divmod(
-            np.arange(self.fishnet_cols * self.fishnet_rows), self.fishnet_cols
-        )
-        batch_id = (tile_row // self.nbr_tiles_per_batch) * self.batch_cols + (
-            tile_col // self.nbr_tiles_per_batch
-        )
-        return batch_id.tolist()
+        return self.grid.id_to_batch_id(self.fishnet["id"].values)
 
     def _create_batch_geometries(self):
         min_xs = (
@@ -297,64 +420,44 @@ class Fishnet:
     # -------------------------------------------------------------------------- #
 
     def compute_neighbors(self):
-        self.neighbors = {}
-
-        # up-left, up, up-right, left, right, down-left, down, down-right
-        position_name = {
-            (-1, -1): "UL",
-            (-1, 0): "U",
-            (-1, 1): "UR",
-            (0, -1): "L",
-            (0, 1): "R",
-            (1, -1): "DL",
-            (1, 0): "D",
-            (1, 1): "DR",
-        }
-
-        for i in tqdm(
-            range(self.fishnet_cols),
-            total=self.fishnet_rows,
-            desc="Computing neighbors...",
-        ):
-            for j in range(self.fishnet_cols):
-                neighbor_indices = [
-                    (i + ii, j + jj)
-                    for ii in range(-1, 2)
-                    for jj in range(-1, 2)
-                    if (ii != 0 or jj != 0)
-                ]
-                neighbor_position = [
-                    position_name[(ii, jj)]
-                    for ii in range(-1, 2)
-                    for jj in range(-1, 2)
-                    if (ii != 0 or jj != 0)
-                ]
-                neighbor_indices = [
-                    (x, y)
-                    for x, y in neighbor_indices
-                    if x >= 0
-                    and x < self.fishnet_rows
-                    and y >= 0
-                    and y < self.fishnet_cols
-                ]
-                neighbor_ids = {
-                    key: self.row_col_to_id(x, y)
-                    for key, (x, y) in zip(neighbor_position, neighbor_indices)
-                }
-                self.neighbors[self.row_col_to_id(i, j)] = neighbor_ids
-
-        # add neighbors to fishnet
-        self.fishnet["neighbors"] = self.fishnet.apply(
-            lambda row: self.neighbors[row["id"]], axis=1
-        )
-        if self.filtered:
-            # add neighbors to filtered fishnet
-            self.filtered_fishnet["neighbors"] = self.filtered_fishnet.apply(
-                lambda row: self.neighbors[row["id"]], axis=1
-            )
+        """
+        Compute the 8 neighbors of every tile of the grid with index arithmetic.
 
+        The result is stored in self.neighbors, an (N, 8) int32 array indexed by tile id whose columns follow
+        NEIGHBOR_POSITIONS (UL, U, UR, L, R, DL, D, DR). Neighbors outside the grid are -1. When the fishnet is
+        clipped, a neighbor id may also refer to a tile that is not in the fishnet.
+        """
+        self.neighbors = self.grid.neighbor_table()
         print("All neighbors computed successfully.")
 
+    def compute_neighborhood_features(
+        self, feature, neighborhood, stats=("mean",), filtered=False
+    ):
+        """
+        Aggregate a fishnet column over a k-ring or radius neighborhood of every tile in one vectorized pass.
+
+        Parameters:
+        feature (str): The fishnet column to aggregate.
+        neighborhood (Neighborhood): The neighborhood to aggregate over, e.g. Neighborhood.k_ring(2).
+        stats (list): The statistics to compute, among NEIGHBORHOOD_STATS (mean, max, weighted_sum, ...).
+        filtered (bool): Whether to compute the features on the filtered fishnet.
+
+        Each statistic is stored in a new column named "{feature}_{neighborhood.name}_{stat}".
+        """
+        if filtered:
+            df = self.filtered_fishnet
+        else:
+            df = self.fishnet
+
+        if feature not in df.columns:
+            raise ValueError("The feature is not available in the Fishnet object.")
+
+        results = neighborhood.aggregate(
+            self.grid, df["id"].values.astype(int), df[feature].values, stats
+        )
+        for stat, values in results.items():
+            df[f"{feature}_{neighborhood.name}_{stat}"] = values
+
     # -------------------------------------------------------------------------- #
     #                               Plots                                        #
     # -------------------------------------------------------------------------- #
@@ -462,8 +565,9 @@ class Fishnet:
         mean_y = (row["geometry"].bounds["miny"] + row["geometry"].bounds["maxy"]) / 2
 
         # find all neighbors
+        neighbor_ids = self.neighbors[id]
         neighbors = self.fishnet[
-            self.fishnet["id"].isin(list(list(row["neighbors"])[0].values()))
+            self.fishnet["id"].isin(neighbor_ids[neighbor_ids >= 0])
         ]
 
         # create empty map
@@ -581,28 +685,98 @@ class Fishnet:
         self.fishnet_info()
         self.batch_info()
 
-    def save(self, file_path):
+    def save(self, file_path, format="binary"):
         """
-        Save the Fishnet object to a file using pickle.
+        Save the Fishnet object.
+
+        The binary format is a folder holding the grid parameters and the tile attributes as memory-mappable NumPy
+        arrays, one per column (see FishnetStore.write_fishnet). Tile polygons, batch geometries and the shapefile
+        are not stored but rebuilt on load, so opening a saved fishnet does not depend on the pickling of shapely
+        and geopandas objects.
 
         Parameters:
-        file_path (str): The file path to save the Fishnet object.
+        file_path (str): The folder (binary format) or file (pickle format) to save the Fishnet object to.
+        format (str): "binary", or "pickle" to pickle the whole object as in previous versions.
         """
-        with open(file_path, "wb") as file:
-            pickle.dump(self, file)
+        if format == "pickle":
+            with open(file_path, "wb") as file:
+                pickle.dump(self, file)
+        elif format == "binary":
+            write_fishnet(self, file_path, derived_columns=LAZY_GEOMETRY_COLUMNS)
+        else:
+            raise ValueError("format must be 'binary' or 'pickle'.")
 
-    def load(file_path):
+    def load(file_path, batch_ids=None, lazy_geometry=True):
         """
-        Load a Fishnet object from a file using pickle.
+        Load a saved Fishnet object.
+
+        Only the tiles of the requested batches are read, and regular tile polygons are not built until
+        materialize_geometry() is called (or lazy_geometry=False), so opening a large fishnet is near-instant. Pickle
+        files written by previous versions are loaded whole.
 
         Parameters:
-        file_path (str): The file path of the saved Fishnet object.
+        file_path (str): The folder or pickle file of the saved Fishnet object.
+        batch_ids (iterable): Ids of the batches whose tiles are loaded, e.g. range(100, 200). None for every tile.
+        lazy_geometry (bool): Whether to keep the regular tiles as row/column/bounds arrays, as with
+        create_fishnet(lazy_geometry=True).
 
         Returns:
         Fishnet: The loaded Fishnet object.
         """
-        with open(file_path, "rb") as file:
-            return pickle.load(file)
+        if not os.path.isdir(file_path):
+            with open(file_path, "rb") as file:
+                return pickle.load(file)
+
+        fishnet = Fishnet.__new__(Fishnet)
+        geometry = read_fishnet(fishnet, file_path, batch_ids)
+        fishnet.grid = ImplicitGrid(
+            fishnet.xmin,
+            fishnet.ymax,
+            fishnet.tile_width_degrees,
+            fishnet.tile_height_degrees,
+            fishnet.fishnet_rows,
+            fishnet.fishnet_cols,
+        )
+        if hasattr(fishnet, "batch_tile_size"):
+            fishnet.grid.set_batches(
+                fishnet.nbr_tiles_per_batch, fishnet.batch_rows, fishnet.batch_cols
+            )
+            fishnet.batches = fishnet._create_batch_geometries()
+            if batch_ids is not None:
+                fishnet.batches = fishnet.batches[
+                    fishnet.batches["batch_id"].isin(list(batch_ids))
+                ]
+        if fishnet.filtered:
+            fishnet.filtered_batches = fishnet.batches[
+                fishnet.batches["batch_id"].isin(
+                    fishnet.grid.bbox_to_batch_ids(fishnet.filter_region)
+                )
+            ]
+
+        for name, storage in geometry.items():
+            if storage == "grid":
+                setattr(
+                    fishnet, name, fishnet._add_lazy_geometry(getattr(fishnet, name))
+                )
+            else:
+                setattr(
+                    fishnet,
+                    name,
+                    gpd.GeoDataFrame(getattr(fishnet, name), crs=fishnet.crs),
+                )
+        fishnet.lazy_geometry = geometry.get("fishnet") == "grid"
+        if not lazy_geometry:
+            fishnet.materialize_geometry()
+        return fishnet
+
+    def __getattr__(self, name):
+        # The shapefile of a loaded fishnet is only read when it is first used, e.g. by the plots
+        if name == "tx" and self.__dict__.get("shapefile"):
+            self.tx = gpd.read_file(self.shapefile_path)
+            return self.tx
+        raise AttributeError(
+            f"'{type(self).__name__}' object has no attribute '{name}'"
+        )
 
     def compute_difference(self, feature1, feature2, filtered=False, normalize=False):
         if filtered:
@@ -620,7 +794,7 @@ class Fishnet:
                 df[feature1 + "-" + feature2] = df[feature1 + "-" + feature2] / 255
 
     def row_col_to_id(self, i, j):
-        return i * self.fishnet_cols + j
+        return self.grid.row_col_to_id(i, j)
 
     # -------------------------------------------------------------------------- #
     #                          Harvesine Formula                                 #
@@ -0,0 +1,230 @@
+import os
+import json
+import pickle
+import shutil
+import numpy as np
+import pandas as pd
+import shapely
+
+# File of the store holding the scalar attributes of the fishnet and the description of its tables
+METADATA_FILE = "fishnet.json"
+
+# Attributes stored as tables or rebuilt on load instead of being written to METADATA_FILE
+TABLE_ATTRIBUTES = ["fishnet", "filtered_fishnet"]
+REBUILT_ATTRIBUTES = ["grid", "batches", "filtered_batches", "tx", "neighbors"]
+
+
+def _json_value(value):
+    # JSON version of a scalar attribute, or None if the attribute cannot be stored as JSON
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, (list, tuple, np.ndarray)):
+        values = [_json_value(item) for item in value]
+        return None if any(item is None for item in values) else values
+    if hasattr(value, "to_wkt"):
+        # pyproj CRS
+        return value.to_wkt()
+    return None
+
+
+# -------------------------------------------------------------------------- #
+#                                 Tables                                     #
+# -------------------------------------------------------------------------- #
+
+
+def _write_table(df, folder, grid, batched, derived_columns):
+    """
+    Write a fishnet table as one .npy file per column, so each column can be memory-mapped on its own.
+
+    Numeric, boolean and datetime columns keep their NumPy dtype, and columns of strings are stored as NumPy
+    strings. Any other column (mixed objects, missing values, pandas extension dtypes) is pickled as a whole, so it
+    is restored exactly but read in full. The shapely geometry and the derived_columns are not stored when every
+    tile is the grid tile of its id (regular tiles), and the geometry is stored as WKB otherwise (clipped tiles).
+    Batched tables also store the rows sorted by batch_id and the offset of each batch in that order, so the rows of
+    a subset of batches are found without reading the batch_id column.
+    """
+    os.makedirs(folder)
+    geometry = "geometry" in df.columns
+    if geometry:
+        # Regular tiles are rebuilt from their id, clipped tiles are stored as WKB
+        tiles = grid.tile_geometry(df["id"].values.astype(np.int64))
+        geometry = not np.all(shapely.equals_exact(tiles, df["geometry"].values, 0))
+
+    columns = []
+    for i, (name, values) in enumerate(df.items()):
+        if name == "geometry" or (not geometry and name in derived_columns):
+            continue
+        values = values.values
+        if isinstance(values, np.ndarray) and values.dtype.kind == "O":
+            if all(isinstance(value, str) for value in values):
+                values = values.astype(str)
+        if isinstance(values, np.ndarray) and values.dtype.kind in "biufcMU":
+            np.save(os.path.join(folder, f"column_{i}.npy"), values)
+            columns.append({"name": name, "file": f"column_{i}.npy"})
+        else:
+            with open(os.path.join(folder, f"column_{i}.pkl"), "wb") as f:
+                pickle.dump(values, f, protocol=pickle.HIGHEST_PROTOCOL)
+            columns.append({"name": name, "file": f"column_{i}.pkl"})
+    np.save(os.path.join(folder, "index.npy"), df.index.values)
+
+    if geometry:
+        wkb = shapely.to_wkb(df["geometry"].values)
+        lengths = np.array([len(item) for item in wkb], dtype=np.int64)
+        np.save(
+            os.path.join(folder, "geometry_offsets.npy"),
+            np.concatenate([[0], np.cumsum(lengths)]),
+        )
+        np.save(
+            os.path.join(folder, "geometry.npy"),
+            np.frombuffer(b"".join(wkb), dtype=np.uint8),
+        )
+
+    if batched:
+        batch_ids = df["batch_id"].values
+        order = np.argsort(batch_ids, kind="stable")
+        np.save(os.path.join(folder, "batch_order.npy"), order)
+        np.save(
+            os.path.join(folder, "batch_offsets.npy"),
+            np.searchsorted(
+                batch_ids[order],
+                np.arange(batch_ids.max() + 2 if len(batch_ids) else 1),
+            ),
+        )
+
+    return {
+        "columns": columns,
+        "rows": len(df),
+        "geometry": "wkb" if geometry else "grid",
+        "batched": batched,
+    }
+
+
+def _table_rows(folder, table, batch_ids):
+    # Positions of the rows of the requested batches, in table order
+    if batch_ids is None:
+        return None
+    if not table["batched"]:
+        raise ValueError(
+            "The fishnet was saved before being batched: batches cannot be selected."
+        )
+    order = np.load(os.path.join(folder, "batch_order.npy"), mmap_mode="r")
+    offsets = np.load(os.path.join(folder, "batch_offsets.npy"))
+    batch_ids = np.asarray(list(batch_ids), dtype=np.int64)
+    batch_ids = batch_ids[(batch_ids >= 0) & (batch_ids < len(offsets) - 1)]
+    rows = [order[offsets[b] : offsets[b + 1]] for b in np.unique(batch_ids)]
+    return np.sort(np.concatenate(rows)) if rows else np.empty(0, dtype=np.int64)
+
+
+def _read_table(folder, table, rows):
+    def read(file):
+        if file.endswith(".pkl"):
+            with open(os.path.join(folder, file), "rb") as f:
+                values = pickle.load(f)
+            return values if rows is None else values[rows]
+        values = np.load(os.path.join(folder, file), mmap_mode="r")
+        return np.array(values if rows is None else values[rows])
+
+    data = {column["name"]: read(column["file"]) for column in table["columns"]}
+    df = pd.DataFrame(data, index=read("index.npy"))
+
+    if table["geometry"] == "wkb":
+        offsets = np.load(os.path.join(folder, "geometry_offsets.npy"))
+        blob = np.load(os.path.join(folder, "geometry.npy"), mmap_mode="r")
+        positions = np.arange(table["rows"]) if rows is None else rows
+        df["geometry"] = shapely.from_wkb(
+            [blob[offsets[i] : offsets[i + 1]].tobytes() for i in positions]
+        )
+    return df
+
+
+# -------------------------------------------------------------------------- #
+#                                 Store                                      #
+# -------------------------------------------------------------------------- #
+
+
+def write_fishnet(fishnet, path, derived_columns=()):
+    """
+    Write a Fishnet as a folder of memory-mappable arrays.
+
+    The grid parameters and scalar attributes are stored in METADATA_FILE, and the fishnet and filtered fishnet
+    tables column by column (see _write_table). The tile polygons, the batch geometries, the grid and the shapefile
+    are not stored: they are rebuilt from the grid parameters and the shapefile path when needed. The neighbor
+    table is stored as a single (N, 8) array.
+
+    Parameters:
+    fishnet (Fishnet): The fishnet to save.
+    path (str): Folder of the store, replaced if it exists.
+    derived_columns (list): Columns of regular tiles that can be rebuilt from their id, and are therefore not stored.
+    """
+    temporary_path = f"{path.rstrip(os.sep)}.{os.getpid()}.tmp"
+    if os.path.exists(temporary_path):
+        shutil.rmtree(temporary_path)
+    os.makedirs(temporary_path)
+
+    attributes = {}
+    for name, value in fishnet.__dict__.items():
+        if name in TABLE_ATTRIBUTES + REBUILT_ATTRIBUTES:
+            continue
+        value = _json_value(value)
+        if value is not None:
+            attributes[name] = value
+
+    batched = hasattr(fishnet, "batch_tile_size")
+    tables = {}
+    for name in TABLE_ATTRIBUTES:
+        if getattr(fishnet, name, None) is not None:
+            tables[name] = _write_table(
+                getattr(fishnet, name),
+                os.path.join(temporary_path, name),
+                fishnet.grid,
+                batched,
+                derived_columns,
+            )
+
+    if getattr(fishnet, "neighbors", None) is not None:
+        np.save(os.path.join(temporary_path, "neighbors.npy"), fishnet.neighbors)
+
+    metadata = {"attributes": attributes, "tables": tables}
+    with open(os.path.join(temporary_path, METADATA_FILE), "w") as f:
+        json.dump(metadata, f)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.replace(temporary_path, path)
+
+
+def read_fishnet(fishnet, path, batch_ids=None):
+    """
+    Restore the attributes and tables of a Fishnet written by write_fishnet into an empty Fishnet object.
+
+    Only the rows of the requested batches are read from the columns, which are memory-mapped. The tables of
+    regular tiles are returned without their polygons and derived columns, the neighbor table is memory-mapped
+    read-only, and the grid and batch geometries are left to the caller.
+
+    Parameters:
+    fishnet (Fishnet): The object to fill, e.g. Fishnet.__new__(Fishnet).
+    path (str): Folder of the store.
+    batch_ids (iterable): Ids of the batches to load, e.g. range(10, 20). None to load every tile.
+
+    Returns:
+    dict: How the geometry of each table is stored: "grid" for regular tiles to rebuild from their id, "wkb" for
+    clipped tiles, whose geometry column has been read.
+    """
+    with open(os.path.join(path, METADATA_FILE)) as f:
+        metadata = json.load(f)
+
+    for name, value in metadata["attributes"].items():
+        setattr(fishnet, name, tuple(value) if isinstance(value, list) else value)
+
+    for name, table in metadata["tables"].items():
+        folder = os.path.join(path, name)
+        rows = _table_rows(folder, table, batch_ids)
+        setattr(fishnet, name, _read_table(folder, table, rows))
+
+    neighbors_path = os.path.join(path, "neighbors.npy")
+    if os.path.exists(neighbors_path):
+        fishnet.neighbors = np.load(neighbors_path, mmap_mode="r")
+
+    return {name: table["geometry"] for name, table in metadata["tables"].items()}
@@ -1,15 +1,51 @@
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image
 import numpy as np
 from prettytable import PrettyTable
 from tqdm import tqdm
 import sys
 from matplotlib import pyplot as plt
+from DynamicWorld import BUILT, N_LABELS, NO_DATA, SNOW, color_to_class, to_class_raster
+from RasterReader import read_image, write_class_raster
+
+# File of the base folder caching the class histogram of every image, keyed by modification time and size
+STATISTICS_CACHE = "pixel_statistics.json"
+
+# Extra histogram bin counting the pixels of "visualize" images whose color is neither black nor a class color, so
+# the NO_DATA bin only counts black pixels
+OTHER_COLORS = N_LABELS
+N_BINS = N_LABELS + 1
 
 
 class ImageCorrector:
-    def __init__(self, base_path, verbose=True):
+    def __init__(
+        self,
+        base_path,
+        verbose=True,
+        class_index=False,
+        packed=False,
+        n_jobs=1,
+        cache=None,
+    ):
+        """
+        Parameters:
+        base_path (str): Folder holding one sub-folder per year, each with Summer and Year images.
+        verbose (bool): Whether to print the pixel summaries.
+        class_index (bool): Whether to write the Final images as single-band class-index rasters, converting
+        "visualize" RGB inputs. Class-index inputs always give class-index outputs.
+        packed (bool): Whether to store the class-index Final images with 4-bit packed labels (implies class_index).
+        n_jobs (int): Number of processes computing the pixel statistics of the summaries and correcting the images
+        in correct_images (None for all the cores).
+        cache (ResultCache): Optional cache recording the Final images produced from each chain of inputs, so that
+        correct_images skips the batch files whose inputs and Final images are unchanged.
+        """
         self.base_path = base_path
+        self.class_index = class_index or packed
+        self.packed = packed
+        self.n_jobs = n_jobs
+        self.cache = cache
         self.years = sorted(self.list_folders())
         self.verbose = verbose
         if self.verbose:
@@ -28,34 +64,29 @@ class ImageCorrector:
             "Year Snow Pixel %",
         ]
 
-        # populate the table
-        for year in tqdm(self.years, desc="Loading images...", file=sys.stdout):
-            summer_path = os.path.join(self.base_path, year, "Summer")
-            year_path = os.path.join(self.base_path, year, "Year")
-
-            summer_black_pixel_proportion = self.compute_color_pixels_proportion(
-                summer_path, color=[0, 0, 0]
-            )
-            year_black_pixel_proportion = self.compute_color_pixels_proportion(
-                year_path, color=[0, 0, 0]
-            )
+        # Class histograms of every Summer and Year folder, reading each image at most once
+        histograms = self.folder_histograms(
+            [
+                os.path.join(self.base_path, year, folder)
+                for year in self.years
+                for folder in ["Summer", "Year"]
+            ]
+        )
 
-            summer_snow_pixel_proportion = self.compute_color_pixels_proportion(
-                summer_path, color=[179, 159, 225]
-            )
-            year_snow_pixel_proportion = self.compute_color_pixels_proportion(
-                year_path, color=[179, 159, 225]
-            )
+        # populate the table
+        for year in self.years:
+            summer = histograms[os.path.join(self.base_path, year, "Summer")]
+            year_ = histograms[os.path.join(self.base_path, year, "Year")]
 
             table.add_row(
                 [
                     year,
-                    self.count_images(summer_path),
-                    self.count_images(year_path),
-                    "{:.4%}".format(summer_black_pixel_proportion),
-                    "{:.4%}".format(year_black_pixel_proportion),
-                    "{:.4%}".format(summer_snow_pixel_proportion),
-                    "{:.4%}".format(year_snow_pixel_proportion),
+                    self.count_images(os.path.join(self.base_path, year, "Summer")),
+                    self.count_images(os.path.join(self.base_path, year, "Year")),
+                    "{:.4%}".format(self.class_proportion(summer, NO_DATA)),
+                    "{:.4%}".format(self.class_proportion(year_, NO_DATA)),
+                    "{:.4%}".format(self.class_proportion(summer, SNOW)),
+                    "{:.4%}".format(self.class_proportion(year_, SNOW)),
                 ]
             )
 
@@ -73,23 +104,21 @@ class ImageCorrector:
             "Final Snow Pixel %",
         ]
 
+        histograms = self.folder_histograms(
+            [os.path.join(self.base_path, year, "Final") for year in self.years]
+        )
+
         # populate the table
-        for year in tqdm(self.years, desc="Loading images...", file=sys.stdout):
+        for year in self.years:
             final_path = os.path.join(self.base_path, year, "Final")
-            final_black_pixel_proportion = self.compute_color_pixels_proportion(
-                final_path, color=[0, 0, 0]
-            )
-
-            final_snow_pixel_proportion = self.compute_color_pixels_proportion(
-                final_path, color=[179, 159, 225]
-            )
+            final = histograms[final_path]
 
             table.add_row(
                 [
                     year,
                     self.count_images(final_path),
-                    "{:.4%}".format(final_black_pixel_proportion),
-                    "{:.4%}".format(final_snow_pixel_proportion),
+                    "{:.4%}".format(self.class_proportion(final, NO_DATA)),
+                    "{:.4%}".format(self.class_proportion(final, SNOW)),
                 ]
             )
 
@@ -97,6 +126,90 @@ class ImageCorrector:
         table.sortby = "Year"
         print(table)
 
+    # -------------------------------------------------------------------------- #
+    #                            Pixel statistics                                #
+    # -------------------------------------------------------------------------- #
+
+    def folder_histograms(self, folders):
+        """
+        Class histogram of all the images of each folder.
+
+        Every image is read once to count the pixels of all the classes at once, in a pool of self.n_jobs
+        processes. The histograms are cached per file in STATISTICS_CACHE, keyed by modification time and size, so
+        only new or modified images are read again.
+
+        Returns:
+        dict: Maps each folder to the (N_BINS,) array of the pixel counts of its images.
+        """
+        cache_path = os.path.join(self.base_path, STATISTICS_CACHE)
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                try:
+                    cache = json.load(f)
+                except ValueError:
+                    # Cache truncated by a run older than the atomic writes: every image is read again
+                    cache = {}
+
+        files = {
+            folder: [os.path.join(folder, file) for file in self.list_files(folder)]
+            for folder in folders
+        }
+        signatures = {}
+        missing = []
+        for path in (path for paths in files.values() for path in paths):
+            stat = os.stat(path)
+            key = os.path.relpath(path, self.base_path)
+            signatures[key] = [stat.st_mtime_ns, stat.st_size]
+            if (
+                key not in cache
+                or cache[key]["signature"] != signatures[key]
+                or len(cache[key]["histogram"]) != N_BINS
+            ):
+                missing.append(path)
+
+        progress = dict(
+            total=len(missing),
+            desc="Loading images...",
+            file=sys.stdout,
+            disable=not missing,
+        )
+        if self.n_jobs == 1:
+            results = [image_histogram(path) for path in tqdm(missing, **progress)]
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                results = list(
+                    tqdm(
+                        executor.map(image_histogram, missing, chunksize=8), **progress
+                    )
+                )
+
+        if missing:
+            for path, histogram in zip(missing, results):
+                key = os.path.relpath(path, self.base_path)
+                cache[key] = {
+                    "signature": signatures[key],
+                    "histogram": histogram.tolist(),
+                }
+            # Written to a temporary file first, so an interrupted or concurrent run never leaves a truncated cache
+            temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(temporary_path, cache_path)
+
+        histograms = {}
+        for folder, paths in files.items():
+            histograms[folder] = np.zeros(N_BINS, dtype=np.int64)
+            for path in paths:
+                histograms[folder] += cache[os.path.relpath(path, self.base_path)][
+                    "histogram"
+                ]
+        return histograms
+
+    def class_proportion(self, histogram, label):
+        total = histogram.sum()
+        return histogram[label] / total if total > 0 else 0
+
     def list_folders(self):
         return [
             entry
@@ -121,61 +234,188 @@ class ImageCorrector:
         ]
 
     def read_image(self, path):
-        img = Image.open(path)
-        data = np.asarray(img, dtype="int32")
-        return data
+        # uint8 view of the image, memory-mapped when the GeoTIFF is uncompressed
+        return read_image(path)
 
     def save_image(self, path, img):
+        if img.ndim == 2:
+            write_class_raster(path, img, packed=self.packed)
+            return
+
         # save the image with PIL
         im = Image.fromarray(img.astype("uint8"))
         im.save(path)
 
-    def correct_images(self):
+    def correct_images(self, incremental=False):
+        """
+        Impute the missing (black) pixels of the Summer images with the Year images, prevent deurbanization with
+        the previous year's Final image, and write the Final images.
+
+        The only dependency between images is along the year axis of each batch file, so every batch file is
+        corrected by one chain running through all the years, which keeps the previous Final image in memory
+        instead of reading it back from disk. The chains of different batch files run in a pool of self.n_jobs
+        processes.
+
+        With incremental=True, each chain starts at its first year whose Final image is missing or older than its
+        inputs (or than the previous year's Final image), so adding a new year only corrects that year.
+        """
         print("Imputing Summer missing pixels with Year data. Processing images...")
+        chains = {}
         for year in self.years:  # years is a string"
             self.set_final_path(year)
             # Input paths
             summer_path = os.path.join(self.base_path, str(year), "Summer")
             year_path = os.path.join(self.base_path, str(year), "Year")
 
-            # Output paths
-            if not os.path.exists(os.path.join(self.base_path, str(year), "Final")):
-                os.makedirs(os.path.join(self.base_path, str(year), "Final"))
-            output_path = os.path.join(self.base_path, str(year), "Final")
-
             summer_files = sorted(self.list_files(summer_path))
             year_files = sorted(self.list_files(year_path))
 
-            for summer_file, year_file in tqdm(
-                zip(summer_files, year_files),
-                desc=f"Correcting images for year {year}",
-                file=sys.stdout,
-                total=len(summer_files),
+            for summer_file, year_file in zip(summer_files, year_files):
+                chains.setdefault(summer_file, []).append(
+                    (
+                        year,
+                        os.path.join(summer_path, summer_file),
+                        os.path.join(year_path, year_file),
+                    )
+                )
+
+        if incremental:
+            chains = {
+                summer_file: chain[self.first_stale_year(summer_file, chain) :]
+                for summer_file, chain in chains.items()
+            }
+            chains = {
+                summer_file: chain for summer_file, chain in chains.items() if chain
+            }
+
+        keys = {}
+        if self.cache is not None:
+            for summer_file, chain in list(chains.items()):
+                keys[summer_file] = self.chain_key(summer_file, chain)
+                finals = self.cache.get(keys[summer_file])
+                if finals is not None and finals == self.final_digests(
+                    summer_file, chain
+                ):
+                    del chains[summer_file]
+            print(f"{len(keys) - len(chains)} of {len(keys)} batch files cached.")
+
+        if self.n_jobs == 1:
+            for summer_file, chain in tqdm(
+                chains.items(), desc="Correcting images", file=sys.stdout
             ):
-                summer_img = self.read_image(os.path.join(summer_path, summer_file))
-                year_img = self.read_image(os.path.join(year_path, year_file))
+                self.correct_chain(summer_file, chain)
+        else:
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                futures = [
+                    executor.submit(self.correct_chain, summer_file, chain)
+                    for summer_file, chain in chains.items()
+                ]
+                for future in tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    desc="Correcting images",
+                    file=sys.stdout,
+                ):
+                    future.result()
+
+        if self.cache is not None:
+            for summer_file, chain in chains.items():
+                self.cache.put(
+                    keys[summer_file], self.final_digests(summer_file, chain)
+                )
+            self.cache.flush()
 
-                if summer_img is None or year_img is None:
-                    raise Exception("Error reading image.")
+        if self.verbose:
+            self.summary_final()
+
+    def chain_key(self, summer_file, chain):
+        # Cache key of a chain: digests of all its inputs, including the Final image it starts from, and the options
+        year = chain[0][0]
+        previous_path = os.path.join(
+            self.base_path, str(int(year) - 1), "Final", summer_file
+        )
+        previous = None
+        if int(year) > int(self.years[0]) and os.path.exists(previous_path):
+            previous = self.cache.file_digest(previous_path)
+        return self.cache.key(
+            "correct_chain",
+            self.class_index,
+            self.packed,
+            previous,
+            [
+                (year, self.cache.file_digest(summer), self.cache.file_digest(year_))
+                for year, summer, year_ in chain
+            ],
+        )
+
+    def first_stale_year(self, summer_file, chain):
+        # Index in the chain of the first year whose Final image is missing or older than one of its inputs
+        previous_mtime = 0
+        for i, (year, summer, year_) in enumerate(chain):
+            final_path = os.path.join(self.base_path, str(year), "Final", summer_file)
+            if not os.path.exists(final_path):
+                return i
+            final_mtime = os.stat(final_path).st_mtime_ns
+            inputs_mtime = max(
+                os.stat(summer).st_mtime_ns, os.stat(year_).st_mtime_ns, previous_mtime
+            )
+            if final_mtime < inputs_mtime:
+                return i
+            previous_mtime = final_mtime
+        return len(chain)
+
+    def final_digests(self, summer_file, chain):
+        # Digests of the Final images of a chain, None if one of them is missing
+        paths = [
+            os.path.join(self.base_path, str(year), "Final", summer_file)
+            for year, _, _ in chain
+        ]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return [self.cache.file_digest(path) for path in paths]
+
+    def correct_chain(self, summer_file, chain):
+        """
+        Correct one batch file through all its years, in chronological order.
+
+        Parameters:
+        summer_file (str): Name of the batch file, also the name of its Final images.
+        chain (list): (year, summer image path, year image path) tuples, sorted by year.
+        """
+        previous_year, previous_img = None, None
+        for year, summer_image_path, year_image_path in chain:
+            summer_img = self.read_image(summer_image_path)
+            year_img = self.read_image(year_image_path)
+
+            if summer_img is None or year_img is None:
+                raise Exception("Error reading image.")
 
-                if summer_img.shape != year_img.shape:
-                    raise Exception("Images have different dimensions.")
+            if summer_img.shape != year_img.shape:
+                raise Exception("Images have different dimensions.")
 
+            if self.class_index or summer_img.ndim == 2:
+                summer_img = to_class_raster(summer_img)
+                year_img = to_class_raster(year_img)
+                result_img = np.where(summer_img != NO_DATA, summer_img, year_img)
+            else:
                 result_img = np.where(summer_img != [0, 0, 0], summer_img, year_img)
 
-                if int(year) > 2016:
+            if int(year) > int(self.years[0]):
+                if previous_year is None or int(previous_year) != int(year) - 1:
+                    # Previous year not corrected in this run: read its Final image back
                     previous_img = self.read_image(
                         os.path.join(
                             self.base_path, str(int(year) - 1), "Final", summer_file
                         )
                     )
-                    result_img = self.discard_deurbanization(previous_img, result_img)
-
-                # Save locally
-                self.save_image(os.path.join(output_path, summer_file), result_img)
+                result_img = self.discard_deurbanization(previous_img, result_img)
 
-        if self.verbose:
-            self.summary_final()
+            # Save locally
+            self.save_image(
+                os.path.join(self.base_path, str(year), "Final", summer_file),
+                result_img,
+            )
+            previous_year, previous_img = year, result_img
 
     def set_final_path(self, year):
         final_path = os.path.join(self.base_path, year, "Final")
@@ -186,9 +426,16 @@ class ImageCorrector:
 
     def discard_deurbanization(self, previous_img, result_img):
         # avoid deurbanization in the data
+        if result_img.ndim == 2:
+            previous_img = to_class_raster(previous_img)
+            return np.where(previous_img == BUILT, previous_img, result_img)
         return np.where(previous_img != [196, 40, 27], result_img, previous_img)
 
     def extract_label(self, image, color):
+        if image.ndim == 2:
+            # Class-index raster: a single compare against the class of the color
+            return np.where(image == color_to_class(color), 255, 0).astype(np.uint8)
+
         red_pixels = np.all(
             [
                 image[:, :, 0] == color[0],  # Red channel
@@ -205,22 +452,30 @@ class ImageCorrector:
         ]  # Extracted image is black & white
         return extracted_image
 
-    # @TO_OPTIMIZE
     def compute_color_pixels_proportion(self, path, color=[0, 0, 0]):
-        total_pixels = 0
-        color_pixels = 0
-
-        files = self.list_files(path)
-
-        for file in files:
-            img = self.read_image(os.path.join(path, file))
-
-            if img is None:
-                print(file)
-                raise Exception("Error reading image.")
-
-            total_pixels += np.size(img)
-            color_pixels += np.sum(img == color)
-
-        proportion = color_pixels / total_pixels if total_pixels > 0 else 0
-        return proportion
+        """
+        Proportion of the pixels of the images in path having the given color (black or a Dynamic World color).
+        """
+        label = color_to_class(color)
+        if label == NO_DATA and np.any(np.asarray(color) != 0):
+            raise ValueError(
+                f"Color {list(color)} is neither black nor a Dynamic World color."
+            )
+        histogram = self.folder_histograms([path])[path]
+        return self.class_proportion(histogram, label)
+
+
+def image_histogram(path):
+    """
+    Number of pixels of each class in an image, followed by the number of NO_DATA (black) pixels and the number of
+    pixels of other colors (OTHER_COLORS).
+    """
+    img = read_image(path)
+    if img is None:
+        print(path)
+        raise Exception("Error reading image.")
+    class_raster = to_class_raster(img)
+    if img.ndim == 3:
+        other = (class_raster == NO_DATA) & np.any(img[..., :3] != 0, axis=-1)
+        class_raster = np.where(other, OTHER_COLORS, class_raster)
+    return np.bincount(class_raster.ravel(), minlength=N_BINS)
@@ -1,12 +1,24 @@
 import ee
 from tqdm import tqdm
 import GeemapUtils as geemap
+from DynamicWorld import NO_DATA
 
 ee.Initialize()
 
 
 class ImageExporter:
-    def __init__(self, fishnet, filtered, scale=10):
+    def __init__(self, fishnet, filtered, scale=10, return_type="visualize"):
+        """
+        Parameters:
+        fishnet (Fishnet): The fishnet whose batches are exported.
+        filtered (bool): Whether to export the batches of the filtered fishnet only.
+        scale (int): Resolution in meters.
+        return_type (str): "visualize" to export the RGB rendering of the classes, or "class" to export single-band
+        uint8 class-index rasters (NO_DATA where Dynamic World has no observation), 3 times smaller.
+        """
+        if return_type not in ["class", "visualize"]:
+            raise ValueError("return_type must be 'class' or 'visualize'.")
+        self.return_type = return_type
         self.fh = fishnet
         self.scale = scale
         self.fileFormat = "GeoTIFF"
@@ -37,8 +49,11 @@ class ImageExporter:
             batch_region = ee.Geometry.Rectangle(batch["geometry"].bounds)
 
             landcover = geemap.dynamic_world(
-                batch_region, self.startDate, self.endDate, return_type="visualize"
+                batch_region, self.startDate, self.endDate, return_type=self.return_type
             )
+            if self.return_type == "class":
+                # Masked pixels would otherwise be exported as 0, i.e. water
+                landcover = landcover.unmask(NO_DATA).toUint8()
 
             # Save the image
             export_params = {
@@ -1,18 +1,46 @@
 import os
+import json
+import warnings
 import numpy as np
+import pandas as pd
+import shapely
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from tqdm.auto import tqdm
 import imageio
 from scipy.stats import entropy
+from DynamicWorld import color_to_class, to_class_raster
+from ProcessedData import processed_data_years, write_processed_data
+from RasterReader import image_shape, read_image, read_windows
+from TileCube import crop_tiles, write_chunk, write_index
+from TileStatistics import (
+    IntegralHistogram,
+    compute_statistics,
+    integral_image,
+    scale_windows,
+    tile_histograms,
+    window_sums,
+)
 
 tqdm.pandas()
 
+# Columns holding the (xmin, ymin, xmax, ymax) pixel window of each tile in its batch image
+IMAGE_COORDINATES = ["ImageXmin", "ImageYmin", "ImageXmax", "ImageYmax"]
+
 
 class ImageProcessor:
     def __init__(
         self,
         fishnet,
         filtered=False,
+        cache=None,
+        state_file=None,
     ):
+        # Optional ResultCache of the per-batch pixel windows and tile statistics
+        self.cache = cache
+        # Optional JSON file keeping the signatures of the images behind the yearly columns across runs (see
+        # process_years). It belongs with the saved fishnet whose columns it describes.
+        self.state_file = state_file
+        self._processed_inputs = None
         self.filtered = filtered
         self.fh = fishnet
 
@@ -23,128 +51,400 @@ class ImageProcessor:
             self.fishnet = self.fh.fishnet
             self.batch_ids = self.fh.batches.index
 
-    def assign_fishnet_tiles_to_pixels(self, image_folder, file_name):
-        self.fishnet["ImageCoordinates"] = np.nan
-        for batch_id in tqdm(list(self.batch_ids), desc="Processing Images"):
-            image_path = os.path.join(image_folder, f"{file_name}_{batch_id}.tif")
-            image = imageio.imread(image_path)
-            if image is None:
-                raise Exception("Error reading image.")
-
-            # Extract image dimensions
-            self.img_height, self.img_width, _ = image.shape
-
-            temp_fishnet = self.fishnet[self.fishnet["batch_id"] == batch_id].copy()
-
-            self.batch_geometry = self.fh.batches.loc[
-                self.fh.batches["batch_id"] == batch_id
-            ]["geometry"].bounds.values[0]
-
-            temp_fishnet["ImageCoordinates"] = self.get_pixel_coordinates(temp_fishnet)
-
-            self.fishnet.update(temp_fishnet)
-
-        self.fishnet["Width"] = self.fishnet["ImageCoordinates"].apply(
-            lambda x: x[2] - x[0]
-        )
-        self.fishnet["Height"] = self.fishnet["ImageCoordinates"].apply(
-            lambda x: x[3] - x[1]
-        )
+    def assign_fishnet_tiles_to_pixels(self, image_folder, file_name, n_jobs=1):
+        batch_positions = self.get_batch_positions()
+        tile_bounds = self.get_tile_bounds(self.fishnet)
+        tasks = {
+            batch_id: (
+                os.path.join(image_folder, f"{file_name}_{batch_id}.tif"),
+                self.fh.grid.batch_id_to_bounds(batch_id),
+                tile_bounds[positions],
+            )
+            for batch_id, positions in batch_positions.items()
+        }
+
+        # Results are written into preallocated columns, by row position. Tiles of no processed batch keep -1.
+        windows = np.full((len(self.fishnet), 4), -1, dtype=np.int32)
+        valid = np.zeros(len(self.fishnet), dtype=bool)
+        # The workers only read the image headers, so the cache is keyed on the image files, not their content
+        for batch_id, (batch_windows, batch_valid) in self._map_batches(
+            _pixel_coordinates_batch, tasks, n_jobs, cached="file"
+        ):
+            windows[batch_positions[batch_id]] = batch_windows
+            valid[batch_positions[batch_id]] = batch_valid
+
+        for i, column in enumerate(IMAGE_COORDINATES):
+            self.fishnet[column] = windows[:, i]
+        self.fishnet["ValidImageCoordinates"] = valid
+        # Yearly statistics computed with the previous windows must be recomputed
+        self.processed_inputs().clear()
+        self.save_processed_inputs()
+        self.fishnet["Width"] = windows[:, 2] - windows[:, 0]
+        self.fishnet["Height"] = windows[:, 3] - windows[:, 1]
+
+        if not valid.all():
+            print(
+                f"Warning: {(~valid).sum()} tiles are not within their batch coordinates and will be skipped. "
+                "See the ValidImageCoordinates column."
+            )
 
     def compute_mean_tile_entropy_urbanization(
-        self, image_folder, file_name, feature1_name, feature2_name
+        self, image_folder, file_name, feature1_name, feature2_name, n_jobs=1
     ):
-        self.fishnet[feature1_name] = np.nan
-        self.fishnet[feature2_name] = np.nan
-
-        for batch_id in tqdm(list(self.batch_ids), desc="Processing Images"):
-            image_path = os.path.join(image_folder, f"{file_name}_{batch_id}.tif")
-            image = imageio.imread(image_path)
-            if image is None:
-                raise Exception("Error reading image.")
-
-            # Extract image dimensions
-            self.img_height, self.img_width, _ = image.shape
-
-            # extract the "built" label
-            built_label = self.extract_label(
-                image, (196, 40, 27)
-            )  # Assuming "built" is represented by white pixels red #  [196  40  27] for red in DW
-
-            temp_fishnet = self.fishnet[self.fishnet["batch_id"] == batch_id].copy()
-
-            self.batch_geometry = self.fh.batches.loc[
-                self.fh.batches["batch_id"] == batch_id
-            ]["geometry"].bounds.values[0]
-
-            (
-                temp_fishnet[feature1_name],
-                temp_fishnet[feature2_name],
-            ) = self.get_mean_pixel_entropy_values(built_label, temp_fishnet)
-
-            self.fishnet.update(temp_fishnet)
-
-    def get_pixel_coordinates(self, df):
-        # Use the apply() method with axis=1 to apply the latlong_to_pixel function to each row
-        image_coordinates = df.apply(
-            lambda row: self.latlong_to_pixel(
-                self.batch_geometry, row["geometry"].bounds, row["id"]
-            ),
-            axis=1,
+        # Mean of the black & white "built" mask and its entropy
+        self.compute_tile_statistics(
+            image_folder,
+            file_name,
+            {feature1_name: "built_pixel_mean", feature2_name: "built_entropy"},
+            n_jobs=n_jobs,
         )
 
-        # raise Error if image coordinates is nan
-        if image_coordinates.isna().any():
-            raise Exception("Error: Image coordinates are nan.")
+    def compute_tile_statistics(
+        self,
+        image_folder,
+        file_name,
+        features,
+        backend="bincount",
+        n_jobs=1,
+        batch_ids=None,
+    ):
+        """
+        Compute statistics of the Dynamic World classes for every tile, in a single pass over each batch image.
+
+        Each batch image is converted once into a class-index raster, the class histograms of all its tiles are
+        computed at once, and every requested feature is derived from these histograms.
+
+        Parameters:
+        image_folder (str): The folder containing the batch images.
+        file_name (str): The prefix of the batch images, which are named {file_name}_{batch_id}.tif.
+        features (dict): Maps the name of each fishnet column to create to a statistic of TILE_STATISTICS, e.g.
+        {"MeanPixel_2020": "built_pixel_mean", "Entropy_2020": "built_entropy", "Trees_2020": "trees_share"}.
+        A value can also be a (statistic, scale) tuple to aggregate over a scale x scale tiles window centered on
+        each tile, e.g. ("built_pixel_mean", 3). Such windows are truncated at the edges of the batch image.
+        backend (str): "bincount" or "integral" (see TileStatistics.tile_histograms). Scales other than 1 always
+        use the integral image, so all scales are computed from a single read of each image. The integral image of
+        a batch holds 2 or 4 bytes per pixel and class (about 4 GB for a 100 megapixel image, see
+        TileStatistics.IntegralHistogram), so it is only built when the backend or a scale requires it.
+        n_jobs (int): Number of worker processes. Each batch image is processed by one worker, which only receives
+        the pixel windows of its tiles and sends back one array per feature. None uses all the cores.
+        batch_ids (list): Only process these batches, keeping the existing values of the other tiles. Defaults to
+        all the batches.
+        """
+        if backend not in ["bincount", "integral"]:
+            raise ValueError("backend must be 'bincount' or 'integral'.")
+        specs = {
+            feature_name: spec if isinstance(spec, tuple) else (spec, 1)
+            for feature_name, spec in features.items()
+        }
+
+        batch_positions = self.get_batch_positions(valid_only=True)
+        if batch_ids is not None:
+            batch_positions = {
+                batch_id: batch_positions[batch_id] for batch_id in batch_ids
+            }
+        windows = self.get_image_windows()
+        tasks = {
+            batch_id: (
+                os.path.join(image_folder, f"{file_name}_{batch_id}.tif"),
+                windows[positions],
+                specs,
+                backend,
+            )
+            for batch_id, positions in batch_positions.items()
+        }
+
+        # Results are written into preallocated columns, by row position
+        values = {
+            feature_name: (
+                self.fishnet[feature_name].values.astype(np.float64)
+                if batch_ids is not None and feature_name in self.fishnet.columns
+                else np.full(len(self.fishnet), np.nan)
+            )
+            for feature_name in features
+        }
+        for batch_id, result in self._map_batches(
+            _tile_statistics_batch, tasks, n_jobs, cached=True
+        ):
+            for feature_name in features:
+                values[feature_name][batch_positions[batch_id]] = result[feature_name]
 
-        return image_coordinates
+        for feature_name in features:
+            self.fishnet[feature_name] = values[feature_name]
 
-    def latlong_to_pixel(self, batch_coords, tile_coords, id):
-        min_lon, min_lat, max_lon, max_lat = batch_coords  # long/lat format
-        xmin, ymin, xmax, ymax = tile_coords  # long/lat format
+    def process_years(
+        self, image_root, file_name, years=None, incremental=True, n_jobs=1
+    ):
+        """
+        Compute the MeanPixel_{year} and Entropy_{year} columns from the Final batch images of each year, stored in
+        image_root/{year}/Final/{file_name}_{batch_id}.tif.
+
+        With incremental=True, only the (year, batch) pairs whose image is new or has changed since it was last
+        processed are computed, and the values of the other tiles are kept. The signature of every processed image
+        (its content digest with a ResultCache, else its modification time and size) is kept by the ImageProcessor,
+        and written to its state_file, if any, so a later run with the same state_file and saved fishnet only
+        processes the new or changed images.
+
+        Parameters:
+        image_root (str): Folder holding one sub-folder per year.
+        file_name (str): The prefix of the batch images.
+        years (list): Years to process. Defaults to every year folder of image_root with a Final sub-folder.
+        incremental (bool): Whether to skip the (year, batch) pairs already processed with the same image.
+        n_jobs (int): Number of worker processes (see compute_tile_statistics).
+
+        Returns:
+        dict: Maps each year to the list of its processed batch ids.
+        """
+        if IMAGE_COORDINATES[0] not in self.fishnet.columns:
+            raise Exception(
+                "Pixel windows are not defined. Please run assign_fishnet_tiles_to_pixels() first."
+            )
+        if years is None:
+            years = sorted(
+                entry
+                for entry in os.listdir(image_root)
+                if entry.startswith("20")
+                and os.path.isdir(os.path.join(image_root, entry, "Final"))
+            )
 
-        # check if xmin > min_lon, xmax>xmin, xmax < max_lon, ymin > min_lat, ymax > ymin, ymax < max_lat
-        if (
-            xmin < min_lon
-            #            or xmax < xmin
-            or xmax > max_lon
-            or ymin < min_lat
-            #            or ymax < ymin
-            or ymax > max_lat
-        ):
-            print("Tile: ", id)
-            print("Xmin: ", xmin)
-            print("Xmax: ", xmax)
-            print("Ymin: ", ymin)
-            print("Ymax: ", ymax)
-            print("Min Lon: ", min_lon)
-            print("Max Lon: ", max_lon)
-            print("Min Lat: ", min_lat)
-            print("Max Lat: ", max_lat)
-            raise Exception("Error: Tile coordinates are not within batch coordinates.")
-
-        # Normalize the bounding box coordinates
-        x_min_pixel = int((xmin - min_lon) / (max_lon - min_lon) * self.img_width)
-        x_max_pixel = int((xmax - min_lon) / (max_lon - min_lon) * self.img_width)
-        y_min_pixel = int(
-            (1 - (ymax - min_lat) / (max_lat - min_lat)) * self.img_height
-        )
-        y_max_pixel = int(
-            (1 - (ymin - min_lat) / (max_lat - min_lat)) * self.img_height
+        processed_inputs = self.processed_inputs()
+        processed = {}
+        for year in years:
+            image_folder = os.path.join(image_root, str(year), "Final")
+            signatures = {}
+            for batch_id in self.batch_ids:
+                path = os.path.join(image_folder, f"{file_name}_{batch_id}.tif")
+                if os.path.exists(path):
+                    signatures[batch_id] = self.input_signature(path)
+
+            if incremental and f"MeanPixel_{year}" in self.fishnet.columns:
+                batch_ids = [
+                    batch_id
+                    for batch_id, signature in signatures.items()
+                    if processed_inputs.get((int(year), int(batch_id))) != signature
+                ]
+            else:
+                batch_ids = list(signatures)
+
+            print(
+                f"Year {year}: {len(batch_ids)} of {len(signatures)} batches to process."
+            )
+            if batch_ids:
+                self.compute_tile_statistics(
+                    image_folder,
+                    file_name,
+                    {
+                        f"MeanPixel_{year}": "built_pixel_mean",
+                        f"Entropy_{year}": "built_entropy",
+                    },
+                    n_jobs=n_jobs,
+                    batch_ids=batch_ids,
+                )
+            for batch_id in batch_ids:
+                processed_inputs[(int(year), int(batch_id))] = signatures[batch_id]
+            processed[int(year)] = batch_ids
+
+        if self.cache is not None:
+            self.cache.flush()
+        self.save_processed_inputs()
+        return processed
+
+    def processed_inputs(self):
+        # Signatures of the batch images behind the yearly columns, per (year, batch_id), read from state_file
+        if self._processed_inputs is None:
+            self._processed_inputs = {}
+            if self.state_file is not None and os.path.exists(self.state_file):
+                self._processed_inputs = _read_signatures(self.state_file)
+        return self._processed_inputs
+
+    def save_processed_inputs(self):
+        # Write the signatures of processed_inputs to state_file, if any
+        if self.state_file is not None:
+            _write_signatures(self.state_file, self.processed_inputs())
+
+    def output_inputs(self, years):
+        # Signatures of the batch images behind the urbanization rows of these years, which are computed from the
+        # MeanPixel columns of the years and of their previous years
+        needed = {int(yr) for yr in years} | {int(yr) - 1 for yr in years}
+        return {
+            key: signature
+            for key, signature in self.processed_inputs().items()
+            if key[0] in needed
+        }
+
+    def stale_years(self, inputs_path, written_years):
+        """
+        Years of an output whose rows were computed from other batch images than the current ones, because
+        process_years recomputed some of their (year, batch) pairs (or those of their previous years) since the
+        output was written. inputs_path is the file where the output recorded the signatures of its images. Every
+        written year is stale when it does not exist.
+        """
+        recorded = _read_signatures(inputs_path) if os.path.exists(inputs_path) else {}
+        current = self.processed_inputs()
+        changed = {
+            year
+            for year, batch_id in set(recorded) | set(current)
+            if recorded.get((year, batch_id)) != current.get((year, batch_id))
+        }
+        return sorted(
+            int(yr) for yr in written_years if yr in changed or yr - 1 in changed
         )
 
-        return x_min_pixel, y_min_pixel, x_max_pixel, y_max_pixel
+    def processed_years(self):
+        # Years whose MeanPixel column has been computed
+        return sorted(
+            int(column[len("MeanPixel_") :])
+            for column in self.fishnet.columns
+            if column.startswith("MeanPixel_") and column[len("MeanPixel_") :].isdigit()
+        )
 
-    def get_mean_pixel_entropy_values(self, matrix, df):
-        # Use the apply() method with axis=1 to apply the function to each row
-        mean_pixel = df.apply(
-            lambda row: self.mean_pixel_value(matrix, row["ImageCoordinates"]),
-            axis=1,
+    def input_signature(self, path):
+        if self.cache is not None:
+            return self.cache.file_digest(path)
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _map_batches(self, worker, tasks, n_jobs, show_progress=True, cached=False):
+        """
+        Run worker(*args) for every (batch_id, args) item of tasks and yield (batch_id, result) pairs.
+
+        With n_jobs > 1 (or None for all the cores) the batches are sent to a process pool and the results are
+        streamed back as they complete. The workers only receive the compact per-batch arguments, never the fishnet.
+
+        With cached=True and a ResultCache, each result is keyed by the worker, the content digest of the batch
+        image (the first argument) and the other arguments, which hold the tile and batch geometry derived from the
+        fishnet parameters. With cached="file", the path, modification time and size of the image replace its
+        digest, for workers that only read the image header. Cached batches are not recomputed, and new results
+        are stored in the cache.
+        """
+        keys = {}
+        if cached and self.cache is not None:
+            signature = (
+                self.cache.file_signature
+                if cached == "file"
+                else self.cache.file_digest
+            )
+            for batch_id, args in tasks.items():
+                keys[batch_id] = self.cache.key(
+                    worker.__name__, signature(args[0]), args[1:]
+                )
+            self.cache.flush()
+
+            misses = {}
+            for batch_id, args in tasks.items():
+                result = self.cache.get(keys[batch_id])
+                if result is None:
+                    misses[batch_id] = args
+                else:
+                    yield batch_id, result
+            if show_progress:
+                print(f"{len(tasks) - len(misses)} of {len(tasks)} batches cached.")
+            tasks = misses
+
+        for batch_id, result in self._run_batches(worker, tasks, n_jobs, show_progress):
+            if batch_id in keys:
+                self.cache.put(keys[batch_id], result)
+            yield batch_id, result
+
+    def _run_batches(self, worker, tasks, n_jobs, show_progress):
+        if n_jobs == 1:
+            for batch_id, args in tqdm(
+                tasks.items(), desc="Processing Images", disable=not show_progress
+            ):
+                yield batch_id, worker(*args)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = {
+                    executor.submit(worker, *args): batch_id
+                    for batch_id, args in tasks.items()
+                }
+                for future in tqdm(
+                    as_completed(futures),
+                    total=len(futures),
+                    desc="Processing Images",
+                    disable=not show_progress,
+                ):
+                    yield futures[future], future.result()
+
+    def get_batch_positions(self, valid_only=False):
+        """
+        Row positions in self.fishnet of the tiles of each batch.
+
+        The tiles are grouped with a single stable argsort of the batch ids, and each batch is a slice of that order
+        delimited by searchsorted offsets, so looking up a batch does not depend on the size of the fishnet.
+
+        Parameters:
+        valid_only (bool): Leave out the tiles whose pixel window is not within their batch image (see the
+        ValidImageCoordinates column set by assign_fishnet_tiles_to_pixels).
+
+        Returns:
+        dict: Maps each batch_id of self.batch_ids to the array of row positions of its tiles.
+        """
+        batch_ids = self.fishnet["batch_id"].values.astype(np.int64)
+        order = np.argsort(batch_ids, kind="stable")
+        sorted_batch_ids = batch_ids[order]
+        wanted = np.asarray(list(self.batch_ids), dtype=np.int64)
+        starts = np.searchsorted(sorted_batch_ids, wanted, side="left")
+        stops = np.searchsorted(sorted_batch_ids, wanted, side="right")
+        positions = {
+            batch_id: order[start:stop]
+            for batch_id, start, stop in zip(self.batch_ids, starts, stops)
+        }
+        if valid_only and "ValidImageCoordinates" in self.fishnet.columns:
+            valid = self.fishnet["ValidImageCoordinates"].values.astype(bool)
+            positions = {
+                batch_id: rows[valid[rows]] for batch_id, rows in positions.items()
+            }
+        return positions
+
+    def get_image_windows(self):
+        # (n, 4) array of the pixel windows of all the tiles, aligned with self.fishnet
+        return self.fishnet[IMAGE_COORDINATES].values
+
+    def get_tile_bounds(self, df):
+        # Fishnets created without geometry take their tile bounds from the implicit grid
+        if "geometry" in df.columns:
+            return df["geometry"].bounds.values
+        return self.fh.grid.id_to_bounds(df["id"].values)
+
+    def get_pixel_coordinates(self, df, batch_coords=None, img_shape=None):
+        """
+        Pixel windows of the tiles of df in their batch image, as a Series of (xmin, ymin, xmax, ymax) tuples
+        indexed like df. Raises an Exception when a tile is not within the batch coordinates.
+
+        batch_coords defaults to self.batch_geometry and img_shape to (self.img_height, self.img_width), the
+        attributes the per-batch loops used to set. assign_fishnet_tiles_to_pixels computes all the windows at
+        once with the module-level latlong_to_pixel instead.
+        """
+        if batch_coords is None:
+            batch_coords = self.batch_geometry
+        img_height, img_width = self._img_shape(img_shape)
+        windows, valid = latlong_to_pixel(
+            batch_coords, self.get_tile_bounds(df), img_width, img_height
         )
-        entropy = df.apply(
-            lambda row: self.entropy(matrix, row["ImageCoordinates"]), axis=1
+        if not valid.all():
+            raise Exception(
+                f"Error: Tile {df['id'].values[~valid][0]} coordinates are not within batch coordinates."
+            )
+        return pd.Series(
+            [tuple(int(x) for x in window) for window in windows], index=df.index
         )
-        return mean_pixel, entropy
+
+    def latlong_to_pixel(self, batch_coords, tile_coords, id, img_shape=None):
+        # Pixel window of one tile, see get_pixel_coordinates
+        img_height, img_width = self._img_shape(img_shape)
+        windows, valid = latlong_to_pixel(
+            batch_coords, tile_coords, img_width, img_height
+        )
+        if not valid[0]:
+            raise Exception(
+                f"Error: Tile {id} coordinates are not within batch coordinates."
+            )
+        return tuple(int(x) for x in windows[0])
+
+    def _img_shape(self, img_shape):
+        if img_shape is None:
+            return self.img_height, self.img_width
+        return img_shape[0], img_shape[1]
 
     def mean_pixel_value(self, matrix: np.ndarray, bounds: list):
         xmin, ymin, xmax, ymax = bounds
@@ -152,6 +452,22 @@ class ImageProcessor:
         mean_value = np.mean(submatrix)
         return mean_value
 
+    def mean_pixel_values(self, matrix: np.ndarray, windows: np.ndarray):
+        # Mean of the matrix over many windows at once, from its summed-area table. Windows are clipped to the
+        # matrix like slices, and the mean of an empty window is NaN
+        windows = np.asarray(windows).reshape(-1, 4)
+        sums = window_sums(integral_image(matrix, dtype=np.float64), windows)
+        height, width = matrix.shape[:2]
+        areas = np.maximum(
+            np.clip(windows[:, 2], 0, width) - np.clip(windows[:, 0], 0, width), 0
+        ) * np.maximum(
+            np.clip(windows[:, 3], 0, height) - np.clip(windows[:, 1], 0, height), 0
+        )
+        if sums.ndim > 1:
+            sums = sums.reshape(len(windows), -1).mean(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(areas > 0, sums / areas, np.nan)
+
     def entropy(self, matrix: np.ndarray, bounds: list):
         xmin, ymin, xmax, ymax = bounds
         submatrix = matrix[ymin:ymax, xmin:xmax]
@@ -161,6 +477,10 @@ class ImageProcessor:
         return entropy_value
 
     def extract_label(self, image, color):
+        if image.ndim == 2:
+            # Class-index raster: a single compare against the class of the color
+            return np.where(image == color_to_class(color), 255, 0).astype(np.uint8)
+
         red_pixels = np.all(
             [
                 image[:, :, 0] == color[0],  # Red channel
@@ -186,69 +506,65 @@ class ImageProcessor:
 
         return unique_colors
 
-    def generate_processed_csv(self, save_path, file_name, filter):
-        # Compute Urbanization Rate
-        years = list(range(2016, 2023))
-        for yr in years[1:]:
-            self.fh.compute_difference(
-                f"MeanPixel_{yr}", f"MeanPixel_{yr-1}", filtered=filter, normalize=True
+    def generate_processed_csv(
+        self, save_path, file_name, filter=None, incremental=False
+    ):
+        """
+        Write the urbanization dataset, with one row per tile and year: the urbanization rate of the year (change of
+        the built pixel mean since the previous year, normalized by 255) and the urbanization of the previous year.
+
+        The years are all the processed years (see processed_years) whose previous year is also processed. The rows
+        are grouped by tile, in fishnet order, and the pixel window of each tile is written as an ImageCoordinates
+        "(xmin, ymin, xmax, ymax)" tuple, readable with ast.literal_eval. With incremental=True and an existing CSV,
+        only the rows of the years missing from the CSV are appended to it.
+
+        Parameters:
+        save_path (str): Folder of the outputs.
+        file_name (str): Name of the outputs, without extension.
+        filter (bool): Deprecated. The fishnet of this ImageProcessor (see its filtered argument) is used, and a
+        different value raises a ValueError.
+        incremental (bool): Whether to append the new years to an existing CSV instead of rewriting it, when its
+        written years are up to date.
+        """
+        if filter is not None:
+            if bool(filter) != bool(self.filtered):
+                raise ValueError(
+                    f"filter={filter} does not match the fishnet of this ImageProcessor (filtered={self.filtered})."
+                )
+            warnings.warn(
+                "The filter argument of generate_processed_csv is deprecated: the fishnet of the ImageProcessor "
+                "is used.",
+                DeprecationWarning,
+                stacklevel=2,
             )
-
-        # rename MeanPixel_2017-MeanPixel_2016 to urbanization_rate_2016
-        for yr in years[1:]:
-            self.fishnet.rename(
-                columns={f"MeanPixel_{yr}-MeanPixel_{yr-1}": f"urbanization_rate_{yr}"},
-                inplace=True,
+        processed_years = self.processed_years()
+        years = [yr for yr in processed_years if yr - 1 in processed_years]
+
+        csv_path = save_path + file_name + ".csv"
+        inputs_path = save_path + file_name + ".inputs.json"
+        append = incremental and os.path.exists(csv_path)
+        if append:
+            written = set(pd.read_csv(csv_path, usecols=["year"])["year"])
+            stale = self.stale_years(inputs_path, written)
+            if stale:
+                print(
+                    f"Years {stale} of {csv_path} were computed from images that have changed: rewriting it."
+                )
+                append = False
+            else:
+                years = [yr for yr in years if yr not in written]
+                print(f"Appending years {years} to {csv_path}.")
+
+        if years or not append:
+            data = self.urbanization_csv_data(years)
+            data.to_csv(
+                csv_path, index=False, mode="a" if append else "w", header=not append
             )
-
-        for yr in years:
-            self.fishnet.rename(
-                columns={f"MeanPixel_{yr}": f"urbanization_{yr}"}, inplace=True
+            _write_signatures(
+                inputs_path,
+                self.output_inputs(set(years) | (written if append else set())),
             )
 
-        self.fishnet.rename(columns={"id": "tile_id"}, inplace=True)
-        self.fishnet["tile_id"] = self.fishnet["tile_id"].astype(int)
-        self.fishnet["batch_id"] = self.fishnet["batch_id"].astype(int)
-
-        # Extracting Lat Long coordinates
-        self.fishnet["centroid"] = self.fishnet["geometry"].apply(lambda x: x.centroid)
-        self.fishnet["Lat"] = self.fishnet["centroid"].apply(lambda x: x.y)
-        self.fishnet["Lon"] = self.fishnet["centroid"].apply(lambda x: x.x)
-
-        vars1 = ["tile_id", "batch_id"] + [
-            f"urbanization_rate_{year}" for year in range(2017, 2023)
-        ]
-        vars2 = ["tile_id", "batch_id"] + [
-            f"urbanization_{year}" for year in range(2016, 2023)
-        ]
-
-        data = self.fishnet[vars1].melt(
-            id_vars=["tile_id", "batch_id"],
-            var_name="year",
-            value_name="urbanization_rate",
-        )
-        data["year"] = data["year"].str[-4:]
-        data["urbanization"] = (
-            self.fishnet[vars2].melt(
-                id_vars=["tile_id", "batch_id"],
-                var_name="year",
-                value_name="urbanization",
-            )["urbanization"]
-            / 255
-        )
-        # data["ImageCoordinates"] =
-        coords = self.fishnet[["tile_id", "ImageCoordinates"]]
-        data = data.merge(coords, on="tile_id")
-
-        # data['Lat'] is the latitude of the centroid of the tile in fc.filtered_fishnet['Lat'] joint
-        data = data.merge(
-            self.fishnet[["tile_id", "batch_id", "Lat", "Lon"]], # Add ImageCoordinates here?
-            on=["tile_id", "batch_id"],
-        )
-
-        # Save result
-        data.to_csv(save_path + file_name + ".csv", index=False)
-
         # Save Metadata
         with open(save_path + file_name + ".txt", "w") as f:
             f.write("\n\nGeneral Fishnet Information:\n")
@@ -261,6 +577,137 @@ class ImageProcessor:
                 f.write("\nNumber of rows: " + str(self.fh.filtered_fishnet_rows))
                 f.write("\nNumber of cols: " + str(self.fh.filtered_fishnet_cols))
 
+    def generate_processed_parquet(
+        self, save_path, file_name, partition_by="year", incremental=False
+    ):
+        """
+        Write the urbanization dataset of generate_processed_csv as a Parquet dataset in save_path/file_name,
+        partitioned by year or batch_id, with typed columns and the fishnet, batch and filter information stored as
+        file metadata instead of a .txt file. Read it back with ProcessedData.read_processed_data, which only loads
+        the requested years and batches.
+
+        As with generate_processed_csv, the signatures of the batch images behind the rows are written with the
+        dataset (in its _inputs.json file), so an incremental run also rewrites the years computed from images that
+        process_years has recomputed since. With partition_by="year" only their partitions are replaced, with
+        partition_by="batch_id" the whole dataset is rewritten.
+
+        Parameters:
+        save_path (str): Folder of the outputs.
+        file_name (str): Name of the dataset folder.
+        partition_by (str): "year" or "batch_id".
+        incremental (bool): Whether to only write the years missing from an existing dataset, and its stale years.
+        """
+        processed_years = self.processed_years()
+        years = [yr for yr in processed_years if yr - 1 in processed_years]
+
+        dataset_path = os.path.join(save_path, file_name)
+        inputs_path = os.path.join(dataset_path, "_inputs.json")
+        written = set()
+        if incremental:
+            written = processed_data_years(dataset_path)
+            stale = self.stale_years(inputs_path, written)
+            if stale and partition_by == "batch_id":
+                # The files of a batch partition hold several years, so stale years cannot be replaced alone
+                print(
+                    f"Years {stale} of {dataset_path} were computed from images that have changed: rewriting it."
+                )
+                incremental, written = False, set()
+            else:
+                years = [yr for yr in years if yr not in written or yr in stale]
+                print(f"Writing years {years} to {dataset_path}.")
+                if not years:
+                    return
+
+        write_processed_data(
+            self.urbanization_data(years),
+            dataset_path,
+            metadata=self.processed_metadata(),
+            partition_by=partition_by,
+            incremental=incremental,
+        )
+        _write_signatures(inputs_path, self.output_inputs(set(years) | written))
+
+    def processed_metadata(self):
+        # Fishnet, batch and filter information stored with the Parquet outputs
+        grid = self.fh.grid
+        metadata = {
+            "tile_width_miles": float(self.fh.tile_width_miles),
+            "tile_height_miles": float(self.fh.tile_height_miles),
+            "fishnet_width_degrees": float(self.fh.fishnet_width_degrees),
+            "fishnet_height_degrees": float(self.fh.fishnet_height_degrees),
+            "grid": {
+                "xmin": float(grid.xmin),
+                "ymax": float(grid.ymax),
+                "tile_width_degrees": float(grid.tile_width_degrees),
+                "tile_height_degrees": float(grid.tile_height_degrees),
+                "rows": int(grid.rows),
+                "cols": int(grid.cols),
+                "nbr_tiles_per_batch": int(grid.nbr_tiles_per_batch),
+                "batch_rows": int(grid.batch_rows),
+                "batch_cols": int(grid.batch_cols),
+            },
+            "filtered": bool(self.filtered),
+        }
+        if self.fh.filtered:
+            metadata["filter_region"] = [float(x) for x in self.fh.filter_region]
+            metadata["filtered_fishnet_rows"] = int(self.fh.filtered_fishnet_rows)
+            metadata["filtered_fishnet_cols"] = int(self.fh.filtered_fishnet_cols)
+        return metadata
+
+    def urbanization_data(self, years):
+        # Long table of the urbanization of every tile, built column by column. Like the original melt and merge,
+        # the rows are grouped by tile in fishnet order, with the years in increasing order within each tile
+        n_years = len(years)
+        current = self.fishnet[[f"MeanPixel_{yr}" for yr in years]].values
+        previous = self.fishnet[[f"MeanPixel_{yr - 1}" for yr in years]].values
+        current, previous = current.astype(np.float64), previous.astype(np.float64)
+
+        if "geometry" in self.fishnet.columns:
+            centroids = shapely.centroid(self.fishnet["geometry"].values)
+            lat, lon = shapely.get_y(centroids), shapely.get_x(centroids)
+        else:
+            bounds = self.get_tile_bounds(self.fishnet)
+            lat = (bounds[:, 1] + bounds[:, 3]) / 2
+            lon = (bounds[:, 0] + bounds[:, 2]) / 2
+
+        data = pd.DataFrame(
+            {
+                "tile_id": np.repeat(self.fishnet["id"].values.astype(int), n_years),
+                "batch_id": np.repeat(
+                    self.fishnet["batch_id"].values.astype(int), n_years
+                ),
+                "year": np.tile(np.asarray(years, dtype=int), len(self.fishnet)),
+                "urbanization_rate": ((current - previous) / 255).ravel(),
+                "urbanization": (previous / 255).ravel(),
+            }
+        )
+        for coordinate in IMAGE_COORDINATES:
+            data[coordinate] = np.repeat(self.fishnet[coordinate].values, n_years)
+        data["Lat"] = np.repeat(lat, n_years)
+        data["Lon"] = np.repeat(lon, n_years)
+        return data
+
+    def urbanization_csv_data(self, years):
+        # The urbanization data in the layout of the CSV: the pixel window of each tile is a single ImageCoordinates
+        # column holding an "(xmin, ymin, xmax, ymax)" tuple, empty when the window is not valid
+        data = self.urbanization_data(years)
+        windows = data[IMAGE_COORDINATES].astype(str)
+        image_coordinates = (
+            "(" + windows[IMAGE_COORDINATES].agg(", ".join, axis=1) + ")"
+        )
+        if "ValidImageCoordinates" in self.fishnet.columns:
+            valid = np.repeat(
+                self.fishnet["ValidImageCoordinates"].values.astype(bool), len(years)
+            )
+            image_coordinates = image_coordinates.where(valid)
+        data = data.drop(columns=IMAGE_COORDINATES)
+        data.insert(
+            data.columns.get_loc("urbanization") + 1,
+            "ImageCoordinates",
+            image_coordinates,
+        )
+        return data
+
     def cnn_partition_images(
         self,
         image_folder,
@@ -269,7 +716,20 @@ class ImageProcessor:
         img_size,
         warning=True,
         show_progress=True,
+        n_jobs=1,
+        store="tiff",
     ):
+        """
+        Export the image of every tile for one year, cropped to img_size.
+
+        With store="tiff", one TIFF per tile is written in image_folder/CNN/year. With store="cube", the crops of the
+        tiles of each batch are written as one contiguous chunk of a TileCube in image_folder/CNN_cube, readable by
+        CustomDataset and SequenceDataLoader without opening one file per tile. In both cases the batches are
+        processed in parallel with n_jobs processes.
+        """
+        if store not in ["tiff", "cube"]:
+            raise ValueError("store must be 'tiff' or 'cube'.")
+
         # Write a message to the user: "Warning, this code will create a new folder CNN in the /Image/ folder, which may take a lot of space on the hard drive. Continue?"
         # If the user says yes, continue, otherwise, stop the code
         if warning:
@@ -280,51 +740,187 @@ class ImageProcessor:
             answer = "Yes"
 
         if answer == "Yes":
-            progress_bar = tqdm(
-                list(self.batch_ids),
-                ncols=80,
-                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}",
-                disable=show_progress,
-            )
-
-            for batch_id in progress_bar:
-                image_path = os.path.join(
-                    image_folder,
-                    year,
-                    "Final",
-                    f"{file_name}_{batch_id}.tif",
+            tile_ids = self.fishnet["id"].values.astype(int)
+            windows = self.get_image_windows()
+            batch_positions = self.get_batch_positions(valid_only=True)
+
+            if store == "cube":
+                export_folder = os.path.join(image_folder, "CNN_cube")
+                worker = _cnn_cube_batch
+                # Position of each tile within the chunk of its batch
+                rows = np.concatenate(
+                    [np.empty(0, dtype=np.int64)] + list(batch_positions.values())
+                )
+                chunk_positions = np.concatenate(
+                    [np.empty(0, dtype=np.int64)]
+                    + [
+                        np.arange(len(positions))
+                        for positions in batch_positions.values()
+                    ]
+                )
+            else:
+                export_folder = os.path.join(image_folder, "CNN", year)
+                worker = _cnn_partition_batch
+
+            if not os.path.exists(export_folder):
+                os.makedirs(export_folder)
+                print("Directory ", export_folder, " Created ")
+
+            tasks = {
+                batch_id: (
+                    os.path.join(
+                        image_folder, year, "Final", f"{file_name}_{batch_id}.tif"
+                    ),
+                    batch_id,
+                    tile_ids[positions],
+                    windows[positions],
+                    img_size,
+                    export_folder,
+                )
+                for batch_id, positions in batch_positions.items()
+            }
+            if store == "cube":
+                tasks = {batch_id: args + (year,) for batch_id, args in tasks.items()}
+
+            for _ in self._map_batches(
+                worker, tasks, n_jobs, show_progress=show_progress
+            ):
+                pass
+
+            if store == "cube":
+                # Only index the tiles once every chunk has been written, so the index never points to a missing
+                # chunk when a batch fails or the run is interrupted
+                write_index(
+                    export_folder,
+                    tile_ids[rows],
+                    self.fishnet["batch_id"].values[rows],
+                    chunk_positions,
                 )
-                image = imageio.imread(image_path)
-
-                # extract all fishnet tile ids in the current batch
-                fishnet_tiles = self.fishnet[self.fishnet["batch_id"] == batch_id]["id"]
-
-                for tile_id in fishnet_tiles:
-                    tile = self.fishnet[self.fishnet["id"] == tile_id]
-                    xmin, ymin, xmax, ymax = tile["ImageCoordinates"].values[0]
-                    subimage = image[ymin:ymax, xmin:xmax]
-
-                    if subimage.shape[0] < 30 or subimage.shape[1] < 30:
-                        raise Exception(
-                            f"Subimage {tile_id} in batch {batch_id} is too small. Please check the image and fishnet."
-                        )
-
-                    # Crop image to img_size
-                    subimage = subimage[: img_size[0], : img_size[1]]
-
-                    # check if the directory self.image_folder + 'CNN' exists, otherwise, create it
-                    if not os.path.exists(image_folder + f"/CNN/{year}/"):
-                        os.makedirs(image_folder + f"/CNN/{year}/")
-                        print(
-                            "Directory ",
-                            image_folder + f"/CNN/{year}/",
-                            " Created ",
-                        )
-
-                    export_path = (
-                        image_folder + f"/CNN/{year}/" + f"/{int(tile_id)}.tif"
-                    )
-                    imageio.imwrite(export_path, subimage)
 
         else:
             print("Aborted.")
+
+
+def _read_signatures(path):
+    # {(year, batch_id): signature} of a JSON list of [year, batch_id, signature] (see process_years)
+    with open(path) as f:
+        return {
+            (year, batch_id): (
+                tuple(signature) if isinstance(signature, list) else signature
+            )
+            for year, batch_id, signature in json.load(f)
+        }
+
+
+def _write_signatures(path, signatures):
+    # Written to a temporary file first, so an interrupted run never leaves a truncated file
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(
+            [
+                [year, batch_id, signature]
+                for (year, batch_id), signature in signatures.items()
+            ],
+            f,
+        )
+    os.replace(temporary_path, path)
+
+
+# -------------------------------------------------------------------------- #
+#                Batch workers (run in the process pool)                      #
+# -------------------------------------------------------------------------- #
+
+
+def latlong_to_pixel(batch_coords, tile_bounds, img_width, img_height):
+    """
+    Convert the (lon, lat) bounds of tiles into pixel windows of their batch image, in one NumPy expression.
+
+    Args:
+        batch_coords (tuple): The (min_lon, min_lat, max_lon, max_lat) bounds of the batch image.
+        tile_bounds (np.ndarray): An (n, 4) array of (xmin, ymin, xmax, ymax) tile bounds in lon/lat.
+        img_width (int): Width of the batch image in pixels.
+        img_height (int): Height of the batch image in pixels.
+
+    Returns:
+        tuple: An (n, 4) int32 array of (xmin, ymin, xmax, ymax) pixel windows, and an (n,) boolean mask which is
+        False for the tiles that are not within the batch coordinates.
+    """
+    min_lon, min_lat, max_lon, max_lat = batch_coords  # long/lat format
+    tile_bounds = np.asarray(tile_bounds, dtype=np.float64).reshape(-1, 4)
+    xmin, ymin, xmax, ymax = tile_bounds.T  # long/lat format
+
+    valid = (
+        (xmin >= min_lon) & (xmax <= max_lon) & (ymin >= min_lat) & (ymax <= max_lat)
+    )
+
+    # Normalize the bounding box coordinates, truncating towards zero like int()
+    windows = np.stack(
+        [
+            (xmin - min_lon) / (max_lon - min_lon) * img_width,
+            (1 - (ymax - min_lat) / (max_lat - min_lat)) * img_height,
+            (xmax - min_lon) / (max_lon - min_lon) * img_width,
+            (1 - (ymin - min_lat) / (max_lat - min_lat)) * img_height,
+        ],
+        axis=1,
+    )
+    return windows.astype(np.int32), valid
+
+
+def _pixel_coordinates_batch(image_path, batch_bounds, tile_bounds):
+    # Only the image header is read
+    img_height, img_width = image_shape(image_path)[:2]
+
+    return latlong_to_pixel(batch_bounds, tile_bounds, img_width, img_height)
+
+
+def _tile_statistics_batch(image_path, windows, specs, backend):
+    # Both "visualize" RGB images and class-index rasters are supported
+    class_raster = to_class_raster(read_image(image_path))
+    scales = sorted({scale for _, scale in specs.values()})
+    if backend == "integral" or scales != [1]:
+        integral = IntegralHistogram(class_raster)
+
+    results = {}
+    for scale in scales:
+        if scale == 1 and backend == "bincount":
+            histograms = tile_histograms(class_raster, windows)
+        else:
+            histograms = integral.histograms(scale_windows(windows, scale))
+        statistics = compute_statistics(
+            histograms, {stat for stat, s in specs.values() if s == scale}
+        )
+        for feature_name, (statistic, s) in specs.items():
+            if s == scale:
+                results[feature_name] = statistics[statistic]
+    return results
+
+
+def _cnn_partition_batch(
+    image_path, batch_id, tile_ids, windows, img_size, export_folder
+):
+    # Only the tile windows are read from the batch image
+    subimages = read_windows(image_path, windows)
+
+    for tile_id, subimage in zip(tile_ids, subimages):
+        if subimage.shape[0] < 30 or subimage.shape[1] < 30:
+            raise Exception(
+                f"Subimage {tile_id} in batch {batch_id} is too small. Please check the image and fishnet."
+            )
+
+        # Crop image to img_size
+        subimage = subimage[: img_size[0], : img_size[1]]
+        imageio.imwrite(os.path.join(export_folder, f"{tile_id}.tif"), subimage)
+
+
+def _cnn_cube_batch(
+    image_path, batch_id, tile_ids, windows, img_size, export_folder, year
+):
+    subimages = read_windows(image_path, windows)
+
+    for tile_id, subimage in zip(tile_ids, subimages):
+        if subimage.shape[0] < 30 or subimage.shape[1] < 30:
+            raise Exception(
+                f"Subimage {tile_id} in batch {batch_id} is too small. Please check the image and fishnet."
+            )
+
+    write_chunk(export_folder, year, batch_id, crop_tiles(subimages, img_size))
@@ -0,0 +1,244 @@
+import math
+import numpy as np
+import shapely
+
+# Names and (row, col) offsets of the 8 immediate neighbors of a tile
+NEIGHBOR_POSITIONS = ["UL", "U", "UR", "L", "R", "DL", "D", "DR"]
+MOORE_OFFSETS = np.array(
+    [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+)
+
+
+class ImplicitGrid:
+    """
+    Geometry-free description of a regular fishnet.
+
+    No per-tile object is ever stored: rows, columns, bounds and batch ids are derived on the fly from the grid
+    origin (xmin, ymax), the tile size in degrees and the number of rows and columns. Tile ids follow the Fishnet
+    convention id = row * cols + col, with row 0 at the top (north) of the grid. Every method accepts scalars or
+    NumPy arrays and answers in constant time per tile.
+    """
+
+    def __init__(self, xmin, ymax, tile_width_degrees, tile_height_degrees, rows, cols):
+        """
+        Parameters:
+        xmin (float): Longitude of the western edge of the grid.
+        ymax (float): Latitude of the northern edge of the grid.
+        tile_width_degrees (float): Width of one tile in degrees of longitude.
+        tile_height_degrees (float): Height of one tile in degrees of latitude.
+        rows (int): Number of tile rows in the grid.
+        cols (int): Number of tile columns in the grid.
+        """
+        self.xmin = xmin
+        self.ymax = ymax
+        self.tile_width_degrees = tile_width_degrees
+        self.tile_height_degrees = tile_height_degrees
+        self.rows = rows
+        self.cols = cols
+        self.nbr_tiles_per_batch = None
+
+    @property
+    def n_tiles(self):
+        return self.rows * self.cols
+
+    def set_batches(self, nbr_tiles_per_batch, batch_rows, batch_cols):
+        """
+        Register the batch layout of the grid, each batch being a square of nbr_tiles_per_batch x nbr_tiles_per_batch
+        tiles.
+        """
+        self.nbr_tiles_per_batch = int(round(nbr_tiles_per_batch))
+        self.batch_rows = batch_rows
+        self.batch_cols = batch_cols
+        self.batch_width_degrees = self.tile_width_degrees * self.nbr_tiles_per_batch
+        self.batch_height_degrees = self.tile_height_degrees * self.nbr_tiles_per_batch
+
+    # -------------------------------------------------------------------------- #
+    #                              Tile lookups                                  #
+    # -------------------------------------------------------------------------- #
+
+    def row_col_to_id(self, row, col):
+        return row * self.cols + col
+
+    def id_to_row_col(self, ids):
+        return np.divmod(ids, self.cols)
+
+    def point_to_id(self, lon, lat):
+        """
+        Return the id of the tile containing each (lon, lat) point, or -1 for points outside the grid.
+        """
+        col = np.floor((np.asarray(lon) - self.xmin) / self.tile_width_degrees)
+        row = np.floor((self.ymax - np.asarray(lat)) / self.tile_height_degrees)
+        inside = (col >= 0) & (col < self.cols) & (row >= 0) & (row < self.rows)
+        ids = np.where(inside, row * self.cols + col, -1).astype(np.int64)
+        return ids if ids.ndim else int(ids)
+
+    def id_to_bounds(self, ids):
+        """
+        Return the (minx, miny, maxx, maxy) bounds of each tile, as an array of shape (n, 4) or (4,) for a scalar id.
+        """
+        row, col = self.id_to_row_col(np.asarray(ids))
+        x_min = self.xmin + col * self.tile_width_degrees
+        y_max = self.ymax - row * self.tile_height_degrees
+        return np.stack(
+            [
+                x_min,
+                y_max - self.tile_height_degrees,
+                x_min + self.tile_width_degrees,
+                y_max,
+            ],
+            axis=-1,
+        )
+
+    def tile_geometry(self, ids):
+        """
+        Build the shapely polygons of the requested tiles only.
+        """
+        bounds = self.id_to_bounds(ids)
+        return shapely.box(
+            bounds[..., 0], bounds[..., 1], bounds[..., 2], bounds[..., 3]
+        )
+
+    # -------------------------------------------------------------------------- #
+    #                                Batches                                     #
+    # -------------------------------------------------------------------------- #
+
+    def id_to_batch_id(self, ids):
+        if self.nbr_tiles_per_batch is None:
+            raise Exception(
+                "Batches are not defined. Please run Fishnet.batch() first."
+            )
+        row, col = self.id_to_row_col(np.asarray(ids))
+        return (row // self.nbr_tiles_per_batch) * self.batch_cols + (
+            col // self.nbr_tiles_per_batch
+        )
+
+    def batch_id_to_bounds(self, batch_ids):
+        """
+        Return the (minx, miny, maxx, maxy) bounds of each batch, matching the Fishnet batch geometries.
+        """
+        if self.nbr_tiles_per_batch is None:
+            raise Exception(
+                "Batches are not defined. Please run Fishnet.batch() first."
+            )
+        batch_row, batch_col = np.divmod(np.asarray(batch_ids), self.batch_cols)
+        x_min = self.xmin + batch_col * self.batch_width_degrees
+        y_max = self.ymax - batch_row * self.batch_height_degrees
+        return np.stack(
+            [
+                x_min,
+                y_max - self.batch_height_degrees,
+                x_min + self.batch_width_degrees,
+                y_max,
+            ],
+            axis=-1,
+        )
+
+    # -------------------------------------------------------------------------- #
+    #                           Bounding box queries                             #
+    # -------------------------------------------------------------------------- #
+
+    def bbox_to_row_col_range(self, bbox):
+        """
+        Return the half-open (row_start, row_stop, col_start, col_stop) range of the tiles intersecting a bounding
+        box. Tiles touching the bounding box on an edge are included, as with shapely's intersects.
+
+        Parameters:
+        bbox (tuple): A tuple of (xmin, ymin, xmax, ymax).
+        """
+        xmin, ymin, xmax, ymax = bbox
+        col_start = math.ceil((xmin - self.xmin) / self.tile_width_degrees) - 1
+        col_stop = math.floor((xmax - self.xmin) / self.tile_width_degrees) + 1
+        row_start = math.ceil((self.ymax - ymax) / self.tile_height_degrees) - 1
+        row_stop = math.floor((self.ymax - ymin) / self.tile_height_degrees) + 1
+        row_start, col_start = max(row_start, 0), max(col_start, 0)
+        row_stop, col_stop = min(row_stop, self.rows), min(col_stop, self.cols)
+        return row_start, max(row_stop, row_start), col_start, max(col_stop, col_start)
+
+    def bbox_to_ids(self, bbox):
+        """
+        Return the sorted ids of all tiles intersecting a bounding box.
+        """
+        row_start, row_stop, col_start, col_stop = self.bbox_to_row_col_range(bbox)
+        return np.add.outer(
+            np.arange(row_start, row_stop) * self.cols, np.arange(col_start, col_stop)
+        ).ravel()
+
+    def bbox_to_batch_ids(self, bbox):
+        """
+        Return the sorted ids of all batches intersecting a bounding box.
+        """
+        row_start, row_stop, col_start, col_stop = self.bbox_to_row_col_range(bbox)
+        if row_start == row_stop or col_start == col_stop:
+            return np.empty(0, dtype=np.int64)
+        n = self.nbr_tiles_per_batch
+        return np.add.outer(
+            np.arange(row_start // n, (row_stop - 1) // n + 1) * self.batch_cols,
+            np.arange(col_start // n, (col_stop - 1) // n + 1),
+        ).ravel()
+
+    def classify_geometry(self, geometry, block_size=2**20):
+        """
+        Classify the tiles of the bounding box of a geometry as fully inside, boundary or outside.
+
+        The candidate tiles follow from the bounding box by index arithmetic, and are tested against the prepared
+        geometry in vectorized calls: tiles covered by the geometry are fully inside, and the other intersecting
+        tiles are on its boundary. Only the boundary tiles require an exact intersection to be clipped.
+
+        Parameters:
+        geometry (shapely.Geometry): The geometry, in the coordinates of the grid.
+        block_size (int): Approximate number of tiles tested at once.
+
+        Returns:
+        tuple: The sorted ids of the tiles intersecting the geometry, and a boolean array flagging the tiles fully
+        inside it.
+        """
+        row_start, row_stop, col_start, col_stop = self.bbox_to_row_col_range(
+            shapely.bounds(geometry)
+        )
+        shapely.prepare(geometry)
+
+        # Blocks of rows bound the number of tile polygons alive at once
+        block_rows = max(1, block_size // max(col_stop - col_start, 1))
+        all_ids, all_inside = [np.empty(0, dtype=np.int64)], [np.zeros(0, dtype=bool)]
+        for block_start in range(row_start, row_stop, block_rows):
+            ids = np.add.outer(
+                np.arange(block_start, min(block_start + block_rows, row_stop))
+                * self.cols,
+                np.arange(col_start, col_stop),
+            ).ravel()
+            boxes = self.tile_geometry(ids)
+            intersecting = shapely.intersects(geometry, boxes)
+            all_ids.append(ids[intersecting])
+            all_inside.append(shapely.covers(geometry, boxes[intersecting]))
+        return np.concatenate(all_ids), np.concatenate(all_inside)
+
+    # -------------------------------------------------------------------------- #
+    #                               Neighbors                                    #
+    # -------------------------------------------------------------------------- #
+
+    def neighbor_table(self, offsets=MOORE_OFFSETS, ids=None):
+        """
+        Compute the neighbor ids of tiles with index arithmetic.
+
+        Parameters:
+        offsets (np.ndarray): Array of shape (K, 2) of (row, col) offsets. Defaults to the 8 immediate neighbors in
+        the NEIGHBOR_POSITIONS order.
+        ids (np.ndarray): Tile ids to compute the neighbors of. Defaults to every tile of the grid, in which case the
+        table is indexed by tile id.
+
+        Returns:
+        np.ndarray: An int32 array of shape (N, K) holding the neighbor ids, -1 where the neighbor is outside the grid.
+        """
+        if ids is None:
+            ids = np.arange(self.n_tiles)
+        row, col = self.id_to_row_col(np.asarray(ids, dtype=np.int32))
+
+        table = np.empty((len(row), len(offsets)), dtype=np.int32)
+        for k, (d_row, d_col) in enumerate(offsets):
+            n_row = row + d_row
+            n_col = col + d_col
+            inside = (
+                (n_row >= 0) & (n_row < self.rows) & (n_col >= 0) & (n_col < self.cols)
+            )
+            table[:, k] = np.where(inside, n_row * self.cols + n_col, -1)
+        return table
@@ -0,0 +1,195 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+# Statistics that Neighborhood.aggregate can compute
+NEIGHBORHOOD_STATS = [
+    "mean",
+    "max",
+    "min",
+    "sum",
+    "count",
+    "weighted_sum",
+    "weighted_mean",
+]
+
+
+class Neighborhood:
+    """
+    Neighborhood of a tile on a regular fishnet, described as a stencil of (row, col) offsets with one weight per
+    offset.
+
+    Since the fishnet is an ImplicitGrid, the neighborhood of every tile is the same stencil shifted, so neighbor
+    tables, sparse adjacency matrices and aggregates are computed for the whole grid with one NumPy operation per
+    offset, never per tile.
+    """
+
+    def __init__(self, offsets, weights=None, name="custom"):
+        """
+        Parameters:
+        offsets (array-like): Array of shape (K, 2) of (row, col) offsets relative to the center tile.
+        weights (array-like): Array of shape (K,) of weights for each offset. Defaults to 1 for every offset.
+        name (str): Name of the neighborhood, used to name the aggregated features.
+        """
+        self.offsets = np.asarray(offsets, dtype=np.int32).reshape(-1, 2)
+        if weights is None:
+            weights = np.ones(len(self.offsets))
+        self.weights = np.asarray(weights, dtype=np.float64)
+        if self.weights.shape != (len(self.offsets),):
+            raise ValueError("There must be exactly one weight per offset.")
+        self.name = name
+
+    @classmethod
+    def k_ring(cls, k, include_center=False, weighting=None):
+        """
+        Square neighborhood of all tiles at most k rows and k columns away, i.e. the (2k+1) x (2k+1) window.
+        k=1 gives the 8 immediate neighbors in the NEIGHBOR_POSITIONS order.
+
+        Parameters:
+        k (int): Radius of the ring, in tiles.
+        include_center (bool): Whether the center tile is part of its own neighborhood.
+        weighting (str or callable): None for uniform weights, "inverse_distance" for 1 / distance in tiles, or a
+        function mapping the array of distances (in tiles) to the array of weights.
+        """
+        d_row, d_col = np.meshgrid(
+            np.arange(-k, k + 1), np.arange(-k, k + 1), indexing="ij"
+        )
+        offsets = np.stack([d_row.ravel(), d_col.ravel()], axis=1)
+        return cls._from_offsets(offsets, include_center, weighting, f"ring{k}")
+
+    @classmethod
+    def radius(cls, radius, include_center=False, weighting=None):
+        """
+        Disk neighborhood of all tiles whose center is at most radius tiles away (Euclidean distance).
+
+        Parameters:
+        radius (float): Radius of the disk, in tiles.
+        include_center (bool): Whether the center tile is part of its own neighborhood.
+        weighting (str or callable): See k_ring.
+        """
+        k = int(np.floor(radius))
+        d_row, d_col = np.meshgrid(
+            np.arange(-k, k + 1), np.arange(-k, k + 1), indexing="ij"
+        )
+        offsets = np.stack([d_row.ravel(), d_col.ravel()], axis=1)
+        offsets = offsets[np.hypot(offsets[:, 0], offsets[:, 1]) <= radius]
+        return cls._from_offsets(
+            offsets, include_center, weighting, f"radius{radius:g}"
+        )
+
+    @classmethod
+    def _from_offsets(cls, offsets, include_center, weighting, name):
+        if not include_center:
+            offsets = offsets[(offsets[:, 0] != 0) | (offsets[:, 1] != 0)]
+        distances = np.hypot(offsets[:, 0], offsets[:, 1])
+
+        if weighting is None:
+            weights = np.ones(len(offsets))
+        elif weighting == "inverse_distance":
+            weights = 1 / np.where(distances == 0, 1, distances)
+        elif callable(weighting):
+            weights = weighting(distances)
+        else:
+            raise ValueError(
+                "weighting must be None, 'inverse_distance' or a callable."
+            )
+
+        return cls(offsets, weights, name)
+
+    @property
+    def distances(self):
+        return np.hypot(self.offsets[:, 0], self.offsets[:, 1])
+
+    # -------------------------------------------------------------------------- #
+    #                          Neighbor structures                               #
+    # -------------------------------------------------------------------------- #
+
+    def neighbor_ids(self, grid, ids=None):
+        """
+        Return an (N, K) int32 table of neighbor ids, -1 where the neighbor is outside the grid.
+        """
+        return grid.neighbor_table(self.offsets, ids)
+
+    def to_csr(self, grid, ids=None):
+        """
+        Build the weighted adjacency matrix of the neighborhood.
+
+        Returns:
+        csr_matrix: A sparse matrix of shape (N, grid.n_tiles) whose row i holds the weights of the neighbors of the
+        i-th tile, indexed by neighbor tile id. Multiplying it by a vector of values indexed by tile id gives the
+        weighted sum over the neighborhood of every tile.
+        """
+        table = self.neighbor_ids(grid, ids)
+        valid = table >= 0
+        indptr = np.concatenate([[0], np.cumsum(valid.sum(axis=1))])
+        data = np.broadcast_to(self.weights, table.shape)[valid]
+        return csr_matrix(
+            (data, table[valid], indptr), shape=(len(table), grid.n_tiles)
+        )
+
+    # -------------------------------------------------------------------------- #
+    #                              Aggregation                                   #
+    # -------------------------------------------------------------------------- #
+
+    def aggregate(self, grid, ids, values, stats=("mean",)):
+        """
+        Aggregate a tile feature over the neighborhood of every tile in one vectorized pass.
+
+        The values are laid out on the (rows, cols) raster of the grid, and each offset of the stencil is applied as
+        a shifted view of that raster. Neighbors outside the grid, missing from ids or with a NaN value are ignored.
+
+        Parameters:
+        grid (ImplicitGrid): The grid of the fishnet.
+        ids (np.ndarray): Tile ids of the values.
+        values (np.ndarray): Feature values of the tiles, aligned with ids.
+        stats (list): Statistics to compute, among NEIGHBORHOOD_STATS.
+
+        Returns:
+        dict: A dictionary mapping each statistic to an array aligned with ids. Tiles without any valid neighbor get
+        NaN, except for "sum", "count" and "weighted_sum" which are 0.
+        """
+        unknown = set(stats) - set(NEIGHBORHOOD_STATS)
+        if unknown:
+            raise ValueError(
+                f"Unknown statistics {unknown}. Choose among {NEIGHBORHOOD_STATS}."
+            )
+
+        # Raster of the values, padded with NaN so that every shifted view stays in bounds
+        pad = int(np.abs(self.offsets).max()) if len(self.offsets) else 0
+        raster = np.full((grid.rows + 2 * pad, grid.cols + 2 * pad), np.nan)
+        rows, cols = grid.id_to_row_col(np.asarray(ids))
+        raster[rows + pad, cols + pad] = values
+
+        shape = (grid.rows, grid.cols)
+        count = np.zeros(shape)
+        total = np.zeros(shape)
+        weighted_total = np.zeros(shape)
+        weight_total = np.zeros(shape)
+        maximum = np.full(shape, -np.inf)
+        minimum = np.full(shape, np.inf)
+
+        for (d_row, d_col), weight in zip(self.offsets, self.weights):
+            shifted = raster[
+                pad + d_row : pad + d_row + grid.rows,
+                pad + d_col : pad + d_col + grid.cols,
+            ]
+            valid = ~np.isnan(shifted)
+            filled = np.where(valid, shifted, 0)
+            count += valid
+            total += filled
+            weighted_total += weight * filled
+            weight_total += weight * valid
+            np.fmax(maximum, shifted, out=maximum)
+            np.fmin(minimum, shifted, out=minimum)
+
+        count, total = count[rows, cols], total[rows, cols]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            results = {
+                "mean": np.where(count > 0, total / count, np.nan),
+                "max": np.where(count > 0, maximum[rows, cols], np.nan),
+                "min": np.where(count > 0, minimum[rows, cols], np.nan),
+                "sum": total,
+                "count": count,
+                "weighted_sum": weighted_total[rows, cols],
+                "weighted_mean": weighted_total[rows, cols] / weight_total[rows, cols],
+            }
+        return {stat: results[stat] for stat in stats}
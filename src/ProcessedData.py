@@ -0,0 +1,140 @@
+import os
+import json
+import shutil
+import numpy as np
+
+# pyarrow is optional: it is only needed for the Parquet outputs
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Key of the Parquet schema metadata holding the fishnet, batch and filter information
+METADATA_KEY = b"urbanization_metadata"
+
+
+def _schema():
+    return pa.schema(
+        [
+            ("tile_id", pa.int32()),
+            ("batch_id", pa.int32()),
+            ("year", pa.int16()),
+            ("urbanization_rate", pa.float32()),
+            ("urbanization", pa.float32()),
+            ("ImageXmin", pa.int32()),
+            ("ImageYmin", pa.int32()),
+            ("ImageXmax", pa.int32()),
+            ("ImageYmax", pa.int32()),
+            ("Lat", pa.float64()),
+            ("Lon", pa.float64()),
+        ]
+    )
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to read and write Parquet outputs.")
+
+
+def write_processed_data(
+    data, path, metadata=None, partition_by="year", incremental=False
+):
+    """
+    Write the urbanization dataset as a Parquet dataset partitioned by year or batch_id (hive-style folders
+    year=2017/, batch_id=3/, ...), with typed columns: int32 ids and pixel windows, int16 year, float32 metrics.
+
+    Parameters:
+    data (pd.DataFrame): The urbanization dataset, see ImageProcessor.urbanization_data.
+    path (str): Folder of the dataset.
+    metadata (dict): JSON-serializable information stored in the schema metadata of every file.
+    partition_by (str): "year" or "batch_id".
+    incremental (bool): Whether to add the rows to the existing dataset instead of replacing it. With
+    partition_by="year", the existing partitions of the years of data are replaced. With partition_by="batch_id",
+    the rows must be of years not yet written (see processed_data_years), as each file holds several years.
+    """
+    _require_pyarrow()
+    if partition_by not in ["year", "batch_id"]:
+        raise ValueError("partition_by must be 'year' or 'batch_id'.")
+
+    years = np.unique(data["year"].values)
+    if not incremental:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    elif partition_by == "year":
+        for year in years:
+            partition = os.path.join(path, f"year={year}")
+            if os.path.exists(partition):
+                shutil.rmtree(partition)
+    else:
+        overlap = processed_data_years(path) & set(int(year) for year in years)
+        if overlap:
+            raise ValueError(
+                f"Years {sorted(overlap)} are already written: rewrite the dataset with incremental=False."
+            )
+
+    schema = _schema().with_metadata({METADATA_KEY: json.dumps(metadata or {})})
+    table = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+    # Files are named after the years they hold, so new years never overwrite existing files
+    basename = f"part-{years.min()}-{years.max()}-{{i}}.parquet" if len(years) else None
+    pq.write_to_dataset(
+        table,
+        path,
+        partition_cols=[partition_by],
+        basename_template=basename,
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    pq.write_metadata(schema, os.path.join(path, "_common_metadata"))
+
+
+def _dataset(path):
+    return ds.dataset(
+        path,
+        schema=_schema(),
+        format="parquet",
+        partitioning="hive",
+        exclude_invalid_files=True,
+    )
+
+
+def read_processed_data(path, years=None, batch_ids=None, columns=None):
+    """
+    Read the urbanization dataset, only loading the partitions and row groups of the requested years and batches.
+
+    Returns:
+    pd.DataFrame: The selected rows, sorted by tile_id and year.
+    """
+    _require_pyarrow()
+    expression = None
+    if years is not None:
+        expression = ds.field("year").isin(list(years))
+    if batch_ids is not None:
+        batch_filter = ds.field("batch_id").isin(list(batch_ids))
+        expression = batch_filter if expression is None else expression & batch_filter
+
+    table = _dataset(path).to_table(columns=columns, filter=expression)
+    data = table.to_pandas()
+    sort_by = [column for column in ["tile_id", "year"] if column in data.columns]
+    return data.sort_values(sort_by, kind="stable", ignore_index=True)
+
+
+def processed_data_years(path):
+    """
+    Years already written in the urbanization dataset, reading the year column only.
+    """
+    _require_pyarrow()
+    if not os.path.exists(path):
+        return set()
+    years = _dataset(path).to_table(columns=["year"])["year"]
+    return set(int(year) for year in years.unique().to_pylist())
+
+
+def processed_data_metadata(path):
+    """
+    Fishnet, batch and filter information stored with the urbanization dataset.
+    """
+    _require_pyarrow()
+    schema = pq.read_schema(os.path.join(path, "_common_metadata"))
+    return json.loads(schema.metadata[METADATA_KEY])
@@ -0,0 +1,159 @@
+import numpy as np
+from PIL import Image
+from DynamicWorld import pack_labels, unpack_labels
+
+# tifffile (and zarr) are optional: without them every image is fully decoded with PIL
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+
+def _is_tiff(path):
+    return tifffile is not None and path.lower().endswith((".tif", ".tiff"))
+
+
+def _packed_width(tif):
+    # Width of the class-index raster stored with 4-bit packed labels, None for a regular image
+    metadata = tif.shaped_metadata
+    if metadata and metadata[0].get("packed_labels"):
+        return metadata[0]["width"]
+    return None
+
+
+def _is_planar(tif):
+    # Whether the samples of each pixel are stored band by band (planar configuration "separate"), which tifffile
+    # returns as (C, H, W) rather than the (H, W, C) layout of every other reader
+    page = tif.pages[0]
+    return len(page.shape) == 3 and page.axes.startswith("S")
+
+
+def _samples_last(raster):
+    # (C, H, W) -> (H, W, C), as a view of the memory-mapped or decoded array
+    return np.moveaxis(raster, 0, -1)
+
+
+def image_shape(path):
+    """
+    Return the (height, width, ...) shape of an image by reading its header only.
+    """
+    if _is_tiff(path):
+        with tifffile.TiffFile(path) as tif:
+            shape = tif.pages[0].shape
+            width = _packed_width(tif)
+            if _is_planar(tif):
+                shape = shape[1:] + shape[:1]
+        return shape if width is None else (shape[0], width)
+
+    with Image.open(path) as img:
+        width, height = img.size
+        bands = len(img.getbands())
+    return (height, width) if bands == 1 else (height, width, bands)
+
+
+def _open(path, windowed):
+    # Return the stored pixels of an image, without decoding them when possible, and the packed width if any
+    if _is_tiff(path):
+        with tifffile.TiffFile(path) as tif:
+            width = _packed_width(tif)
+            planar = _is_planar(tif)
+        try:
+            raster = tifffile.memmap(path, mode="r")
+        except ValueError:
+            # Compressed or non-contiguous image data cannot be memory-mapped. A zarr array cannot be transposed
+            # lazily, so planar images are fully decoded instead
+            if windowed and zarr is not None and not planar:
+                return zarr.open(tifffile.imread(path, aszarr=True), mode="r"), width
+            raster = tifffile.imread(path)
+        return (_samples_last(raster) if planar else raster), width
+
+    with Image.open(path) as img:
+        return np.asarray(img, dtype=np.uint8), None
+
+
+def read_image(path):
+    """
+    Read a whole batch image as a uint8 array.
+
+    Uncompressed, contiguous GeoTIFFs are memory-mapped read-only, so no pixel is decoded or copied until it is
+    accessed. Other images are decoded once into a uint8 array. Class-index rasters written with 4-bit packed labels
+    are unpacked, and band-interleaved (planar) GeoTIFFs are returned pixel-interleaved like any other image. The
+    result must be treated as read-only.
+
+    Args:
+        path (str): Path of the image.
+
+    Returns:
+        np.ndarray: An (H, W) or (H, W, C) uint8 array (a np.memmap when the file could be memory-mapped).
+    """
+    raster, width = _open(path, windowed=False)
+    if width is not None:
+        return unpack_labels(raster, width)
+    return raster
+
+
+def open_raster(path):
+    """
+    Open an image for windowed reads, without decoding it when possible.
+
+    Uncompressed GeoTIFFs are memory-mapped, and tiled or striped compressed GeoTIFFs are opened as a read-only
+    zarr array (when zarr is installed) whose slices only decode the chunks they overlap. Other images, including
+    compressed band-interleaved GeoTIFFs, are fully decoded once. In every case the result is laid out as
+    (H, W) or (H, W, C), and slicing it returns the uint8 pixels of the window.
+    """
+    return _open(path, windowed=True)[0]
+
+
+def read_windows(path, windows):
+    """
+    Read the pixels of several (xmin, ymin, xmax, ymax) windows of an image, without decoding the rest of the image
+    when the file format allows it.
+
+    Returns:
+        list: One uint8 array per window (views of the memory-mapped file when the image is uncompressed and its
+        labels are not packed).
+    """
+    raster, width = _open(path, windowed=True)
+    if width is None:
+        return [raster[ymin:ymax, xmin:xmax] for xmin, ymin, xmax, ymax in windows]
+
+    subimages = []
+    for xmin, ymin, xmax, ymax in windows:
+        xmax = min(xmax, width)
+        packed = np.asarray(raster[ymin:ymax, xmin // 2 : (xmax + 1) // 2])
+        subimages.append(
+            unpack_labels(packed, 2 * packed.shape[1])[:, xmin % 2 :][:, : xmax - xmin]
+        )
+    return subimages
+
+
+def write_class_raster(path, class_raster, packed=False):
+    """
+    Write a class-index raster as a single-band uint8 GeoTIFF, one label per pixel.
+
+    Args:
+        path (str): Path of the image.
+        class_raster (np.ndarray): An (H, W) uint8 raster of class indices.
+        packed (bool): Whether to store two 4-bit labels per byte, halving the file size. read_image and
+        read_windows unpack such rasters transparently.
+    """
+    class_raster = np.asarray(class_raster, dtype=np.uint8)
+    if not packed:
+        if tifffile is not None:
+            tifffile.imwrite(path, class_raster)
+        else:
+            Image.fromarray(class_raster).save(path)
+        return
+
+    if tifffile is None:
+        raise ImportError("tifffile is required to write packed class rasters.")
+    tifffile.imwrite(
+        path,
+        pack_labels(class_raster),
+        metadata={"packed_labels": True, "width": class_raster.shape[1]},
+    )
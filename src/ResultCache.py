@@ -0,0 +1,196 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+
+# File of the cache folder memoizing the content digest of input files, keyed by path, modification time and size
+DIGESTS_FILE = "digests.json"
+
+
+class ResultCache:
+    """
+    Persistent, content-addressed cache of the results of the processing stages (corrected images, pixel windows,
+    tile statistics).
+
+    Entries are keyed by a hash of everything the result depends on: the content digest of the input files and
+    the parameters of the computation, e.g. the tile and batch bounds derived from the fishnet tile size, batch size
+    and region. Changing a parameter or an input file therefore misses the cache, while rerunning an unchanged stage
+    hits it. Entries are pickled files, evicted in least recently used order once the cache exceeds max_bytes. The
+    total size of the entries is measured once and then tracked in memory, so the entries folder is only walked
+    again when the cache is over budget.
+    """
+
+    def __init__(self, folder, max_bytes=10 * 2**30):
+        """
+        Parameters:
+        folder (str): Folder of the cache, created if needed.
+        max_bytes (int): Maximum total size of the entries. None for no limit.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._digests = None
+        self._digests_changed = False
+        self._size = None
+        os.makedirs(os.path.join(folder, "entries"), exist_ok=True)
+
+    # -------------------------------------------------------------------------- #
+    #                                  Keys                                      #
+    # -------------------------------------------------------------------------- #
+
+    def key(self, *parts):
+        """
+        Hash the parts a result depends on (strings, numbers, NumPy arrays, and lists, tuples or dicts of them).
+        """
+        h = hashlib.sha256()
+        self._update(h, parts)
+        return h.hexdigest()
+
+    def _update(self, h, part):
+        if isinstance(part, np.ndarray):
+            h.update(f"ndarray{part.dtype.str}{part.shape}".encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        elif isinstance(part, dict):
+            h.update(b"dict")
+            for k in sorted(part, key=repr):
+                self._update(h, k)
+                self._update(h, part[k])
+        elif isinstance(part, (list, tuple)):
+            h.update(f"{type(part).__name__}{len(part)}".encode())
+            for item in part:
+                self._update(h, item)
+        else:
+            h.update(repr(part).encode())
+
+    def file_digest(self, path):
+        """
+        SHA-256 digest of the content of a file.
+
+        Digests are memoized in DIGESTS_FILE by path, modification time and size, so unchanged files are only hashed
+        once. New digests are written to DIGESTS_FILE by flush.
+        """
+        if self._digests is None:
+            digests_path = os.path.join(self.folder, DIGESTS_FILE)
+            self._digests = {}
+            if os.path.exists(digests_path):
+                with open(digests_path) as f:
+                    self._digests = json.load(f)
+
+        stat = os.stat(path)
+        signature = [stat.st_mtime_ns, stat.st_size]
+        memo = self._digests.get(os.path.abspath(path))
+        if memo is not None and memo["signature"] == signature:
+            return memo["digest"]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 23), b""):
+                h.update(block)
+        self._digests[os.path.abspath(path)] = {
+            "signature": signature,
+            "digest": h.hexdigest(),
+        }
+        self._digests_changed = True
+        return h.hexdigest()
+
+    def file_signature(self, path):
+        """
+        Path, modification time and size of a file, a cheap key part for results that only depend on the file
+        header (e.g. the image shape), for which hashing the whole content is not worth it.
+        """
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+
+    def flush(self):
+        """
+        Write the digests memoized since the last flush to DIGESTS_FILE.
+        """
+        if not self._digests_changed:
+            return
+        digests_path = os.path.join(self.folder, DIGESTS_FILE)
+        temporary_path = f"{digests_path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump(self._digests, f)
+        os.replace(temporary_path, digests_path)
+        self._digests_changed = False
+
+    # -------------------------------------------------------------------------- #
+    #                                 Entries                                    #
+    # -------------------------------------------------------------------------- #
+
+    def _entry_path(self, key):
+        return os.path.join(self.folder, "entries", key[:2], key + ".pkl")
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def get(self, key, default=None):
+        """
+        Return the value stored under key, or default on a miss. A hit marks the entry as recently used.
+        """
+        path = self._entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return default
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        """
+        Store a value under key, then evict the least recently used entries if the cache is too large.
+        """
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self._size is None:
+            self._size = self._entries_size()
+        if os.path.exists(path):
+            self._size -= os.path.getsize(path)
+        self._size += os.path.getsize(temporary_path)
+        os.replace(temporary_path, path)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def _entries_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _entries(self):
+        # (last use time, size, path) of every entry
+        entries = []
+        for root, _, files in os.walk(os.path.join(self.folder, "entries")):
+            for file in files:
+                if file.endswith(".pkl"):
+                    stat = os.stat(os.path.join(root, file))
+                    entries.append(
+                        (stat.st_mtime, stat.st_size, os.path.join(root, file))
+                    )
+        return entries
+
+    def evict(self, max_bytes):
+        """
+        Delete the least recently used entries until the entries take at most max_bytes.
+        """
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            os.remove(path)
+            total -= size
+        self._size = total
+
+    def clear(self):
+        self.evict(0)
+
+    def __getstate__(self):
+        # The memoized digests and the size of the entries are reloaded lazily instead of being sent to worker
+        # processes
+        state = self.__dict__.copy()
+        state["_digests"] = None
+        state["_digests_changed"] = False
+        state["_size"] = None
+        return state
@@ -3,7 +3,61 @@ import pandas as pd
 from PIL import Image, ImageOps
 from tensorflow.keras.utils import Sequence
 import os
+import time
+from collections import OrderedDict, deque
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 import imageio
+from DynamicWorld import class_to_rgb, class_to_gray, rgb_to_class, to_class_raster
+from RasterReader import read_image
+from TileCube import TileCube
+
+# Loader of the current worker process, set once per process by the prefetch pool initializer
+_worker_loader = None
+
+
+def _init_worker(loader):
+    global _worker_loader
+    _worker_loader = loader
+
+
+def _assemble_batch(batch, slot):
+    return _worker_loader._assemble(batch, slot)
+
+
+class _TileBatches:
+    """
+    Batches of an epoch, split at batch_size boundaries from the tiles of the epoch in order. Each batch is built on
+    request as a dictionary of region keys and arrays of tile ids, the regions in their order of the epoch.
+    """
+
+    def __init__(self, keys, tile_ids, region_position, batch_size):
+        self.keys = keys
+        self.tile_ids = tile_ids
+        self.region_position = region_position
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return int(np.ceil(len(self.tile_ids) / self.batch_size))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Batch index out of range.")
+        batch = slice(index * self.batch_size, (index + 1) * self.batch_size)
+        order = np.argsort(self.region_position[batch], kind="stable")
+        tile_ids = self.tile_ids[batch][order]
+        regions = self.region_position[batch][order]
+
+        starts = np.flatnonzero(np.diff(regions, prepend=-1))
+        stops = np.append(starts[1:], len(regions))
+        return {
+            self.keys[regions[start]]: tile_ids[start:stop]
+            for start, stop in zip(starts, stops)
+        }
 
 
 class SequenceDataLoader(Sequence):
@@ -24,6 +78,15 @@ class SequenceDataLoader(Sequence):
         n_channels=1,
         shuffle=True,
         tab_data=None,
+        store="tiff",
+        workers=0,
+        prefetch=2,
+        use_processes=False,
+        cache_bytes=0,
+        batch_order="shuffle",
+        shuffle_mode="regions",
+        dtype="float32",
+        n_buffers=0,
     ):
         """Initialization
 
@@ -34,6 +97,28 @@ class SequenceDataLoader(Sequence):
         :param dim: tuple indicating image dimension
         :param n_channels: number of image channels
         :param shuffle: True to shuffle label indexes after every epoch
+        :param store: "tiff" to crop the tiles from the region images in image_dir, or "cube" to slice them from
+            the TileCube stored in image_dir (written by ImageProcessor.cnn_partition_images with store="cube")
+        :param workers: number of background workers assembling the next batches while the current one trains, 0 to
+            assemble each batch on the calling thread
+        :param prefetch: number of batches assembled ahead of the requested one (queue depth), following the
+            order of set_index_order. The loader shuffles the batches itself every epoch, so Keras should request
+            them in order (fit(..., shuffle=False))
+        :param use_processes: True to assemble batches in worker processes instead of threads
+        :param cache_bytes: byte budget of the cache of decoded, quantized region images keyed by (label, region),
+            evicted in least recently used order. 0 to disable the cache
+        :param batch_order: "shuffle" to visit the regions in a new random order every epoch, or "cache" to start
+            every epoch with the regions still in the cache (most recently used first) and shuffle the others
+        :param shuffle_mode: how the tiles are shuffled when shuffle is True. "regions" to only shuffle the order of
+            the regions, "within_regions" to also shuffle the tiles inside each region, or "balanced" to interleave
+            the (shuffled) tiles of all regions, so every batch samples the regions evenly. The first two keep the
+            tiles of a region together, which the region cache benefits from
+        :param dtype: "float32" for images normalized to [0, 1], or "uint8" for raw gray levels (or RGB values),
+            4 times smaller, to be normalized by the model
+        :param n_buffers: number of preallocated output buffers reused in turn (ring buffer), 0 to allocate the
+            arrays of every batch. A returned batch is a view of its buffer, which stays valid while the next
+            n_buffers - 1 batches are requested (n_buffers - prefetch - 1 with workers, so n_buffers must then be at
+            least prefetch + 2). A batch for which every buffer is still in use gets new arrays
         """
         self.labels = labels
         self.list_IDs = list_IDs  # name of all batch_IDs
@@ -41,19 +126,81 @@ class SequenceDataLoader(Sequence):
         self.tile_region_dic = tile_region_dic
         self.tile_coordinates = tile_coordinates
         self.image_dir = image_dir
+        self.cube = TileCube(image_dir) if store == "cube" else None
         self.batch_size = batch_size
         self.dim = dim
         self.n_channels = n_channels
         self.shuffle = shuffle
+        self.tab_data = tab_data
+        self.workers = workers
+        self.prefetch = prefetch
+        self.use_processes = use_processes
+        self._executor = None
+        self._pending = {}
+        self._dropped = []
+        self.index_order = None
+        self._order_position = None
+        self._lock = threading.Lock()
+        self.stall_time = 0.0
+        self.n_served = 0
+        self.cache_bytes = cache_bytes
+        self.batch_order = batch_order
+        self.shuffle_mode = shuffle_mode
+        self._region_cache = OrderedDict()
+        self._region_cache_size = 0
+        self._cache_lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.dtype = np.dtype(dtype)
+        self.n_buffers = n_buffers
+        self._buffers = {}
+        self._n_slots_assigned = 0
+        self._future_slots = {}
         self._init_params()
         self.on_epoch_end()
-        self.tab_data = tab_data
 
     def _init_params(self):
+        if self.batch_order not in ["shuffle", "cache"]:
+            raise ValueError("batch_order must be 'shuffle' or 'cache'.")
+        if self.shuffle_mode not in ["regions", "within_regions", "balanced"]:
+            raise ValueError(
+                "shuffle_mode must be 'regions', 'within_regions' or 'balanced'."
+            )
+        if self.dtype not in [np.float32, np.uint8]:
+            raise ValueError("dtype must be 'float32' or 'uint8'.")
+        if self.n_buffers and self.workers > 0 and self.n_buffers < self.prefetch + 2:
+            raise ValueError("n_buffers must be at least prefetch + 2 with workers.")
+        # Slots of the last returned batches, which are not reused while the caller may still read them
+        in_flight = self.prefetch + 1 if self.workers > 0 else 1
+        self._served_slots = deque(maxlen=max(self.n_buffers - in_flight, 0))
         self.N_regions = len(self.tile_region_dic)
         self.N_fishnets = len(self.tile_coordinates)
         self.N_labels = len(self.labels)
 
+        # Tiles of every region, in the order of list_IDs, as one array with the offset of each region
+        region_tiles = [
+            np.asarray(self.tile_region_dic[key], dtype=np.int64)
+            for key in self.list_IDs
+        ]
+        self._region_sizes = np.array([len(tiles) for tiles in region_tiles])
+        self._region_offsets = np.concatenate([[0], np.cumsum(self._region_sizes)])
+        self._region_tiles = (
+            np.concatenate(region_tiles) if region_tiles else np.empty(0, np.int64)
+        )
+
+        # Targets and tabular features as arrays, gathered for a batch with a single fancy index
+        self._tile_ids = np.unique(self._region_tiles)
+        if isinstance(self.target, np.ndarray):
+            self._target_values = self.target[self._tile_ids].astype(np.float32)
+        else:
+            self._target_values = np.array(
+                [self.target[tile_id] for tile_id in self._tile_ids.tolist()],
+                dtype=np.float32,
+            )
+        self._tab_matrix = None
+        if self.tab_data is not None:
+            self._tab_matrix = np.asarray(self.tab_data, dtype=np.float32)
+
     def __len__(self):
         """Denotes the number of batches per epoch
 
@@ -65,151 +212,388 @@ class SequenceDataLoader(Sequence):
     def __getitem__(self, index):
         """Generate one batch of data
 
+        With workers > 0, the batch and the next ones are assembled in the background, so the batch is usually ready
+        when requested. The time spent waiting for it is accumulated in stall_time.
+
         :param index: index of the batch
         :return: X and y when fitting. X only when predicting
         """
-        # Generate indexes of the batch
-        # indexes = self.tile_indexes[
-        #     index * self.batch_size : (index + 1) * self.batch_size
-        # ]
-
-        # Find list of IDs --> These are the batch_IDs that we want to load in this batch
-        # list_IDs_temp = [self.list_IDs[k] for k in indexes]
-
-        batch = self.batches[index]
+        start = time.perf_counter()
+        if self.workers > 0:
+            future = self._prefetch(index)
+            X, y = future.result()
+        else:
+            with self._lock:
+                slot = self._slot()
+                if slot is not None:
+                    self._served_slots.append(slot)
+            X, y = self._assemble(self.batches[index], slot)
+
+        # Time the caller waited for the batch, i.e. the time the accelerator was not fed
+        self.stall_time += time.perf_counter() - start
+        self.n_served += 1
+        return X, y
 
-        # Generate data
-        X = self._generate_X(batch)
-        y = self._generate_y(batch)
+    def _assemble(self, batch, slot=None):
+        X = self._generate_X(batch, slot)
+        y = self._generate_y(batch, slot)
 
         if self.tab_data is not None:
-            X = (X, self._generate_X_tab(batch))
+            X = (X, self._generate_X_tab(batch, slot))
 
         return X, y
 
+    def _slot(self):
+        """
+        Ring buffer slot of the next assembled batch: the next slot in turn that no pending, still running or
+        recently returned batch uses. None when the arrays of every batch are allocated, or every slot is in use
+        """
+        if not self.n_buffers:
+            return None
+        self._prune_dropped()
+        in_use = set(self._served_slots)
+        in_use.update(self._future_slots[future] for future in self._pending.values())
+        in_use.update(self._future_slots[future] for future in self._dropped)
+        for k in range(self.n_buffers):
+            slot = (self._n_slots_assigned + k) % self.n_buffers
+            if slot not in in_use:
+                self._n_slots_assigned += k + 1
+                return slot
+        return None
+
+    def _buffer(self, slot, name, shape, dtype):
+        """
+        Output array of a batch: a view of the preallocated buffer of its slot, or a new array without slot
+        """
+        if slot is None:
+            return np.empty(shape, dtype)
+        buffer = self._buffers.get((slot, name))
+        if buffer is None or buffer.shape[1:] != shape[1:]:
+            buffer = np.empty((self.batch_size,) + shape[1:], dtype)
+            self._buffers[(slot, name)] = buffer
+        return buffer[: shape[0]]
+
+    def set_index_order(self, order=None):
+        """
+        Set the order in which the batches of the epoch will be requested, which the prefetching follows.
+
+        The order is kept across epochs, as the number of batches does not change.
+
+        :param order: permutation of the batch indexes, None for 0, 1, 2, ...
+        """
+        position = None
+        if order is not None:
+            order = np.asarray(order, dtype=np.int64)
+            if not np.array_equal(np.sort(order), np.arange(len(self.batches))):
+                raise ValueError("order must be a permutation of the batch indexes.")
+            position = np.empty(len(order), dtype=np.int64)
+            position[order] = np.arange(len(order))
+        with self._lock:
+            self.index_order = order
+            self._order_position = position
+
+    def _upcoming(self, index):
+        # The requested batch and the next self.prefetch ones in the order of the epoch
+        if self.index_order is None:
+            return list(range(index, min(index + self.prefetch + 1, len(self.batches))))
+        position = self._order_position[index]
+        return self.index_order[position : position + self.prefetch + 1].tolist()
+
+    def _prefetch(self, index):
+        """
+        Submit the requested batch and the next self.prefetch ones to the worker pool, and return the future of
+        the requested batch. Pending batches that are not among them (already passed, or prefetched for another
+        order of access) are dropped.
+        """
+        with self._lock:
+            if self._executor is None:
+                if self.use_processes:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        initializer=_init_worker,
+                        initargs=(self,),
+                    )
+                else:
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+
+            upcoming = self._upcoming(index)
+            for i in list(self._pending):
+                if i not in upcoming:
+                    self._drop(self._pending.pop(i))
+
+            for i in upcoming:
+                if i not in self._pending:
+                    batch, slot = self.batches[i], self._slot()
+                    if self.use_processes:
+                        future = self._executor.submit(_assemble_batch, batch, slot)
+                    else:
+                        future = self._executor.submit(self._assemble, batch, slot)
+                    self._pending[i] = future
+                    self._future_slots[future] = slot
+
+            # The slot of the returned batch stays in use while the caller may read it
+            future = self._pending.pop(index)
+            slot = self._future_slots.pop(future)
+            if slot is not None:
+                self._served_slots.append(slot)
+            return future
+
+    def stall_report(self):
+        """
+        Time spent waiting for batches since the beginning of the epoch.
+
+        :return: dict with the number of batches served, the total stall time and the mean stall time per batch
+        """
+        return {
+            "batches": self.n_served,
+            "stall_time": self.stall_time,
+            "mean_stall_time": self.stall_time / max(self.n_served, 1),
+        }
+
+    def close(self):
+        """Shut the prefetch workers down"""
+        self._cancel_pending()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _drop(self, future):
+        # Batches already being assembled cannot be cancelled: they are kept, with their slot, until they are done
+        if not future.cancel():
+            self._dropped.append(future)
+        else:
+            del self._future_slots[future]
+        self._prune_dropped()
+
+    def _prune_dropped(self):
+        # Dropped batches release their slot once they are done
+        for future in [future for future in self._dropped if future.done()]:
+            self._dropped.remove(future)
+            del self._future_slots[future]
+
+    def _cancel_pending(self):
+        # Batches prefetched for the previous epoch are stale once the batches are rebuilt, and the running ones
+        # are waited for, so that no worker is still reading the batches of the previous epoch
+        with self._lock:
+            for future in self._pending.values():
+                self._drop(future)
+            self._pending = {}
+            wait(self._dropped)
+            self._dropped = []
+            self._future_slots = {}
+
+    def __getstate__(self):
+        # Worker processes receive the loader without its pool and pending batches
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        state["_pending"] = {}
+        state["_dropped"] = []
+        state["_future_slots"] = {}
+        state["_region_cache"] = OrderedDict()
+        state["_region_cache_size"] = 0
+        state["_buffers"] = {}
+        del state["_lock"], state["_cache_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+
     def on_epoch_end(self):
         """Updates indexes after each epoch"""
+        self._cancel_pending()
+        self.last_stall_report = self.stall_report()
+        self.stall_time = 0.0
+        self.n_served = 0
         self.region_indexes = np.arange(len(self.list_IDs))
         if self.shuffle == True:
             np.random.shuffle(self.region_indexes)
+        if self.batch_order == "cache":
+            self.region_indexes = self._cached_regions_first(self.region_indexes)
         self.create_batches()
 
+    def _region_key(self, region_index):
+        return self.list_IDs[region_index]
+
+    def _cached_regions_first(self, region_indexes):
+        # The regions used last in the previous epoch are still cached: visiting them first turns them into hits
+        with self._cache_lock:
+            cached = list(dict.fromkeys(key[1] for key in reversed(self._region_cache)))
+        position = {self._region_key(i): i for i in region_indexes}
+        first = [position[key] for key in cached if key in position]
+        rest = region_indexes[~np.isin(region_indexes, first)]
+        return np.concatenate([np.array(first, dtype=region_indexes.dtype), rest])
+
     def create_batches(self):
         """
         Create batches of tiles for each region based on a specified batch size.
 
-        This method generates a list of batches, where each batch is a dictionary with
-        region IDs as keys and lists of corresponding tiles as values. Each tile ID
-        appears only once across all the batches. The method iterates through the
-        specified region IDs in the order provided in 'region_indexes' and assigns
-        tiles to each region until a batch reaches the maximum batch size.
+        This method generates the batches of the epoch, where each batch is a dictionary
+        with region IDs as keys and arrays of corresponding tiles as values. Each tile ID
+        appears only once across all the batches. The tiles of the regions are
+        concatenated in the order provided in 'region_indexes', reordered according
+        to 'shuffle_mode', and split at batch_size boundaries with array operations;
+        the dictionary of a batch is only built when the batch is requested.
 
         Returns:
-            None: The method stores the generated list of batches in 'self.batches'.
+            None: The method stores the sequence of batches in 'self.batches'.
         """
-        batches = []
-        current_batch = {}
-        current_batch_size = 0
-
-        for region_id in self.region_indexes:
-            key = "landcover_batchID_" + str(region_id)
-            tiles = self.tile_region_dic[key]
-
-            for tile_id in tiles:
-                if tile_id not in current_batch.values():
-                    current_batch.setdefault(key, []).append(tile_id)
-                    current_batch_size += 1
-
-                    if current_batch_size >= self.batch_size:
-                        batches.append(current_batch)
-                        current_batch = {}
-                        current_batch_size = 0
-
-        if current_batch:
-            batches.append(current_batch)
-
-        print("Success. Completed creating batches.")
-        self.batches = batches
-
-    def _generate_y(self, batch):
-        # Initialization
-        regionLengths = [len(v) for v in batch.values()]
-        y = np.empty(sum(regionLengths))
-
-        # Generate data
-        cursor = 0
-        for regionID, tileIDs in batch.items():
-            for tileID in tileIDs:
-                y[cursor] = self.target[tileID]
-                cursor += 1
-
+        order = np.asarray(self.region_indexes, dtype=np.int64)
+        sizes = self._region_sizes[order]
+
+        # Position of every tile in the concatenation of the regions, and its region (as a position in order)
+        region_position = np.repeat(np.arange(len(order)), sizes)
+        tile_positions = np.repeat(
+            self._region_offsets[order] - np.cumsum(sizes) + sizes, sizes
+        ) + np.arange(sizes.sum())
+
+        if self.shuffle and self.shuffle_mode != "regions":
+            # Shuffle inside each region, keeping the regions in order
+            tile_positions = tile_positions[
+                np.argsort(region_position + np.random.random(len(region_position)))
+            ]
+            if self.shuffle_mode == "balanced":
+                # Round-robin over the regions: the k-th tile of every region, then the (k+1)-th, ...
+                rank = np.arange(len(tile_positions)) - np.repeat(
+                    np.cumsum(sizes) - sizes, sizes
+                )
+                tile_order = np.argsort(rank * len(order) + region_position)
+                tile_positions = tile_positions[tile_order]
+                region_position = region_position[tile_order]
+
+        self.batches = _TileBatches(
+            [self._region_key(i) for i in order],
+            self._region_tiles[tile_positions],
+            region_position,
+            self.batch_size,
+        )
+
+    def _batch_tile_ids(self, batch):
+        return np.concatenate([np.asarray(tileIDs) for tileIDs in batch.values()])
+
+    def _generate_y(self, batch, slot=None):
+        tile_ids = self._batch_tile_ids(batch)
+        y = self._buffer(slot, "y", (len(tile_ids),), np.float32)
+        np.take(self._target_values, np.searchsorted(self._tile_ids, tile_ids), out=y)
         return y
 
-    def _generate_X(self, batch):
+    def _generate_X(self, batch, slot=None):
         """Generates data containing batch_size images
 
-        :param list_IDs_temp: list of label ids to load
+        :param batch: dictionary of region IDs and tile IDs to load
+        :param slot: ring buffer slot to write the images to, None to allocate them
         :return: batch of images
         """
-        # [len(self.tile_region_dic[ID]) for ID in list_IDs_temp]
         regionLengths = [len(v) for v in batch.values()]
-        X = np.empty((sum(regionLengths), len(self.labels), *self.dim, self.n_channels))
-
-        # Generate data
+        X = self._buffer(
+            slot,
+            "X",
+            (sum(regionLengths), self.N_labels, *self.dim, self.n_channels),
+            self.dtype,
+        )
+
+        # Each region is written straight into its rows of the batch
         cursor = 0
         for regionID, tileIDs in batch.items():
-            X[cursor : cursor + len(tileIDs), :] = self._load_region(regionID, tileIDs)
+            self._load_region(regionID, tileIDs, out=X[cursor : cursor + len(tileIDs)])
             cursor += len(tileIDs)
 
         return X
 
-    def _generate_X_tab(self, batch):
-        X_tab = pd.DataFrame()
-        for regionID, tileIDs in batch.items():
-            for ID in tileIDs:
-                # X_tab = X_tab.append(self.tab_data[ID], ignore_index=True)
-                X_tab = pd.concat([X_tab, self.tab_data.iloc[ID]], ignore_index=True)
-
+    def _generate_X_tab(self, batch, slot=None):
+        tile_ids = self._batch_tile_ids(batch)
+        X_tab = self._buffer(
+            slot, "X_tab", (len(tile_ids), self._tab_matrix.shape[1]), np.float32
+        )
+        np.take(self._tab_matrix, tile_ids, axis=0, out=X_tab)
         return X_tab
 
-    def _load_region(self, regionID, tileIDs):
+    def _load_region(self, regionID, tileIDs, out=None):
         """
-        Load a region from the image directory
+        Load a region from the image directory into out, an array of shape (len(tileIDs), N_labels, *dim, n_channels)
         """
-        # N is the number of fishnet in that region
-        # fishnetIDs = self.tile_region_dic[regionID]
         N = len(tileIDs)
-        X = np.empty(
-            (N, self.N_labels, self.dim[0], self.dim[1], self.n_channels)
-        )  # dim [X, 6, 40, 44, 1]
+        if out is None:
+            out = np.empty(
+                (N, self.N_labels, self.dim[0], self.dim[1], self.n_channels),
+                self.dtype,
+            )  # dim [X, 6, 40, 44, 1]
+        tile_shape = (self.dim[0], self.dim[1], self.n_channels)
 
         for i, label in enumerate(self.labels):
-            region_path = os.path.join(
-                self.image_dir,
-                str(label),
-                "Final",
-                f"{regionID}.tif",
-            )
-            img = Image.open(region_path)
-            if self.n_channels == 1:
-                # Convert the image to grayscale with custom separation
-                num_colors = 9
-                color_separation = 255.0 / (num_colors - 1)
-                img = img.convert("L", palette=Image.ADAPTIVE, colors=num_colors - 1)
-                img = Image.eval(
-                    img, lambda x: int(x // color_separation) * color_separation
+            if self.cube is not None:
+                # Fixed-size crops of the tiles, sliced from the chunks of the cube and converted in one call
+                crops = self.cube.get_many(tileIDs, label)
+                if crops.shape[1] < self.dim[0] or crops.shape[2] < self.dim[1]:
+                    raise ValueError(
+                        f"The tiles of the cube are {crops.shape[1:3]} pixels, smaller than dim={self.dim}."
+                    )
+                crops = crops[:, : self.dim[0], : self.dim[1]]
+                out[:, i] = self._prepare_image(crops, stacked=True).reshape(
+                    (N,) + tile_shape
                 )
-                # img = img.convert("L")  # convert to grayscale
-            img = np.array(img) / 255.0
+                continue
+
+            img = self._region_image(label, regionID)
 
             for j, tileID in enumerate(tileIDs):
                 coordinates = self.tile_coordinates[tileID]
                 sub_img = self._crop_image(img, tileID, regionID, coordinates)
-                X[j, i, :, :, :] = np.array(sub_img).reshape(
-                    self.dim[0], self.dim[1], self.n_channels
-                )
+                out[j, i] = sub_img.reshape(tile_shape)
 
-        return X
+        return out
+
+    def _region_image(self, label, regionID):
+        """
+        Decoded, quantized image of a region for one label, from the region cache when possible
+        """
+        key = (label, regionID)
+        with self._cache_lock:
+            img = self._region_cache.get(key)
+            if img is not None:
+                self._region_cache.move_to_end(key)
+                self.cache_hits += 1
+                return img
+            self.cache_misses += 1
+
+        region_path = os.path.join(
+            self.image_dir,
+            str(label),
+            "Final",
+            f"{regionID}.tif",
+        )
+        img = self._prepare_image(read_image(region_path))
+        if img.nbytes > self.cache_bytes:
+            return img
+
+        with self._cache_lock:
+            if key not in self._region_cache:
+                self._region_cache[key] = img
+                self._region_cache_size += img.nbytes
+            while self._region_cache_size > self.cache_bytes:
+                _, evicted = self._region_cache.popitem(last=False)
+                self._region_cache_size -= evicted.nbytes
+        return img
+
+    def _prepare_image(self, img, stacked=False):
+        """
+        Convert an RGB image or a class-index raster into normalized model input. With stacked=True, img is an
+        (n, height, width, ...) block of images converted at once
+        """
+        img = np.asarray(img)
+        normalize = self.dtype == np.float32
+        class_raster = img.ndim == (3 if stacked else 2)
+        if self.n_channels == 1:
+            # Fixed gray level per class, identical across images and years
+            if not class_raster:
+                img = rgb_to_class(img)
+            return class_to_gray(img, normalize=normalize)
+        if class_raster:
+            # Class-index raster: render it with the "visualize" colors
+            img = class_to_rgb(img)
+        img = np.asarray(img, dtype=np.uint8)
+        return img.astype(np.float32) / 255.0 if normalize else img
 
     def _crop_image(self, image, tile_id, batch_id, coordinates):
         xmin, ymin, xmax, ymax = coordinates
@@ -225,30 +609,20 @@ class SequenceDataLoader(Sequence):
     ###################################################################################################
 
     def _load_grayscale_sequence(self, image_sequence):
-        """Load grayscale image sequence and quantize to 9 colors
+        """Load an image sequence quantized to fixed gray levels
 
         :param image_sequence: list of paths to images to load as a sequence
         :return: loaded image sequence
         """
-        images = [
-            Image.open(img_path).convert("P", palette=Image.ADAPTIVE, colors=9)
-            for img_path in image_sequence
-        ]
-        grayscale_images = [
-            img.convert("L") for img in images
-        ]  # Convert back to grayscale
-        image_data = [
-            np.array(img) / 255.0 for img in grayscale_images
-        ]  # Convert to float and normalize
-        return np.stack(image_data, axis=-1)
+        return np.stack(
+            [self._load_grayscale_image(img_path) for img_path in image_sequence],
+            axis=-1,
+        )
 
     def _load_grayscale_image(self, image_path):
-        """Load grayscale image and quantize to 9 colors
+        """Load an image quantized to fixed gray levels (see DynamicWorld.class_to_gray)
 
         :param image_path: path to image to load
         :return: loaded image
         """
-        img = Image.open(image_path).convert("P", palette=Image.ADAPTIVE, colors=9)
-        img = img.convert("L")  # Convert back to grayscale
-        img = np.array(img) / 255.0
-        return img
+        return class_to_gray(to_class_raster(read_image(image_path)), normalize=True)
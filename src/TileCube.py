@@ -0,0 +1,145 @@
+import os
+import numpy as np
+from DynamicWorld import NO_DATA
+
+# Index of the cube: one (tile_id, batch_id, position) row per tile, the tiles being sorted by id
+INDEX_FILE = "tiles.npy"
+
+
+def chunk_path(root, year, batch_id):
+    return os.path.join(root, str(year), f"batch_{batch_id}.npy")
+
+
+def crop_tiles(subimages, img_size):
+    """
+    Stack the tile subimages of a batch into one (n, height, width, ...) uint8 array of fixed-size crops.
+
+    Tiles larger than img_size are cropped to their top-left corner, as in the per-tile TIFF exports, and smaller
+    tiles are padded with no-data pixels (NO_DATA for class-index rasters, black for RGB images).
+    """
+    shape = subimages[0].shape[2:] if len(subimages) else ()
+    fill = NO_DATA if len(shape) == 0 else 0
+    crops = np.full((len(subimages), img_size[0], img_size[1]) + shape, fill, np.uint8)
+    for i, subimage in enumerate(subimages):
+        subimage = subimage[: img_size[0], : img_size[1]]
+        crops[i, : subimage.shape[0], : subimage.shape[1]] = subimage
+    return crops
+
+
+def write_chunk(root, year, batch_id, crops):
+    """
+    Write the crops of the tiles of one batch for one year as a single contiguous chunk.
+
+    Every batch has its own chunk file, so batches can be written concurrently by independent processes. The chunk
+    is written to a temporary file first, so readers never see a partially written chunk.
+    """
+    path = chunk_path(root, year, batch_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        np.save(f, crops)
+    os.replace(temporary_path, path)
+
+
+def write_index(root, tile_ids, batch_ids, positions):
+    """
+    Write the index mapping each tile id to its batch chunk and its position within the chunk.
+
+    The rows are merged into the existing index of the cube, if any: the given tiles replace their previous rows
+    and the other tiles keep theirs, so a cube can be filled one subset of the fishnet at a time.
+    """
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, INDEX_FILE)
+    index = np.stack([tile_ids, batch_ids, positions], axis=1).astype(np.int64)
+    if os.path.exists(path):
+        previous = np.load(path)
+        previous = previous[~np.isin(previous[:, 0], index[:, 0])]
+        index = np.concatenate([previous, index])
+
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "wb") as f:
+        np.save(f, index[np.argsort(index[:, 0], kind="stable")])
+    os.replace(temporary_path, path)
+
+
+class TileCube:
+    """
+    Chunked on-disk store of the fixed-size image crops of the tiles, keyed by (tile_id, year).
+
+    The crops of the tiles of one batch and one year are stored contiguously in a single .npy chunk
+    ({root}/{year}/batch_{batch_id}.npy) of shape (n_tiles_in_batch, height, width, ...), instead of one small TIFF
+    per tile. Chunks are memory-mapped, so reading a tile returns a read-only view of the file without copying it,
+    and the tiles of a batch, which are usually read together, are contiguous on disk.
+    """
+
+    def __init__(self, root):
+        """
+        Parameters:
+        root (str): Folder of the cube, written by ImageProcessor.cnn_partition_images(store="cube").
+        """
+        self.root = root
+        index = np.load(os.path.join(root, INDEX_FILE))
+        self.tile_ids = index[:, 0]
+        self.batch_ids = index[:, 1]
+        self.positions = index[:, 2]
+        self._chunks = {}
+
+    def __len__(self):
+        return len(self.tile_ids)
+
+    def locate(self, tile_ids):
+        """
+        Return the batch ids and the positions within their chunk of the requested tiles.
+        """
+        tile_ids = np.asarray(tile_ids)
+        rows = np.searchsorted(self.tile_ids, tile_ids)
+        rows = np.minimum(rows, len(self.tile_ids) - 1)
+        missing = self.tile_ids[rows] != tile_ids
+        if np.any(missing):
+            raise KeyError(
+                f"Tiles {np.asarray(tile_ids)[missing]} are not in the cube."
+            )
+        return self.batch_ids[rows], self.positions[rows]
+
+    def chunk(self, year, batch_id):
+        """
+        Memory-mapped (n_tiles_in_batch, height, width, ...) array of the crops of one batch for one year.
+        """
+        key = (str(year), int(batch_id))
+        if key not in self._chunks:
+            self._chunks[key] = np.load(
+                chunk_path(self.root, year, batch_id), mmap_mode="r"
+            )
+        return self._chunks[key]
+
+    def get(self, tile_id, year):
+        """
+        Read-only view of the crop of one tile for one year.
+        """
+        batch_ids, positions = self.locate([tile_id])
+        return self.chunk(year, batch_ids[0])[positions[0]]
+
+    def get_many(self, tile_ids, year, out=None):
+        """
+        Gather the crops of several tiles for one year into a single (n, height, width, ...) array, with one fancy
+        index per batch chunk involved.
+
+        Parameters:
+        tile_ids (array-like): Ids of the tiles.
+        year (int or str): Year of the crops.
+        out (np.ndarray): Optional array to fill instead of allocating a new one.
+        """
+        batch_ids, positions = self.locate(tile_ids)
+        for batch_id in np.unique(batch_ids):
+            selected = np.flatnonzero(batch_ids == batch_id)
+            chunk = self.chunk(year, batch_id)
+            if out is None:
+                out = np.empty((len(batch_ids),) + chunk.shape[1:], dtype=chunk.dtype)
+            out[selected] = chunk[positions[selected]]
+        return out
+
+    def __getstate__(self):
+        # Memory maps are reopened in each worker process (e.g. DataLoader workers)
+        state = self.__dict__.copy()
+        state["_chunks"] = {}
+        return state
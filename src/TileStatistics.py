@@ -0,0 +1,235 @@
+import numpy as np
+from DynamicWorld import BUILT, DW_CLASSES, N_LABELS
+
+
+def tile_histograms(class_raster, windows, n_labels=N_LABELS, backend="bincount"):
+    """
+    Count the pixels of each class inside each tile window of a class-index raster.
+
+    With the "bincount" backend, the tile windows of a batch share their column and row edges, so every pixel is
+    mapped to its tile with two searchsorted calls and all the histograms come out of a single bincount. Windows
+    that do not form such a grid (e.g. tiles clipped to a shapefile) fall back to one bincount per window.
+    The "integral" backend builds an IntegralHistogram and answers each window with four array gathers, whatever
+    the windows are.
+
+    Args:
+        class_raster (np.ndarray): An (H, W) raster of class indices in [0, n_labels).
+        windows (np.ndarray): An (n, 4) array of (xmin, ymin, xmax, ymax) pixel windows.
+        n_labels (int): Number of class indices.
+        backend (str): "bincount" or "integral".
+
+    Returns:
+        np.ndarray: An (n, n_labels) int64 array of pixel counts.
+    """
+    if backend == "integral":
+        return IntegralHistogram(class_raster, n_labels).histograms(windows)
+    elif backend != "bincount":
+        raise ValueError("backend must be 'bincount' or 'integral'.")
+
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    height, width = class_raster.shape
+    n = len(windows)
+    if n == 0:
+        return np.zeros((0, n_labels), dtype=np.int64)
+
+    x_bin, x_of_window = _window_bins(windows[:, 0], windows[:, 2], width)
+    y_bin, y_of_window = _window_bins(windows[:, 1], windows[:, 3], height)
+
+    if x_bin is not None and y_bin is not None:
+        cells = np.full(
+            (y_of_window.max() + 1, x_of_window.max() + 1), -1, dtype=np.int64
+        )
+        cells[y_of_window, x_of_window] = np.arange(n)
+        if (cells >= 0).sum() == n:
+            tile = np.where(
+                (y_bin[:, None] >= 0) & (x_bin[None, :] >= 0),
+                cells[y_bin[:, None], x_bin[None, :]],
+                -1,
+            )
+            inside = tile >= 0
+            counts = np.bincount(
+                tile[inside] * n_labels + class_raster[inside],
+                minlength=n * n_labels,
+            )
+            return counts.reshape(n, n_labels)
+
+    histograms = np.zeros((n, n_labels), dtype=np.int64)
+    for i, (xmin, ymin, xmax, ymax) in enumerate(windows):
+        histograms[i] = np.bincount(
+            class_raster[ymin:ymax, xmin:xmax].ravel(), minlength=n_labels
+        )
+    return histograms
+
+
+def _window_bins(starts, stops, size):
+    # Map each pixel along one axis to the index of the distinct, non-overlapping [start, stop) interval containing it
+    intervals, window_bin = np.unique(
+        np.stack([starts, np.minimum(stops, size)], axis=1), axis=0, return_inverse=True
+    )
+    if np.any(intervals[1:, 0] < intervals[:-1, 1]):
+        return None, None
+
+    pixels = np.arange(size)
+    pixel_bin = np.searchsorted(intervals[:, 0], pixels, side="right") - 1
+    inside = (pixel_bin >= 0) & (pixels < intervals[np.maximum(pixel_bin, 0), 1])
+    return np.where(inside, pixel_bin, -1), window_bin.ravel()
+
+
+# -------------------------------------------------------------------------- #
+#                        Integral image (summed-area table)                  #
+# -------------------------------------------------------------------------- #
+
+
+def integral_image(array, dtype=np.int64):
+    """
+    Summed-area table of an (H, W) or (H, W, C) array.
+
+    Returns:
+        np.ndarray: An (H + 1, W + 1, ...) array S such that S[y, x] = array[:y, :x].sum(axis=(0, 1)).
+    """
+    height, width = array.shape[:2]
+    table = np.zeros((height + 1, width + 1) + array.shape[2:], dtype=dtype)
+    np.cumsum(array, axis=0, dtype=dtype, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, dtype=dtype, out=table[1:, 1:])
+    return table
+
+
+def window_sums(table, windows):
+    """
+    Sum of the array over each (xmin, ymin, xmax, ymax) window, read from its summed-area table with four gathers.
+    Windows are clipped to the array bounds.
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    height, width = table.shape[0] - 1, table.shape[1] - 1
+    x0, x1 = np.clip(windows[:, 0], 0, width), np.clip(windows[:, 2], 0, width)
+    y0, y1 = np.clip(windows[:, 1], 0, height), np.clip(windows[:, 3], 0, height)
+    x1, y1 = np.maximum(x0, x1), np.maximum(y0, y1)
+    return table[y1, x1] - table[y0, x1] - table[y1, x0] + table[y0, x0]
+
+
+class IntegralHistogram:
+    """
+    Summed-area table of the per-class pixel counts of a class-index raster.
+
+    It is built once per image, after which the class histogram of any rectangular window (tiles, multi-scale
+    context windows, sliding windows, tiles of another fishnet resolution) costs four array gathers.
+    The table holds (H + 1) x (W + 1) x n_labels counts, in the smallest unsigned dtype able to count every pixel
+    of the image: 2 bytes per count up to 65535 pixels, 4 bytes above. A 100 megapixel image therefore needs about
+    4 GB, against 100 MB for the raster itself.
+    """
+
+    def __init__(self, class_raster, n_labels=N_LABELS):
+        self.height, self.width = class_raster.shape
+        self.n_labels = n_labels
+        dtype = _count_dtype(self.height * self.width)
+        self.table = np.zeros((self.height + 1, self.width + 1, n_labels), dtype=dtype)
+        for label in range(n_labels):
+            self.table[..., label] = integral_image(class_raster == label, dtype=dtype)
+
+    def histograms(self, windows):
+        """
+        Return the (n, n_labels) pixel counts of each (xmin, ymin, xmax, ymax) window.
+        """
+        # Unsigned differences wrap around, but the counts of a window always fit the dtype
+        return window_sums(self.table, windows).astype(np.int64)
+
+    def sliding_windows(self, size, stride):
+        """
+        Return the (n, 4) windows of a (height, width) = size window sliding over the image with a (y, x) stride.
+        """
+        ys = np.arange(0, self.height - size[0] + 1, stride[0])
+        xs = np.arange(0, self.width - size[1] + 1, stride[1])
+        y0, x0 = np.meshgrid(ys, xs, indexing="ij")
+        return np.stack(
+            [x0.ravel(), y0.ravel(), x0.ravel() + size[1], y0.ravel() + size[0]], axis=1
+        )
+
+
+def _count_dtype(n_pixels):
+    # Smallest unsigned dtype holding counts up to n_pixels
+    for dtype in (np.uint16, np.uint32):
+        if n_pixels <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def scale_windows(windows, scale):
+    """
+    Grow each window around its center to scale x scale times its size, e.g. scale=3 covers the tile and its 8
+    neighbors. The windows are not clipped.
+    """
+    windows = np.asarray(windows, dtype=np.int64).reshape(-1, 4)
+    pad_x = np.round((windows[:, 2] - windows[:, 0]) * (scale - 1) / 2).astype(np.int64)
+    pad_y = np.round((windows[:, 3] - windows[:, 1]) * (scale - 1) / 2).astype(np.int64)
+    return windows + np.stack([-pad_x, -pad_y, pad_x, pad_y], axis=1)
+
+
+# -------------------------------------------------------------------------- #
+#                      Statistics derived from histograms                    #
+# -------------------------------------------------------------------------- #
+
+
+def class_shares(histograms):
+    """
+    Share of each class among all the pixels of each tile, NaN for empty tiles.
+    """
+    total = histograms.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return histograms / total
+
+
+def _entropy(probabilities):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        terms = np.where(probabilities > 0, -probabilities * np.log2(probabilities), 0)
+    entropy = terms.sum(axis=1)
+    return np.where(np.isnan(probabilities).any(axis=1), np.nan, entropy)
+
+
+def built_pixel_mean(histograms):
+    """
+    Mean pixel value of the black & white "built" mask of each tile (255 for built pixels, 0 otherwise).
+    """
+    return 255 * class_shares(histograms)[:, BUILT]
+
+
+def built_entropy(histograms):
+    """
+    Entropy (base 2) of the built / not built distribution of each tile.
+    """
+    built = class_shares(histograms)[:, BUILT]
+    return _entropy(np.stack([built, 1 - built], axis=1))
+
+
+def class_entropy(histograms):
+    """
+    Shannon entropy (base 2) of the distribution of the Dynamic World classes in each tile, ignoring no-data pixels.
+    """
+    return _entropy(class_shares(histograms[:, : len(DW_CLASSES)]))
+
+
+# Statistics available to ImageProcessor.compute_tile_statistics, by name
+TILE_STATISTICS = {
+    "built_pixel_mean": built_pixel_mean,
+    "built_entropy": built_entropy,
+    "class_entropy": class_entropy,
+    "no_data_share": lambda histograms: class_shares(histograms)[:, len(DW_CLASSES)],
+}
+for _index, _name in enumerate(DW_CLASSES):
+    TILE_STATISTICS[f"{_name}_share"] = lambda histograms, index=_index: class_shares(
+        histograms
+    )[:, index]
+
+
+def compute_statistics(histograms, names):
+    """
+    Derive the requested statistics from the class histograms of the tiles.
+
+    Returns:
+        dict: A dictionary mapping each statistic name to an array of one value per tile.
+    """
+    unknown = set(names) - set(TILE_STATISTICS)
+    if unknown:
+        raise ValueError(
+            f"Unknown statistics {unknown}. Choose among {list(TILE_STATISTICS)}."
+        )
+    return {name: TILE_STATISTICS[name](histograms) for name in names}
@@ -9,6 +9,7 @@ from sklearn.model_selection import train_test_split
 import xgboost as xgb
 from matplotlib import pyplot as plt
 from sklearn.model_selection import GridSearchCV
+from ImplicitGrid import NEIGHBOR_POSITIONS
 
 
 class XGB:
@@ -23,6 +24,7 @@ class XGB:
     else:
       self.df = deepcopy(fishnet.fishnet)
     self.seed = 42
+    self.neighbors_matrix = None
     
   def feature_engineering(self, yearStart, yearEnd):
     self.years_range = range(yearStart, yearEnd + 1)
@@ -36,23 +38,44 @@ class XGB:
     to_drop = [f"{feature}_{yr}" for yr in self.years_range for feature in ["MeanPixel", "Entropy"]]
     self.df.drop(columns = to_drop, axis = 1, inplace = True)
 
-  def neighbors_features(self):
-    position_names = ['UL', 'U', 'UR', 'L', 'R', 'DL', 'D', 'DR']
-    for yr in self.years_range[1:-1]:
-      for pos_name in tqdm(position_names):
-        self.df[f"{pos_name}_{yr}"] = self.df.apply(lambda row: self.get_neighbor_value(row, pos_name, yr), axis=1)
+  def neighbors_features(self, as_matrix = False):
+    """
+    Gather the ΔMeanPixel of the 8 neighbors of every tile, for every year, in a single array gather.
+    Missing neighbors (outside the grid or not in the dataframe) get 0.
+
+    If as_matrix is True, the features are not added to self.df but kept as a wide float32 matrix in
+    self.neighbors_matrix (columns named by self.neighbors_feature_names), which train_model appends to the
+    other features.
+    """
+    years = list(self.years_range[1:-1])
+    ids = self.df["id"].values.astype(int)
+
+    # row position of each tile id in self.df, -1 for the tiles that are not in the dataframe
+    position = np.full(self.fishnet.grid.n_tiles, -1, dtype=np.int64)
+    position[ids] = np.arange(len(ids))
+    neighbors = self.fishnet.neighbors[ids]
+    neighbor_position = np.where(neighbors >= 0, position[neighbors], -1)
+
+    # the last row is all zeros, so that missing neighbors (position -1) gather 0
+    values = np.zeros((len(ids) + 1, len(years)), dtype=np.float32)
+    values[:-1] = self.df[[f"ΔMeanPixel_{yr-1}_{yr}" for yr in years]].values
+    matrix = values[neighbor_position].transpose(0, 2, 1).reshape(len(ids), -1)
+    names = [f"{pos_name}_{yr}" for yr in years for pos_name in NEIGHBOR_POSITIONS]
 
-  def get_neighbor_value(self, row, pos_name, yr):
-    if pos_name not in row["neighbors"]:
-      return 0 # that neighbor doesn't exist
+    if as_matrix:
+      self.neighbors_matrix = matrix
+      self.neighbors_feature_names = names
     else:
-      neighbor_id = row["neighbors"][pos_name]
-      values = self.df.loc[self.df["id"] == neighbor_id, f"ΔMeanPixel_{yr-1}_{yr}"].values
-      return values[0] if len(values) != 0 else 0
+      self.df = pd.concat(
+        [self.df.drop(columns = names, errors = "ignore"), pd.DataFrame(matrix, columns = names, index = self.df.index)],
+        axis = 1,
+      )
 
   def train_model(self):
     target = f'ΔMeanPixel_{self.years_range[-1] - 1}_{self.years_range[-1]}'
     X = self.df.drop(columns = [target], axis = 1, inplace = False)
+    if self.neighbors_matrix is not None:
+      X = np.hstack([X.to_numpy(np.float32), self.neighbors_matrix])
     y = self.df[target]
     X_train, X_test, y_train, y_test = train_test_split(X, y, random_state = self.seed, train_size = 0.8)
 
@@ -3,21 +3,46 @@ from torch.utils.data import Dataset, DataLoader
 from PIL import Image
 import pandas as pd
 import numpy as np
+from DynamicWorld import class_to_rgb
+from RasterReader import read_image
+from TileCube import TileCube
 
 
 class CustomDataset(Dataset):
-    def __init__(self, base_path, dataframe, dtype=torch.float32, transform=None):
+    def __init__(
+        self,
+        base_path,
+        dataframe,
+        dtype=torch.float32,
+        transform=None,
+        store="tiff",
+        class_images=False,
+    ):
+        # With store="cube", base_path is the TileCube folder (CNN_cube) and tiles are sliced from its chunks.
+        # With class_images=True, the tiles are class-index rasters (ImageExporter(return_type="class")) and are
+        # rendered with the "visualize" colors; any other tile is converted to RGB.
         self.base_path = base_path
+        self.cube = TileCube(base_path) if store == "cube" else None
         self.dataframe = dataframe
         self.dtype = dtype
         self.transform = transform
+        self.class_images = class_images
 
     def __len__(self):
         return len(self.dataframe)
 
     def __getitem__(self, index):
-        image_path = self.get_image_path(index)
-        image = Image.open(image_path).convert("RGB")
+        if self.cube is not None:
+            image = self.cube.get(*self.get_tile_year(index))
+        elif self.class_images:
+            image = read_image(self.get_image_path(index))
+        else:
+            image = Image.open(self.get_image_path(index)).convert("RGB")
+
+        if self.class_images:
+            image = class_to_rgb(image)
+        else:
+            image = _to_rgb(image)
         image = torch.from_numpy(np.array(image))
         image = image.permute(2, 0, 1).type(self.dtype)
 
@@ -44,3 +69,13 @@ class CustomDataset(Dataset):
         tile_id = self.dataframe.iloc[index]["tile_id"]
         year = self.dataframe.iloc[index]["year"]
         return tile_id, year
+
+
+def _to_rgb(image):
+    # (H, W, 3) version of a grayscale, RGB or RGBA array, as PIL's convert("RGB") would return it
+    image = np.asarray(image)
+    if image.ndim == 2:
+        return np.repeat(image[..., None], 3, axis=2)
+    if image.shape[2] == 1:
+        return np.repeat(image, 3, axis=2)
+    return image[..., :3]
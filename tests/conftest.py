@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules of src are imported as top-level modules, as in the notebooks
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
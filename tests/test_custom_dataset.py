@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+torch = pytest.importorskip("torch")
+from custom_dataset import CustomDataset
+from DynamicWorld import class_to_rgb
+
+
+@pytest.fixture
+def dataframe():
+    return pd.DataFrame({"tile_id": [0], "year": [2020], "urbanization_rate": [0.5]})
+
+
+@pytest.mark.parametrize("mode", ["L", "P", "RGBA"])
+def test_non_class_images_are_converted_to_rgb(tmp_path, dataframe, mode):
+    (tmp_path / "2020").mkdir()
+    pixels = np.random.default_rng(0).integers(0, 9, (32, 32)).astype(np.uint8)
+    image = Image.fromarray(pixels, "L").convert(mode)
+    image.save(tmp_path / "2020" / "0.tif")
+
+    tensor, _ = CustomDataset(str(tmp_path), dataframe)[0]
+    expected = np.array(image.convert("RGB")).transpose(2, 0, 1)
+    assert np.array_equal(tensor.numpy(), expected)
+
+
+def test_class_images_are_rendered_with_the_palette(tmp_path, dataframe):
+    (tmp_path / "2020").mkdir()
+    classes = np.random.default_rng(0).integers(0, 10, (32, 32)).astype(np.uint8)
+    Image.fromarray(classes).save(tmp_path / "2020" / "0.tif")
+
+    tensor, _ = CustomDataset(str(tmp_path), dataframe, class_images=True)[0]
+    assert np.array_equal(tensor.numpy(), class_to_rgb(classes).transpose(2, 0, 1))
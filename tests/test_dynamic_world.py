@@ -0,0 +1,35 @@
+import numpy as np
+from PIL import Image
+from DynamicWorld import (
+    DW_PALETTE,
+    NO_DATA,
+    class_to_gray,
+    class_to_rgb,
+    rgb_to_class,
+)
+
+
+def test_gray_levels_match_pil_luminance_per_class():
+    classes = np.arange(NO_DATA + 1, dtype=np.uint8)
+    colors = class_to_rgb(classes.reshape(1, -1))
+    expected = np.asarray(Image.fromarray(colors).convert("L"))[0]
+
+    assert np.array_equal(class_to_gray(classes), expected)
+    assert class_to_gray(classes).dtype == np.uint8
+    normalized = class_to_gray(classes, normalize=True)
+    assert normalized.dtype == np.float32
+    assert np.array_equal(normalized, expected.astype(np.float32) / 255.0)
+
+    # NO_DATA is black, and every class keeps its own level
+    assert class_to_gray(classes)[NO_DATA] == 0
+    assert len(np.unique(class_to_gray(classes))) == len(classes)
+
+
+def test_gray_levels_of_a_visualize_image_match_pil():
+    rng = np.random.default_rng(0)
+    palette = np.vstack([DW_PALETTE, np.zeros((1, 3), dtype=np.uint8)])
+    image = palette[rng.integers(0, len(palette), (32, 48))]
+    assert np.array_equal(
+        class_to_gray(rgb_to_class(image)),
+        np.asarray(Image.fromarray(image).convert("L")),
+    )
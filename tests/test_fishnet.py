@@ -0,0 +1,85 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+import shapely
+from Fishnet import Fishnet
+
+
+@pytest.fixture
+def shapefile(tmp_path):
+    # A concave U shape and a square with a hole
+    u_shape = shapely.Polygon(
+        [
+            (-97.90, 30.10),
+            (-97.80, 30.10),
+            (-97.80, 30.20),
+            (-97.83, 30.20),
+            (-97.83, 30.13),
+            (-97.87, 30.13),
+            (-97.87, 30.20),
+            (-97.90, 30.20),
+        ]
+    )
+    holed = shapely.Polygon(
+        [(-97.78, 30.12), (-97.70, 30.12), (-97.70, 30.21), (-97.78, 30.21)],
+        holes=[[(-97.765, 30.14), (-97.72, 30.14), (-97.72, 30.19), (-97.765, 30.19)]],
+    )
+    path = str(tmp_path / "shapes.geojson")
+    gpd.GeoDataFrame(
+        {"name": ["u", "holed"]}, geometry=[u_shape, holed], crs="EPSG:4326"
+    ).to_file(path)
+    return path
+
+
+def test_clip_matches_overlay(shapefile):
+    clipped = Fishnet(
+        tile_size_miles=0.5,
+        shapefile_path=shapefile,
+        clip=True,
+        overlay_method="intersection",
+    )
+    clipped.create_fishnet()
+
+    reference = Fishnet(tile_size_miles=0.5, shapefile_path=shapefile)
+    reference.create_fishnet()
+    expected = gpd.overlay(reference.fishnet, reference.tx, how="intersection")
+
+    # The row order of gpd.overlay depends on the pandas version: compare the pairs sorted by tile then shape
+    shape_order = {"u": 0, "holed": 1}
+    expected = expected.iloc[
+        np.lexsort((expected["name"].map(shape_order), expected["id"]))
+    ].reset_index(drop=True)
+    result = clipped.fishnet
+    assert result.columns.tolist() == expected.columns.tolist()
+    assert result["id"].tolist() == expected["id"].tolist()
+    assert result["name"].tolist() == expected["name"].tolist()
+    assert shapely.equals(
+        shapely.normalize(result.geometry.values),
+        shapely.normalize(expected.geometry.values),
+    ).all()
+    # Both fully inside and boundary tiles were clipped
+    areas = shapely.area(result.geometry.values)
+    assert (areas < 0.99 * areas.max()).any() and (areas > 0.99 * areas.max()).any()
+
+    # The tiles in the hole and in the notch of the U are dropped
+    holed = reference.tx.geometry.values[1]
+    hole = shapely.Polygon(holed.interiors[0])
+    inside_hole = reference.fishnet.geometry.within(hole)
+    assert inside_hole.any()
+    assert not result["id"].isin(reference.fishnet["id"][inside_hole]).any()
+    notch = shapely.box(-97.87, 30.13, -97.83, 30.20)
+    inside_notch = reference.fishnet.geometry.within(notch)
+    assert inside_notch.any()
+    assert not result["id"].isin(reference.fishnet["id"][inside_notch]).any()
+
+
+def test_classify_geometry_matches_shapely(shapefile):
+    fishnet = Fishnet(tile_size_miles=0.5, shapefile_path=shapefile)
+    fishnet.create_fishnet()
+    boxes = fishnet.fishnet.geometry.values
+    for shape in fishnet.tx.geometry.values:
+        # Small blocks exercise the row blocks of the classification
+        ids, inside = fishnet.grid.classify_geometry(shape, block_size=7)
+        assert np.array_equal(ids, np.flatnonzero(shapely.intersects(shape, boxes)))
+        assert np.array_equal(inside, shapely.covers(shape, boxes[ids]))
+        assert inside.any() and not inside.all()
@@ -0,0 +1,70 @@
+import os
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from Fishnet import Fishnet
+
+
+@pytest.fixture
+def fishnet():
+    fishnet = Fishnet(tile_size_miles=0.5, coordinates=(-97.9, 30.1, -97.7, 30.3))
+    fishnet.create_fishnet()
+    fishnet.batch(2)
+    fishnet.compute_neighbors()
+    return fishnet
+
+
+def test_regular_fishnet_round_trip(fishnet, tmp_path):
+    n = len(fishnet.fishnet)
+    fishnet.fishnet["MeanPixel_2020"] = np.linspace(0, 1, n).astype(np.float32)
+    fishnet.fishnet["name"] = [f"tile {i}" for i in range(n)]
+    fishnet.fishnet["note"] = [None, np.nan, 1, "a"] * (n // 4) + ["b"] * (n % 4)
+    fishnet.fishnet["kind"] = pd.Categorical(np.where(np.arange(n) % 2, "odd", "even"))
+    fishnet.save(str(tmp_path / "fishnet"))
+
+    # Regular tiles are rebuilt from the grid instead of being stored
+    assert not os.path.exists(tmp_path / "fishnet" / "fishnet" / "geometry.npy")
+    loaded = Fishnet.load(str(tmp_path / "fishnet"), lazy_geometry=False)
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(loaded.fishnet[fishnet.fishnet.columns]),
+        pd.DataFrame(fishnet.fishnet),
+    )
+    assert np.array_equal(loaded.neighbors, fishnet.neighbors)
+
+    batch = Fishnet.load(str(tmp_path / "fishnet"), batch_ids=[1, 2])
+    expected = fishnet.fishnet[fishnet.fishnet["batch_id"].isin([1, 2])]
+    assert batch.fishnet.index.equals(expected.index)
+    columns = ["name", "note", "kind"]
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(batch.fishnet[columns]), pd.DataFrame(expected[columns])
+    )
+
+
+def test_clipped_fishnet_round_trip(tmp_path):
+    # A rectangle not aligned with the grid: its boundary tiles are clipped into smaller rectangles
+    shapefile = str(tmp_path / "region.shp")
+    gpd.GeoDataFrame(
+        {"NAME": ["region"]},
+        geometry=[shapely.box(-97.881, 30.117, -97.723, 30.262)],
+        crs="EPSG:4326",
+    ).to_file(shapefile)
+    fishnet = Fishnet(
+        0.5, shapefile_path=shapefile, clip=True, overlay_method="intersection"
+    )
+    fishnet.create_fishnet()
+    fishnet.batch(2)
+    # The clipped tiles are rectangles, stored as boxes like the regular tiles
+    fishnet.fishnet["geometry"] = shapely.box(*fishnet.fishnet.bounds.values.T)
+    fishnet.save(str(tmp_path / "fishnet"))
+
+    for batch_ids in [None, [0, 3, 4]]:
+        loaded = Fishnet.load(str(tmp_path / "fishnet"), batch_ids=batch_ids)
+        expected = fishnet.fishnet
+        if batch_ids is not None:
+            expected = expected[expected["batch_id"].isin(batch_ids)]
+        assert not loaded.lazy_geometry
+        assert loaded.fishnet.index.equals(expected.index)
+        assert loaded.fishnet.geometry.geom_equals_exact(expected.geometry, 0).all()
+        assert (loaded.fishnet["NAME"] == "region").all()
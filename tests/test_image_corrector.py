@@ -0,0 +1,188 @@
+import os
+import json
+import numpy as np
+import pytest
+from PIL import Image
+from DynamicWorld import DW_PALETTE, NO_DATA, SNOW
+from ImageCorrector import STATISTICS_CACHE, ImageCorrector
+from RasterReader import read_image, write_class_raster
+from ResultCache import ResultCache
+
+
+@pytest.fixture
+def corrector(tmp_path):
+    # 4 black pixels, 2 snow pixels and 2 pixels of a color outside the palette
+    image = np.zeros((2, 4, 3), dtype=np.uint8)
+    image[1, :2] = DW_PALETTE[SNOW]
+    image[1, 2:] = [10, 20, 30]
+    for folder in ["Summer", "Year"]:
+        os.makedirs(tmp_path / "2020" / folder)
+        Image.fromarray(image).save(tmp_path / "2020" / folder / "landcover_0.tif")
+    return ImageCorrector(str(tmp_path), verbose=False)
+
+
+def test_black_pixel_share_only_counts_black_pixels(corrector, tmp_path):
+    path = str(tmp_path / "2020" / "Summer")
+    assert corrector.compute_color_pixels_proportion(path, [0, 0, 0]) == 0.5
+    assert corrector.compute_color_pixels_proportion(path, DW_PALETTE[SNOW]) == 0.25
+
+
+def test_colors_outside_the_palette_are_rejected(corrector, tmp_path):
+    with pytest.raises(ValueError):
+        corrector.compute_color_pixels_proportion(
+            str(tmp_path / "2020" / "Summer"), [10, 20, 30]
+        )
+
+
+def test_statistics_cache_is_written_atomically(corrector, tmp_path, monkeypatch):
+    path = str(tmp_path / "2020" / "Summer")
+    cache_path = tmp_path / STATISTICS_CACHE
+    corrector.compute_color_pixels_proportion(path)
+    assert sorted(os.listdir(tmp_path)) == ["2020", STATISTICS_CACHE]
+    content = cache_path.read_text()
+
+    # A run interrupted while writing the cache leaves the previous cache in place
+    image = np.zeros((2, 4, 3), dtype=np.uint8)
+    Image.fromarray(image).save(tmp_path / "2020" / "Summer" / "landcover_1.tif")
+
+    def interrupted_dump(obj, f):
+        f.write(json.dumps(obj)[:10])
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(json, "dump", interrupted_dump)
+    with pytest.raises(KeyboardInterrupt):
+        corrector.compute_color_pixels_proportion(path)
+    assert cache_path.read_text() == content
+    monkeypatch.undo()
+
+    # A truncated cache is recomputed instead of crashing the next load
+    cache_path.write_text(content[:10])
+    assert corrector.compute_color_pixels_proportion(path) == 0.75
+    assert json.loads(cache_path.read_text())
+
+
+YEARS = ["2019", "2020", "2021"]
+FILES = ["landcover_0.tif", "landcover_1.tif"]
+
+
+@pytest.fixture
+def chains(tmp_path):
+    # Class-index Summer images with missing pixels, filled by their Year image
+    rng = np.random.default_rng(0)
+    for year in YEARS:
+        for folder in ["Summer", "Year"]:
+            os.makedirs(tmp_path / year / folder)
+            for file in FILES:
+                labels = rng.integers(0, NO_DATA + 1, (16, 16)).astype(np.uint8)
+                if folder == "Year":
+                    labels[labels == NO_DATA] = 0
+                write_class_raster(str(tmp_path / year / folder / file), labels)
+    return tmp_path
+
+
+def saved_images(corrector, monkeypatch):
+    # Record the Final images written by the corrector, as (year, file) pairs
+    saved = []
+    save_image = corrector.save_image
+
+    def record(path, img):
+        saved.append(
+            (
+                os.path.basename(os.path.dirname(os.path.dirname(path))),
+                os.path.basename(path),
+            )
+        )
+        save_image(path, img)
+
+    monkeypatch.setattr(corrector, "save_image", record)
+    return saved
+
+
+def file_chain(root, file, years):
+    return [
+        (year, str(root / year / "Summer" / file), str(root / year / "Year" / file))
+        for year in years
+    ]
+
+
+def finals(root):
+    return {
+        (year, file): read_image(str(root / year / "Final" / file)).copy()
+        for year in YEARS
+        for file in FILES
+    }
+
+
+def backdate(root):
+    # Move every image 100 seconds back in time, keeping their order, so a file written next is newer than all of
+    # them whatever the timestamp resolution of the file system
+    for folder, _, files in os.walk(root):
+        for file in files:
+            path = os.path.join(folder, file)
+            mtime = os.stat(path).st_mtime_ns - 100 * 10**9
+            os.utime(path, ns=(mtime, mtime))
+
+
+def test_incremental_correction_recomputes_the_later_years(chains, monkeypatch):
+    corrector = ImageCorrector(str(chains), verbose=False)
+    saved = saved_images(corrector, monkeypatch)
+    corrector.correct_images(incremental=True)
+    assert sorted(saved) == sorted((year, file) for year in YEARS for file in FILES)
+    chain = file_chain(chains, FILES[0], YEARS)
+    assert corrector.first_stale_year(FILES[0], chain) == len(YEARS)
+
+    # A mid-sequence input changes: only its year and the later years of its batch file are corrected
+    backdate(chains)
+    labels = np.full((16, 16), NO_DATA, dtype=np.uint8)
+    write_class_raster(str(chains / "2020" / "Summer" / FILES[0]), labels)
+    assert corrector.first_stale_year(FILES[0], chain) == 1
+    saved.clear()
+    corrector.correct_images(incremental=True)
+    assert saved == [("2020", FILES[0]), ("2021", FILES[0])]
+
+    # The result is the same as correcting everything again
+    incremental = finals(chains)
+    corrector.correct_images()
+    expected = finals(chains)
+    for key in expected:
+        assert np.array_equal(incremental[key], expected[key]), key
+
+    saved.clear()
+    corrector.correct_images(incremental=True)
+    assert saved == []
+
+
+def test_cached_chains_are_skipped(chains, tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path / "cache"))
+    corrector = ImageCorrector(str(chains), verbose=False, cache=cache)
+    saved = saved_images(corrector, monkeypatch)
+    corrector.correct_images()
+    assert len(saved) == len(YEARS) * len(FILES)
+    expected = finals(chains)
+
+    # Unchanged inputs and Final images: every chain is a cache hit
+    saved.clear()
+    corrector.correct_images()
+    assert saved == []
+
+    # A deleted Final image, or a changed input, misses the key of its chain only
+    os.remove(chains / "2021" / "Final" / FILES[1])
+    labels = read_image(str(chains / "2019" / "Year" / FILES[0])).copy()
+    labels[0, 0] = (labels[0, 0] + 1) % NO_DATA
+    write_class_raster(str(chains / "2019" / "Year" / FILES[0]), labels)
+    saved.clear()
+    corrector.correct_images()
+    assert sorted(saved) == sorted(
+        [(year, FILES[0]) for year in YEARS] + [(year, FILES[1]) for year in YEARS]
+    )
+    assert np.array_equal(
+        finals(chains)[("2021", FILES[1])], expected[("2021", FILES[1])]
+    )
+
+    # The chain key covers the Final image an incremental chain starts from
+    chain = file_chain(chains, FILES[0], YEARS[1:])
+    key = corrector.chain_key(FILES[0], chain)
+    write_class_raster(
+        str(chains / "2019" / "Final" / FILES[0]), np.zeros((16, 16), dtype=np.uint8)
+    )
+    assert corrector.chain_key(FILES[0], chain) != key
@@ -0,0 +1,258 @@
+import ast
+import os
+import imageio
+import numpy as np
+import pandas as pd
+import pytest
+from DynamicWorld import BUILT
+from Fishnet import Fishnet
+from ImageProcessor import IMAGE_COORDINATES, ImageProcessor
+from ProcessedData import read_processed_data
+from ResultCache import ResultCache
+from TileCube import TileCube
+
+
+@pytest.fixture
+def processor(tmp_path):
+    fishnet = Fishnet(tile_size_miles=0.5, coordinates=(-97.9, 30.1, -97.8, 30.2))
+    fishnet.create_fishnet()
+    fishnet.batch(2)
+    rng = np.random.default_rng(0)
+    for batch_id in fishnet.batches.index:
+        imageio.imwrite(
+            tmp_path / f"landcover_{batch_id}.tif",
+            rng.integers(0, BUILT + 2, (128, 128)).astype(np.uint8),
+        )
+    processor = ImageProcessor(fishnet)
+    processor.assign_fishnet_tiles_to_pixels(str(tmp_path), "landcover")
+    return processor
+
+
+def test_pixel_coordinate_wrappers_keep_their_signatures(processor):
+    df = processor.fishnet.iloc[:3]
+    batch_coords = processor.fh.grid.batch_id_to_bounds(df["batch_id"].iloc[0])
+    expected = [tuple(window) for window in df[IMAGE_COORDINATES].values]
+
+    # The original signatures read the batch and image attributes of the processor
+    processor.batch_geometry = batch_coords
+    processor.img_height, processor.img_width = 128, 128
+    windows = processor.get_pixel_coordinates(df)
+    assert windows.index.equals(df.index)
+    assert windows.tolist() == expected
+    tile_bounds = processor.get_tile_bounds(df)
+    assert (
+        processor.latlong_to_pixel(batch_coords, tile_bounds[0], df["id"].iloc[0])
+        == expected[0]
+    )
+
+    # The image shape can also be given explicitly
+    processor.img_height, processor.img_width = 1, 1
+    assert (
+        processor.get_pixel_coordinates(df, batch_coords, (128, 128)).tolist()
+        == expected
+    )
+    assert (
+        processor.latlong_to_pixel(
+            batch_coords, tile_bounds[0], df["id"].iloc[0], (128, 128)
+        )
+        == expected[0]
+    )
+
+    other = processor.fishnet[processor.fishnet["batch_id"] != df["batch_id"].iloc[0]]
+    with pytest.raises(Exception, match="not within batch coordinates"):
+        processor.get_pixel_coordinates(other.iloc[:1])
+
+
+def test_invalid_windows_are_skipped(processor, tmp_path):
+    processor.fishnet.loc[processor.fishnet.index[0], "ValidImageCoordinates"] = False
+    processor.compute_tile_statistics(
+        str(tmp_path), "landcover", {"MeanPixel": "built_pixel_mean"}
+    )
+    assert np.isnan(processor.fishnet["MeanPixel"].iloc[0])
+    assert not np.isnan(processor.fishnet["MeanPixel"].iloc[1:]).any()
+
+    os.makedirs(tmp_path / "2020" / "Final")
+    for batch_id in processor.batch_ids:
+        os.replace(
+            tmp_path / f"landcover_{batch_id}.tif",
+            tmp_path / "2020" / "Final" / f"landcover_{batch_id}.tif",
+        )
+    processor.cnn_partition_images(
+        str(tmp_path), "landcover", "2020", (8, 8), warning=False, store="cube"
+    )
+    cube = TileCube(str(tmp_path / "CNN_cube"))
+    assert sorted(cube.tile_ids) == sorted(processor.fishnet["id"].iloc[1:])
+
+
+def test_pixel_windows_are_cached_without_hashing_the_images(processor, tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    cached = ImageProcessor(processor.fh, cache=cache)
+    cached.assign_fishnet_tiles_to_pixels(str(tmp_path), "landcover")
+    assert not cache._digests
+    assert np.array_equal(cached.get_image_windows(), processor.get_image_windows())
+
+    cached.fishnet.drop(columns=IMAGE_COORDINATES, inplace=True)
+    cached.assign_fishnet_tiles_to_pixels(str(tmp_path), "landcover")
+    assert np.array_equal(cached.get_image_windows(), processor.get_image_windows())
+
+
+def write_years(processor, image_root, years):
+    rng = np.random.default_rng(1)
+    for year in years:
+        os.makedirs(os.path.join(image_root, str(year), "Final"))
+        for batch_id in processor.batch_ids:
+            imageio.imwrite(
+                os.path.join(
+                    image_root, str(year), "Final", f"landcover_{batch_id}.tif"
+                ),
+                rng.integers(0, BUILT + 2, (128, 128)).astype(np.uint8),
+            )
+
+
+def test_processed_inputs_are_kept_off_the_fishnet(processor, tmp_path):
+    image_root = str(tmp_path / "years")
+    write_years(processor, image_root, [2016, 2017])
+    state_file = str(tmp_path / "processed_inputs.json")
+    processor.state_file = state_file
+
+    processed = processor.process_years(image_root, "landcover")
+    assert len(processed[2016]) == len(processor.batch_ids)
+    assert not hasattr(processor.fh, "processed_inputs")
+    assert processor.process_years(image_root, "landcover") == {2016: [], 2017: []}
+
+    # A new processor of the same fishnet resumes from the state file
+    resumed = ImageProcessor(processor.fh, state_file=state_file)
+    assert resumed.process_years(image_root, "landcover") == {2016: [], 2017: []}
+    assert ImageProcessor(processor.fh).process_years(image_root, "landcover")[2017]
+
+
+def original_processed_csv(fishnet, years):
+    # The melt and merge of the original generate_processed_csv, on a copy of the fishnet
+    fishnet = fishnet.rename(columns={"id": "tile_id"})
+    fishnet["tile_id"] = fishnet["tile_id"].astype(int)
+    fishnet["batch_id"] = fishnet["batch_id"].astype(int)
+    fishnet["ImageCoordinates"] = [
+        tuple(int(x) for x in window) for window in fishnet[IMAGE_COORDINATES].values
+    ]
+    for yr in years[1:]:
+        fishnet[f"urbanization_rate_{yr}"] = (
+            fishnet[f"MeanPixel_{yr}"] - fishnet[f"MeanPixel_{yr - 1}"]
+        ) / 255
+    fishnet["Lat"] = fishnet["geometry"].apply(lambda x: x.centroid.y)
+    fishnet["Lon"] = fishnet["geometry"].apply(lambda x: x.centroid.x)
+
+    data = fishnet[
+        ["tile_id", "batch_id"] + [f"urbanization_rate_{yr}" for yr in years[1:]]
+    ].melt(
+        id_vars=["tile_id", "batch_id"], var_name="year", value_name="urbanization_rate"
+    )
+    data["year"] = data["year"].str[-4:]
+    data["urbanization"] = (
+        fishnet[["tile_id", "batch_id"] + [f"MeanPixel_{yr}" for yr in years]].melt(
+            id_vars=["tile_id", "batch_id"], var_name="year", value_name="urbanization"
+        )["urbanization"]
+        / 255
+    )
+    data = data.merge(fishnet[["tile_id", "ImageCoordinates"]], on="tile_id")
+    data = data.merge(
+        fishnet[["tile_id", "batch_id", "Lat", "Lon"]], on=["tile_id", "batch_id"]
+    )
+    return data.to_csv(index=False)
+
+
+def test_processed_csv_matches_the_original_layout(processor, tmp_path):
+    years = [2016, 2017, 2018]
+    rng = np.random.default_rng(2)
+    for year in years:
+        processor.fishnet[f"MeanPixel_{year}"] = rng.random(len(processor.fishnet))
+    processor.generate_processed_csv(str(tmp_path) + "/", "processed")
+
+    with open(tmp_path / "processed.csv") as f:
+        assert f.read() == original_processed_csv(processor.fishnet, years)
+    data = pd.read_csv(tmp_path / "processed.csv")
+    assert data["year"].tolist()[:2] == [2017, 2018]
+    assert ast.literal_eval(data["ImageCoordinates"].iloc[0]) == tuple(
+        processor.fishnet[IMAGE_COORDINATES].iloc[0]
+    )
+
+    with pytest.warns(DeprecationWarning):
+        processor.generate_processed_csv(str(tmp_path) + "/", "processed", False)
+    with pytest.raises(ValueError):
+        processor.generate_processed_csv(str(tmp_path) + "/", "processed", True)
+
+
+def test_incremental_outputs_rewrite_the_years_of_changed_images(processor, tmp_path):
+    pytest.importorskip("pyarrow")
+    image_root = str(tmp_path / "years")
+    write_years(processor, image_root, [2016, 2017, 2018])
+    processor.process_years(image_root, "landcover")
+    save_path = str(tmp_path) + "/"
+    processor.generate_processed_csv(save_path, "processed", incremental=True)
+    processor.generate_processed_parquet(save_path, "dataset", incremental=True)
+
+    # A new year is appended after the existing rows
+    write_years(processor, image_root, [2019])
+    processor.process_years(image_root, "landcover")
+    processor.generate_processed_csv(save_path, "processed", incremental=True)
+    data = pd.read_csv(tmp_path / "processed.csv")
+    assert data["year"].tolist()[-len(processor.fishnet) :] == [2019] * len(
+        processor.fishnet
+    )
+
+    # An image of a year already written changes: the rows of 2017 and 2018 are stale
+    batch_id = processor.batch_ids[0]
+    path = os.path.join(image_root, "2017", "Final", f"landcover_{batch_id}.tif")
+    imageio.imwrite(path, np.full((128, 128), BUILT, dtype=np.uint8))
+    assert processor.process_years(image_root, "landcover")[2017] == [batch_id]
+    assert processor.stale_years(
+        save_path + "processed.inputs.json", [2017, 2018, 2019]
+    ) == [
+        2017,
+        2018,
+    ]
+
+    processor.generate_processed_csv(save_path, "processed", incremental=True)
+    processor.generate_processed_parquet(save_path, "dataset", incremental=True)
+    processor.generate_processed_csv(save_path, "expected")
+    with open(tmp_path / "processed.csv") as f, open(tmp_path / "expected.csv") as g:
+        assert f.read() == g.read()
+
+    expected = processor.urbanization_data([2017, 2018, 2019])
+    dataset = read_processed_data(str(tmp_path / "dataset"))
+    assert sorted(dataset["year"].unique()) == [2017, 2018, 2019]
+    expected = expected.sort_values(["tile_id", "year"], ignore_index=True)
+    assert np.allclose(dataset["urbanization_rate"], expected["urbanization_rate"])
+    assert np.allclose(dataset["urbanization"], expected["urbanization"])
+
+    # Nothing is stale any more
+    assert (
+        processor.stale_years(save_path + "processed.inputs.json", [2017, 2018, 2019])
+        == []
+    )
+
+
+def test_cube_index_is_written_after_every_chunk(processor, tmp_path):
+    os.makedirs(tmp_path / "2020" / "Final")
+    for batch_id in processor.batch_ids[1:]:
+        os.replace(
+            tmp_path / f"landcover_{batch_id}.tif",
+            tmp_path / "2020" / "Final" / f"landcover_{batch_id}.tif",
+        )
+    with pytest.raises(FileNotFoundError):
+        processor.cnn_partition_images(
+            str(tmp_path), "landcover", "2020", (8, 8), warning=False, store="cube"
+        )
+    assert not os.path.exists(tmp_path / "CNN_cube" / "tiles.npy")
+
+    batch_id = processor.batch_ids[0]
+    os.replace(
+        tmp_path / f"landcover_{batch_id}.tif",
+        tmp_path / "2020" / "Final" / f"landcover_{batch_id}.tif",
+    )
+    processor.cnn_partition_images(
+        str(tmp_path), "landcover", "2020", (8, 8), warning=False, store="cube"
+    )
+    cube = TileCube(str(tmp_path / "CNN_cube"))
+    assert len(cube.get_many(processor.fishnet["id"].values, 2020)) == len(
+        processor.fishnet
+    )
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from ImplicitGrid import NEIGHBOR_POSITIONS, ImplicitGrid
+
+# Direction of each neighbor position, as the signs of its (d_lon, d_lat) from the center tile
+POSITION_DIRECTIONS = {
+    "UL": (-1, 1),
+    "U": (0, 1),
+    "UR": (1, 1),
+    "L": (-1, 0),
+    "R": (1, 0),
+    "DL": (-1, -1),
+    "D": (0, -1),
+    "DR": (1, -1),
+}
+
+
+@pytest.fixture
+def grid():
+    return ImplicitGrid(-97.9, 30.3, 0.01, 0.008, rows=5, cols=7)
+
+
+def brute_force_neighbors(grid):
+    # Compare the centers of every pair of tiles: the neighbors are the tiles at most one tile away on each axis
+    bounds = grid.id_to_bounds(np.arange(grid.n_tiles))
+    centers_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    centers_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    table = np.full((grid.n_tiles, len(NEIGHBOR_POSITIONS)), -1)
+    for i in range(grid.n_tiles):
+        for j in range(grid.n_tiles):
+            d_x = np.round((centers_x[j] - centers_x[i]) / grid.tile_width_degrees)
+            d_y = np.round((centers_y[j] - centers_y[i]) / grid.tile_height_degrees)
+            if i != j and abs(d_x) <= 1 and abs(d_y) <= 1:
+                position = [
+                    k
+                    for k, name in enumerate(NEIGHBOR_POSITIONS)
+                    if POSITION_DIRECTIONS[name] == (d_x, d_y)
+                ][0]
+                table[i, position] = j
+    return table
+
+
+def test_neighbor_table_matches_brute_force(grid):
+    table = grid.neighbor_table()
+    assert table.dtype == np.int32
+    assert table.shape == (grid.n_tiles, 8)
+    assert np.array_equal(table, brute_force_neighbors(grid))
+
+    # Corners have 3 neighbors, other edge tiles 5 and inner tiles 8
+    counts = (table >= 0).sum(axis=1).reshape(grid.rows, grid.cols)
+    assert counts[[0, 0, -1, -1], [0, -1, 0, -1]].tolist() == [3, 3, 3, 3]
+    assert (counts[0, 1:-1] == 5).all() and (counts[-1, 1:-1] == 5).all()
+    assert (counts[1:-1, 0] == 5).all() and (counts[1:-1, -1] == 5).all()
+    assert (counts[1:-1, 1:-1] == 8).all()
+
+    # The top-left corner only has neighbors to the right and below
+    assert table[0].tolist() == [-1, -1, -1, -1, 1, -1, grid.cols, grid.cols + 1]
+
+
+def test_neighbor_table_of_selected_tiles(grid):
+    ids = np.array([34, 0, 17, 6])
+    assert np.array_equal(grid.neighbor_table(ids=ids), grid.neighbor_table()[ids])
+
+    offsets = np.array([(0, 2), (-3, 0)])
+    table = grid.neighbor_table(offsets, ids)
+    assert table.tolist() == [[-1, 13], [2, -1], [19, -1], [-1, -1]]
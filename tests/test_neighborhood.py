@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from ImplicitGrid import MOORE_OFFSETS, ImplicitGrid
+from Neighborhood import NEIGHBORHOOD_STATS, Neighborhood
+
+
+@pytest.fixture
+def grid():
+    return ImplicitGrid(-97.9, 30.3, 0.01, 0.008, rows=6, cols=5)
+
+
+def tile_offsets(grid):
+    # (n, n, 2) array of the (d_row, d_col) from every tile to every other tile, measured between tile centers
+    bounds = grid.id_to_bounds(np.arange(grid.n_tiles))
+    x = (bounds[:, 0] + bounds[:, 2]) / 2 / grid.tile_width_degrees
+    y = (bounds[:, 1] + bounds[:, 3]) / 2 / grid.tile_height_degrees
+    d_row = np.round(y[:, None] - y[None, :])
+    d_col = np.round(x[None, :] - x[:, None])
+    return np.stack([d_row, d_col], axis=-1).astype(int)
+
+
+def brute_force_weights(grid, neighborhood):
+    # Dense (n, n) matrix of the weight of tile j in the neighborhood of tile i
+    offsets = tile_offsets(grid)
+    weights = np.zeros((grid.n_tiles, grid.n_tiles))
+    for (d_row, d_col), weight in zip(neighborhood.offsets, neighborhood.weights):
+        weights[(offsets[..., 0] == d_row) & (offsets[..., 1] == d_col)] = weight
+    return weights
+
+
+def test_k_ring_and_radius_offsets():
+    ring = Neighborhood.k_ring(1)
+    assert np.array_equal(ring.offsets, MOORE_OFFSETS)
+    assert len(Neighborhood.k_ring(2).offsets) == 24
+    assert len(Neighborhood.k_ring(2, include_center=True).offsets) == 25
+    assert np.abs(Neighborhood.k_ring(2).offsets).max() == 2
+
+    disk = Neighborhood.radius(2)
+    assert len(disk.offsets) == 12
+    assert (disk.distances <= 2).all()
+    assert len(Neighborhood.radius(1.5).offsets) == 8
+    assert Neighborhood.radius(1.5).name == "radius1.5"
+
+    weighted = Neighborhood.k_ring(1, include_center=True, weighting="inverse_distance")
+    assert np.allclose(
+        weighted.weights, 1 / np.where(weighted.distances == 0, 1, weighted.distances)
+    )
+    with pytest.raises(ValueError):
+        Neighborhood.k_ring(1, weighting="gaussian")
+    with pytest.raises(ValueError):
+        Neighborhood([(0, 1), (1, 0)], weights=[1.0])
+
+
+@pytest.mark.parametrize(
+    "neighborhood",
+    [
+        Neighborhood.k_ring(1),
+        Neighborhood.k_ring(2, include_center=True),
+        Neighborhood.radius(2.3, weighting="inverse_distance"),
+    ],
+    ids=["ring1", "ring2", "radius"],
+)
+def test_csr_matches_brute_force(grid, neighborhood):
+    expected = brute_force_weights(grid, neighborhood)
+    assert np.array_equal(neighborhood.to_csr(grid).toarray(), expected)
+
+    ids = np.array([0, 4, 25, 29, 12])
+    csr = neighborhood.to_csr(grid, ids)
+    assert csr.shape == (len(ids), grid.n_tiles)
+    assert np.array_equal(csr.toarray(), expected[ids])
+
+    # Tiles on the edges and corners only keep their neighbors inside the grid
+    table = neighborhood.neighbor_ids(grid, ids)
+    for row, tile_id in zip(table, ids):
+        assert sorted(row[row >= 0]) == np.flatnonzero(expected[tile_id]).tolist()
+
+
+@pytest.mark.parametrize(
+    "neighborhood",
+    [
+        Neighborhood.k_ring(1),
+        Neighborhood.k_ring(2, include_center=True, weighting="inverse_distance"),
+        Neighborhood.radius(1.5, weighting=lambda d: np.exp(-d)),
+    ],
+    ids=["ring1", "ring2", "radius"],
+)
+def test_aggregate_matches_brute_force(grid, neighborhood):
+    rng = np.random.default_rng(0)
+    # Some tiles are missing from the fishnet and some values are NaN
+    ids = rng.permutation(grid.n_tiles)[:24]
+    values = rng.random(len(ids))
+    values[:3] = np.nan
+    results = neighborhood.aggregate(grid, ids, values, NEIGHBORHOOD_STATS)
+
+    raster = np.full(grid.n_tiles, np.nan)
+    raster[ids] = values
+    weights = brute_force_weights(grid, neighborhood)
+    for i, tile_id in enumerate(ids):
+        members = (weights[tile_id] != 0) & ~np.isnan(raster)
+        neighbor_values, neighbor_weights = raster[members], weights[tile_id][members]
+        expected = {
+            "sum": neighbor_values.sum(),
+            "count": members.sum(),
+            "weighted_sum": (neighbor_weights * neighbor_values).sum(),
+        }
+        if members.any():
+            expected["mean"] = neighbor_values.mean()
+            expected["max"] = neighbor_values.max()
+            expected["min"] = neighbor_values.min()
+            expected["weighted_mean"] = (
+                expected["weighted_sum"] / neighbor_weights.sum()
+            )
+        for stat in NEIGHBORHOOD_STATS:
+            assert np.isclose(
+                results[stat][i], expected.get(stat, np.nan), equal_nan=True
+            ), (tile_id, stat)
+
+
+def test_aggregate_rejects_unknown_statistics(grid):
+    with pytest.raises(ValueError):
+        Neighborhood.k_ring(1).aggregate(grid, [0], [1.0], stats=["median"])
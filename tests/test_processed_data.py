@@ -0,0 +1,156 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("pyarrow")
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from ProcessedData import (
+    _dataset,
+    processed_data_metadata,
+    processed_data_years,
+    read_processed_data,
+    write_processed_data,
+)
+
+
+def urbanization(years, tile_ids=(4, 1, 7, 2), batch_ids=(0, 0, 1, 1)):
+    # Rows in the tile-major order of ImageProcessor.urbanization_data
+    rng = np.random.default_rng(sum(years))
+    n = len(tile_ids) * len(years)
+    data = pd.DataFrame(
+        {
+            "tile_id": np.repeat(tile_ids, len(years)),
+            "batch_id": np.repeat(batch_ids, len(years)),
+            "year": np.tile(years, len(tile_ids)),
+            "urbanization_rate": rng.random(n),
+            "urbanization": rng.random(n),
+        }
+    )
+    for i, column in enumerate(["ImageXmin", "ImageYmin", "ImageXmax", "ImageYmax"]):
+        data[column] = np.repeat(np.arange(len(tile_ids)) * 10 + i, len(years))
+    data["Lat"] = np.repeat(np.linspace(30, 31, len(tile_ids)), len(years))
+    data["Lon"] = np.repeat(np.linspace(-98, -97, len(tile_ids)), len(years))
+    return data
+
+
+def expected_rows(data):
+    expected = data.sort_values(["tile_id", "year"], kind="stable", ignore_index=True)
+    for column in ["urbanization_rate", "urbanization"]:
+        expected[column] = expected[column].astype(np.float32)
+    return expected
+
+
+def assert_same_rows(dataset, data):
+    expected = expected_rows(data)
+    assert dataset.columns.tolist() == expected.columns.tolist()
+    for column in expected.columns:
+        assert np.array_equal(dataset[column].values, expected[column].values), column
+
+
+@pytest.mark.parametrize("partition_by", ["year", "batch_id"])
+def test_round_trip_with_typed_columns(tmp_path, partition_by):
+    path = str(tmp_path / "dataset")
+    data = urbanization([2017, 2018, 2019])
+    write_processed_data(data, path, metadata={"a": 1}, partition_by=partition_by)
+
+    dataset = read_processed_data(path)
+    assert_same_rows(dataset, data)
+    assert dataset["year"].dtype == np.int16
+    assert dataset["tile_id"].dtype == np.int32
+    assert dataset["urbanization"].dtype == np.float32
+    assert dataset["Lat"].dtype == np.float64
+
+    folders = sorted(entry for entry in os.listdir(path) if "=" in entry)
+    if partition_by == "year":
+        assert folders == ["year=2017", "year=2018", "year=2019"]
+    else:
+        assert folders == ["batch_id=0", "batch_id=1"]
+    assert processed_data_years(path) == {2017, 2018, 2019}
+    assert processed_data_metadata(path) == {"a": 1}
+
+
+@pytest.mark.parametrize("partition_by", ["year", "batch_id"])
+def test_filters_select_partitions_and_rows(tmp_path, partition_by):
+    path = str(tmp_path / "dataset")
+    data = urbanization([2017, 2018, 2019])
+    write_processed_data(data, path, partition_by=partition_by)
+
+    selected = read_processed_data(path, years=[2018], batch_ids=[1])
+    assert_same_rows(selected, data[(data["year"] == 2018) & (data["batch_id"] == 1)])
+    assert read_processed_data(path, years=[2020]).empty
+
+    columns = read_processed_data(path, years=[2017, 2019], columns=["tile_id", "year"])
+    assert columns.columns.tolist() == ["tile_id", "year"]
+    assert columns["year"].tolist() == [2017, 2019] * 4
+    assert columns["tile_id"].tolist() == [1, 1, 2, 2, 4, 4, 7, 7]
+
+
+def test_filters_are_pushed_down_to_partitions_and_row_groups(tmp_path):
+    path = str(tmp_path / "dataset")
+    write_processed_data(urbanization([2017, 2018]), path, partition_by="year")
+    # A year filter only reaches the files of the year partition
+    fragments = _dataset(path).get_fragments(filter=ds.field("year") == 2018)
+    assert [os.path.basename(os.path.dirname(f.path)) for f in fragments] == [
+        "year=2018"
+    ]
+
+    write_processed_data(urbanization([2017, 2018]), path, partition_by="batch_id")
+    fragments = _dataset(path).get_fragments(filter=ds.field("batch_id") == 1)
+    (fragment,) = list(fragments)
+    assert os.path.basename(os.path.dirname(fragment.path)) == "batch_id=1"
+    # Within a batch file, the year statistics of the row groups let a year filter skip them
+    metadata = pq.ParquetFile(fragment.path).metadata
+    column = metadata.schema.names.index("year")
+    statistics = metadata.row_group(0).column(column).statistics
+    assert (statistics.min, statistics.max) == (2017, 2018)
+
+
+def test_missing_dataset_has_no_years(tmp_path):
+    assert processed_data_years(str(tmp_path / "missing")) == set()
+
+
+def test_incremental_writes_add_and_replace_years(tmp_path):
+    path = str(tmp_path / "dataset")
+    first = urbanization([2017, 2018])
+    write_processed_data(first, path, metadata={"version": 1})
+    second = urbanization([2019])
+    write_processed_data(second, path, metadata={"version": 2}, incremental=True)
+    assert processed_data_years(path) == {2017, 2018, 2019}
+    assert_same_rows(read_processed_data(path), pd.concat([first, second]))
+    assert processed_data_metadata(path) == {"version": 2}
+
+    # The partition of a year written again is replaced, not duplicated
+    replaced = urbanization([2018, 2020])
+    write_processed_data(replaced, path, incremental=True)
+    assert_same_rows(
+        read_processed_data(path),
+        pd.concat([first[first["year"] == 2017], replaced, second]),
+    )
+
+    # A rewrite drops the previous years
+    write_processed_data(second, path)
+    assert processed_data_years(path) == {2019}
+
+
+def test_incremental_batch_partitions_only_add_new_years(tmp_path):
+    path = str(tmp_path / "dataset")
+    first = urbanization([2017, 2018])
+    write_processed_data(first, path, partition_by="batch_id")
+    second = urbanization([2019])
+    write_processed_data(second, path, partition_by="batch_id", incremental=True)
+    assert_same_rows(read_processed_data(path), pd.concat([first, second]))
+
+    with pytest.raises(ValueError):
+        write_processed_data(
+            urbanization([2018]), path, partition_by="batch_id", incremental=True
+        )
+    assert_same_rows(read_processed_data(path), pd.concat([first, second]))
+
+
+def test_unknown_partitioning_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        write_processed_data(
+            urbanization([2017]), str(tmp_path / "dataset"), partition_by="tile_id"
+        )
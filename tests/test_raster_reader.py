@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from PIL import Image
+from RasterReader import image_shape, open_raster, read_image, read_windows
+
+tifffile = pytest.importorskip("tifffile")
+
+
+@pytest.fixture
+def rgb():
+    return np.random.default_rng(0).integers(0, 256, (300, 200, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        {},
+        {"planarconfig": "separate"},
+        {"planarconfig": "separate", "compression": "zlib", "tile": (64, 64)},
+        {"compression": "zlib", "tile": (64, 64)},
+    ],
+    ids=["contiguous", "planar", "planar-compressed", "compressed"],
+)
+def test_tiffs_are_read_pixel_interleaved(tmp_path, rgb, options):
+    path = str(tmp_path / "image.tif")
+    stored = np.moveaxis(rgb, -1, 0) if options.get("planarconfig") else rgb
+    tifffile.imwrite(path, stored, photometric="rgb", **options)
+
+    assert tuple(image_shape(path)) == (300, 200, 3)
+    assert np.array_equal(read_image(path), rgb)
+    assert np.array_equal(open_raster(path)[10:50, 20:60], rgb[10:50, 20:60])
+
+    windows = [(20, 10, 60, 50), (150, 250, 200, 300)]
+    subimages = read_windows(path, windows)
+    for (xmin, ymin, xmax, ymax), subimage in zip(windows, subimages):
+        assert np.array_equal(subimage, rgb[ymin:ymax, xmin:xmax])
+
+
+def test_tiff_and_png_readers_agree(tmp_path, rgb):
+    Image.fromarray(rgb).save(tmp_path / "image.png")
+    tifffile.imwrite(
+        str(tmp_path / "image.tif"),
+        np.moveaxis(rgb, -1, 0),
+        photometric="rgb",
+        planarconfig="separate",
+    )
+    png, tif = str(tmp_path / "image.png"), str(tmp_path / "image.tif")
+    assert tuple(image_shape(png)) == tuple(image_shape(tif))
+    assert np.array_equal(read_image(png), read_image(tif))
@@ -0,0 +1,62 @@
+import json
+import os
+import numpy as np
+from ResultCache import DIGESTS_FILE, ResultCache
+
+
+def test_put_get_and_keys(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    key = cache.key("worker", np.arange(3), {"scale": 1})
+    assert key == cache.key("worker", np.arange(3), {"scale": 1})
+    assert key != cache.key("worker", np.arange(3), {"scale": 2})
+    assert key != cache.key("worker", np.arange(3).astype(np.int32), {"scale": 1})
+
+    assert cache.get(key, "missing") == "missing"
+    cache.put(key, {"values": np.ones(4)})
+    assert key in cache
+    assert np.array_equal(cache.get(key)["values"], np.ones(4))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, monkeypatch):
+    cache = ResultCache(str(tmp_path), max_bytes=None)
+    keys = [cache.key(i) for i in range(4)]
+    for i, key in enumerate(keys):
+        cache.put(key, np.zeros(1000, dtype=np.uint8))
+        os.utime(cache._entry_path(key), (i, i))
+    entry_size = os.path.getsize(cache._entry_path(keys[0]))
+
+    walks = []
+    walk = os.walk
+    monkeypatch.setattr(os, "walk", lambda *args: walks.append(args) or walk(*args))
+    cache = ResultCache(str(tmp_path), max_bytes=5 * entry_size)
+    cache.put(cache.key(4), np.zeros(1000, dtype=np.uint8))
+    assert len(walks) == 1
+    cache.get(keys[0])
+
+    # The cache goes over budget: the two least recently used entries are deleted
+    cache.max_bytes = 4 * entry_size
+    cache.put(cache.key(5), np.zeros(1000, dtype=np.uint8))
+    assert len(walks) == 2
+    assert [key in cache for key in keys] == [True, False, False, True]
+
+    # Puts within the budget do not walk the entries again
+    cache.put(cache.key(5), np.zeros(1000, dtype=np.uint8))
+    assert len(walks) == 2
+
+
+def test_digests_are_memoized_and_flushed(tmp_path):
+    path = tmp_path / "image.tif"
+    path.write_bytes(b"pixels")
+    cache = ResultCache(str(tmp_path / "cache"))
+    digest = cache.file_digest(str(path))
+    assert not (tmp_path / "cache" / DIGESTS_FILE).exists()
+
+    cache.flush()
+    with open(tmp_path / "cache" / DIGESTS_FILE) as f:
+        assert json.load(f)[os.path.abspath(path)]["digest"] == digest
+    assert ResultCache(str(tmp_path / "cache")).file_digest(str(path)) == digest
+
+    signature = cache.file_signature(str(path))
+    path.write_bytes(b"other pixels")
+    assert cache.file_signature(str(path)) != signature
+    assert cache.file_digest(str(path)) != digest
@@ -0,0 +1,282 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+pytest.importorskip("tensorflow")
+from DynamicWorld import DW_PALETTE, rgb_to_class
+from RasterReader import read_image, write_class_raster
+from SequenceDataLoader import SequenceDataLoader
+from TileCube import crop_tiles, write_chunk, write_index
+
+YEARS = [2016, 2017, 2018]
+N_REGIONS = 6
+
+
+@pytest.fixture(scope="module")
+def regions(tmp_path_factory):
+    # 6 regions of 3 x 3 tiles of 40 x 40 pixels, with one class raster per year
+    root = str(tmp_path_factory.mktemp("regions"))
+    rng = np.random.default_rng(0)
+    tile_region_dic, coordinates = {}, {}
+    for region in range(N_REGIONS):
+        key = f"landcover_batchID_{region}"
+        for year in YEARS:
+            os.makedirs(os.path.join(root, str(year), "Final"), exist_ok=True)
+            write_class_raster(
+                os.path.join(root, str(year), "Final", f"{key}.tif"),
+                rng.integers(0, 10, (128, 128)).astype(np.uint8),
+            )
+        tile_region_dic[key] = list(range(region * 9, region * 9 + 9))
+        for tile in range(9):
+            row, col = divmod(tile, 3)
+            coordinates[region * 9 + tile] = (
+                col * 40,
+                row * 40,
+                col * 40 + 40,
+                row * 40 + 40,
+            )
+    target = rng.random(N_REGIONS * 9)
+    tab_data = pd.DataFrame(rng.random((N_REGIONS * 9, 4)), columns=list("abcd"))
+    return root, tile_region_dic, coordinates, target, tab_data
+
+
+def make_loader(regions, image_dir=None, **kwargs):
+    root, tile_region_dic, coordinates, target, tab_data = regions
+    kwargs.setdefault("batch_size", 8)
+    return SequenceDataLoader(
+        YEARS,
+        list(tile_region_dic),
+        target,
+        tile_region_dic,
+        coordinates,
+        image_dir or root,
+        (32, 32),
+        **kwargs,
+    )
+
+
+def test_cube_tiles_are_cropped_to_dim(regions, tmp_path):
+    root, tile_region_dic, coordinates, _, _ = regions
+    tile_ids, batch_ids, positions = [], [], []
+    for batch_id, (key, tiles) in enumerate(tile_region_dic.items()):
+        for year in YEARS:
+            image = read_image(os.path.join(root, str(year), "Final", f"{key}.tif"))
+            subimages = [
+                image[ymin:ymax, xmin:xmax]
+                for xmin, ymin, xmax, ymax in map(coordinates.get, tiles)
+            ]
+            # The cube keeps the full 40 x 40 tiles, larger than dim
+            write_chunk(str(tmp_path), year, batch_id, crop_tiles(subimages, (40, 40)))
+        tile_ids += tiles
+        batch_ids += [batch_id] * len(tiles)
+        positions += list(range(len(tiles)))
+    write_index(str(tmp_path), tile_ids, batch_ids, positions)
+
+    tiff = make_loader(regions, shuffle=False)
+    cube = make_loader(regions, str(tmp_path), shuffle=False, store="cube")
+    for i in range(len(tiff)):
+        assert np.array_equal(tiff[i][0], cube[i][0])
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_prefetching_follows_the_index_order(regions, use_processes):
+    reference = make_loader(regions, shuffle=False)
+    loader = make_loader(
+        regions, shuffle=False, workers=2, prefetch=2, use_processes=use_processes
+    )
+    order = np.random.default_rng(0).permutation(len(loader.batches))
+    loader.set_index_order(order)
+    try:
+        for position, index in enumerate(order):
+            X, y = loader[index]
+            assert np.array_equal(X, reference[index][0])
+            assert np.array_equal(y, reference[index][1])
+            assert sorted(loader._pending) == sorted(order[position + 1 : position + 3])
+    finally:
+        loader.close()
+
+
+def test_pending_batches_are_bounded_under_random_access(regions):
+    loader = make_loader(regions, shuffle=False, workers=2, prefetch=2)
+    rng = np.random.default_rng(1)
+    try:
+        for index in rng.integers(0, len(loader.batches), 20):
+            loader[index]
+            assert len(loader._pending) <= loader.prefetch
+            assert index not in loader._pending
+
+        futures = list(loader._pending.values()) + loader._dropped
+        loader.on_epoch_end()
+        assert all(future.done() for future in futures)
+        assert not loader._pending and not loader._dropped
+    finally:
+        loader.close()
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+@pytest.mark.parametrize("shuffle_mode", ["regions", "within_regions", "balanced"])
+@pytest.mark.parametrize("batch_size", [4, 6, 100])
+def test_batches_partition_the_tiles(regions, shuffle, shuffle_mode, batch_size):
+    _, tile_region_dic, _, _, _ = regions
+    np.random.seed(0)
+    loader = make_loader(
+        regions, shuffle=shuffle, shuffle_mode=shuffle_mode, batch_size=batch_size
+    )
+    batches = list(loader.batches)
+    tiles = np.concatenate([np.concatenate(list(b.values())) for b in batches])
+
+    # Every tile exactly once, in full batches but the last one
+    assert len(batches) == len(loader)
+    assert np.array_equal(np.sort(tiles), np.arange(N_REGIONS * 9))
+    sizes = [sum(len(t) for t in b.values()) for b in batches]
+    assert all(size == batch_size for size in sizes[:-1])
+    assert 0 < sizes[-1] <= batch_size
+    for batch in batches:
+        for key, tile_ids in batch.items():
+            assert set(tile_ids) <= set(tile_region_dic[key])
+
+    region_of = {t: key for key, ts in tile_region_dic.items() for t in ts}
+    visits = [region_of[t] for t in tiles]
+    if not shuffle or shuffle_mode != "balanced":
+        # The tiles of a region are visited together
+        changes = [
+            key for i, key in enumerate(visits) if i == 0 or key != visits[i - 1]
+        ]
+        assert len(changes) == N_REGIONS
+    else:
+        # Every batch samples the regions evenly
+        for batch in batches:
+            counts = [len(batch.get(key, ())) for key in tile_region_dic]
+            assert max(counts) - min(counts) <= 1
+    if not shuffle or shuffle_mode == "regions":
+        for key in tile_region_dic:
+            assert [t for t in tiles if region_of[t] == key] == tile_region_dic[key]
+
+
+@pytest.mark.parametrize(
+    "workers, prefetch, n_buffers", [(0, 2, 3), (2, 2, 6), (3, 1, 4)]
+)
+def test_ring_buffers_never_overwrite_batches_in_use(
+    regions, workers, prefetch, n_buffers
+):
+    _, _, _, target, tab_data = regions
+    np.random.seed(0)
+    loader = make_loader(
+        regions,
+        batch_size=4,
+        tab_data=tab_data,
+        workers=workers,
+        prefetch=prefetch,
+        n_buffers=n_buffers,
+    )
+    held = n_buffers - (prefetch + 1 if workers else 1)
+    try:
+        returned = []
+        for index in np.random.default_rng(2).integers(0, len(loader.batches), 40):
+            returned.append((index, loader[index]))
+            # The last returned batches are all still intact
+            for i, ((X, X_tab), y) in returned[-held:]:
+                tile_ids = np.concatenate(list(loader.batches[i].values()))
+                expected = loader._assemble(loader.batches[i])
+                assert np.array_equal(X, expected[0][0])
+                assert np.array_equal(
+                    X_tab, tab_data.values[tile_ids].astype(np.float32)
+                )
+                assert np.array_equal(y, target[tile_ids].astype(np.float32))
+        assert len(loader._buffers) <= 3 * n_buffers
+    finally:
+        loader.close()
+
+
+def test_grayscale_inputs_match_pil_luminance(regions, tmp_path):
+    rng = np.random.default_rng(2)
+    palette = np.vstack([DW_PALETTE, np.zeros((1, 3), dtype=np.uint8)])
+    paths = []
+    for i in range(2):
+        classes = rng.integers(0, len(palette), (40, 40)).astype(np.uint8)
+        paths.append(str(tmp_path / f"visualize_{i}.tif"))
+        Image.fromarray(palette[classes]).save(paths[-1])
+        write_class_raster(str(tmp_path / f"class_{i}.tif"), classes)
+    expected = [np.asarray(Image.open(path).convert("L")) / 255.0 for path in paths]
+
+    loader = make_loader(regions, shuffle=False)
+    for i, path in enumerate(paths):
+        assert np.allclose(loader._load_grayscale_image(path), expected[i])
+        assert np.allclose(
+            loader._load_grayscale_image(str(tmp_path / f"class_{i}.tif")), expected[i]
+        )
+    assert np.allclose(
+        loader._load_grayscale_sequence(paths), np.stack(expected, axis=-1)
+    )
+
+    # Whole region arrays, RGB or class indices, float32 or uint8
+    image = np.asarray(Image.open(paths[0]))
+    assert np.allclose(loader._prepare_image(image), expected[0])
+    assert np.allclose(loader._prepare_image(rgb_to_class(image)), expected[0])
+    uint8 = make_loader(regions, shuffle=False, dtype="uint8")
+    assert np.array_equal(
+        uint8._prepare_image(image), np.asarray(Image.open(paths[0]).convert("L"))
+    )
+
+
+def test_region_cache_evicts_the_least_recently_used_images(regions):
+    _, tile_region_dic, _, _, _ = regions
+    keys = list(tile_region_dic)
+    # Budget of two decoded float32 region images of 128 x 128 pixels
+    loader = make_loader(regions, shuffle=False, cache_bytes=2 * 128 * 128 * 4)
+
+    first = loader._region_image(2016, keys[0])
+    loader._region_image(2016, keys[1])
+    assert (loader.cache_hits, loader.cache_misses) == (0, 2)
+    # A hit returns the cached array and makes it the most recently used
+    assert loader._region_image(2016, keys[0]) is first
+    assert (loader.cache_hits, loader.cache_misses) == (1, 2)
+
+    loader._region_image(2016, keys[2])
+    assert list(loader._region_cache) == [(2016, keys[0]), (2016, keys[2])]
+    assert loader._region_cache_size == 2 * first.nbytes
+    # The evicted image is decoded again, which evicts the next least recently used one
+    loader._region_image(2016, keys[1])
+    assert loader.cache_misses == 4
+    assert list(loader._region_cache) == [(2016, keys[2]), (2016, keys[1])]
+
+    # Images larger than the budget are not cached, and a budget of 0 disables the cache
+    small = make_loader(regions, shuffle=False, cache_bytes=first.nbytes - 1)
+    small._region_image(2016, keys[0])
+    assert not small._region_cache
+    disabled = make_loader(regions, shuffle=False)
+    disabled._region_image(2016, keys[0])
+    disabled._region_image(2016, keys[0])
+    assert not disabled._region_cache and disabled.cache_misses == 2
+
+
+def test_region_cache_is_reused_across_batches_and_epochs(regions):
+    reference = make_loader(regions, shuffle=False)
+    loader = make_loader(regions, shuffle=False, cache_bytes=2**30)
+    batches = [reference[i] for i in range(len(reference))]
+
+    for epoch in range(2):
+        for i in range(len(loader)):
+            X, y = loader[i]
+            assert np.array_equal(X, batches[i][0])
+            assert np.array_equal(y, batches[i][1])
+        # Every (year, region) image is only decoded in the first epoch
+        assert loader.cache_misses == len(YEARS) * N_REGIONS
+        loader.on_epoch_end()
+
+
+def test_cache_batch_order_starts_with_the_cached_regions(regions):
+    _, tile_region_dic, _, _, _ = regions
+    keys = list(tile_region_dic)
+    loader = make_loader(
+        regions, batch_order="cache", cache_bytes=3 * len(YEARS) * 128 * 128 * 4
+    )
+    for key in [keys[4], keys[1], keys[3]]:
+        for year in YEARS:
+            loader._region_image(year, key)
+    loader.on_epoch_end()
+    # Most recently used first, then the other regions in shuffled order
+    assert [keys[i] for i in loader.region_indexes[:3]] == [keys[3], keys[1], keys[4]]
+    assert sorted(loader.region_indexes) == list(range(N_REGIONS))
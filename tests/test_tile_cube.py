@@ -0,0 +1,27 @@
+import numpy as np
+from TileCube import TileCube, crop_tiles, write_chunk, write_index
+
+
+def test_write_index_merges_with_the_existing_index(tmp_path):
+    crops = np.arange(4 * 2 * 2, dtype=np.uint8).reshape(4, 2, 2)
+    write_chunk(str(tmp_path), 2020, 0, crops[:2])
+    write_chunk(str(tmp_path), 2020, 1, crops[2:])
+
+    write_index(str(tmp_path), [7, 3], [0, 0], [0, 1])
+    write_index(str(tmp_path), [5, 1], [1, 1], [0, 1])
+    cube = TileCube(str(tmp_path))
+    assert cube.tile_ids.tolist() == [1, 3, 5, 7]
+    assert np.array_equal(cube.get_many([7, 3, 5, 1], 2020), crops)
+
+    # Rewritten tiles replace their previous rows
+    write_index(str(tmp_path), [3], [1], [0])
+    cube = TileCube(str(tmp_path))
+    assert cube.tile_ids.tolist() == [1, 3, 5, 7]
+    assert np.array_equal(cube.get(3, 2020), crops[2])
+
+
+def test_crop_tiles_pads_small_tiles_with_no_data():
+    crops = crop_tiles([np.ones((3, 5), np.uint8), np.ones((1, 1), np.uint8)], (2, 2))
+    assert crops.shape == (2, 2, 2)
+    assert crops[0].tolist() == [[1, 1], [1, 1]]
+    assert crops[1].tolist() == [[1, 9], [9, 9]]
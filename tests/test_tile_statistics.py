@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from DynamicWorld import N_LABELS
+from Fishnet import Fishnet
+from ImageProcessor import ImageProcessor
+from TileStatistics import IntegralHistogram, scale_windows, tile_histograms
+
+
+def random_raster(height, width, seed=0):
+    return np.random.default_rng(seed).integers(0, N_LABELS, (height, width))
+
+
+def grid_windows(height, width, size):
+    ys, xs = np.meshgrid(
+        np.arange(0, height, size), np.arange(0, width, size), indexing="ij"
+    )
+    return np.stack(
+        [xs.ravel(), ys.ravel(), xs.ravel() + size, ys.ravel() + size], axis=1
+    )
+
+
+@pytest.mark.parametrize("shape", [(40, 60), (300, 260)])
+def test_integral_histogram_matches_bincount(shape):
+    raster = random_raster(*shape)
+    windows = grid_windows(*shape, 20)
+    integral = IntegralHistogram(raster)
+
+    # Small images are counted in 2 bytes, larger ones in 4
+    assert integral.table.dtype == (np.uint16 if raster.size < 2**16 else np.uint32)
+    assert np.array_equal(
+        integral.histograms(windows), tile_histograms(raster, windows)
+    )
+    assert np.array_equal(
+        integral.histograms(windows),
+        tile_histograms(raster, windows, backend="integral"),
+    )
+
+    # Scaled windows are truncated at the edges of the image
+    scaled = scale_windows(windows, 3)
+    expected = [
+        np.bincount(
+            raster[max(y0, 0) : y1, max(x0, 0) : x1].ravel(), minlength=N_LABELS
+        )
+        for x0, y0, x1, y1 in scaled
+    ]
+    assert np.array_equal(integral.histograms(scaled), expected)
+
+
+def test_unknown_backend_raises_value_error():
+    fishnet = Fishnet(tile_size_miles=0.5, coordinates=(-97.9, 30.1, -97.8, 30.2))
+    fishnet.create_fishnet()
+    fishnet.batch(2)
+    processor = ImageProcessor(fishnet)
+    with pytest.raises(ValueError):
+        processor.compute_tile_statistics(
+            "missing_folder", "landcover", {"x": "built_pixel_mean"}, backend="sat"
+        )
+    with pytest.raises(ValueError):
+        tile_histograms(random_raster(10, 10), grid_windows(10, 10, 5), backend="sat")
+
+
+def test_mean_pixel_values_of_empty_windows_are_nan():
+    matrix = np.arange(100, dtype=np.float64).reshape(10, 10)
+    windows = np.array([[0, 0, 5, 5], [8, 8, 12, 12], [3, 3, 3, 6], [12, 0, 15, 5]])
+    means = ImageProcessor.mean_pixel_values(None, matrix, windows)
+    assert means[0] == matrix[:5, :5].mean()
+    assert means[1] == matrix[8:12, 8:12].mean()
+    assert np.isnan(means[2:]).all()